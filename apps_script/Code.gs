@@ -0,0 +1,235 @@
+// ==============================================================================
+// 【Apps Script 雲端端點】 - 對應 stock_app.py 的 load_db_from_sheets / push_db_to_sheets
+// 部署方式：試算表 → 擴充功能 → Apps Script，貼上本檔後「部署為網頁應用程式」，
+// 網址填入 secrets 的 GOOGLE_SCRIPT_URL。
+//
+// 整包文件以 JSON 字串分段存在工作表 DB_SHEET 的 A 欄 (單一儲存格上限 5 萬字元)，
+// 文件帶 "_version"，每次成功寫入 +1：
+//   GET                                    → 目前文件 (含 _version)
+//   POST {"op": "patch", "base_version", "ops"}
+//        版本相符 → 套用 ops，回傳 {"status": "ok", "version": v+1}
+//        版本不符 → 不寫入，回傳 {"status": "conflict", "version": 目前版本, "db": 目前文件}
+//   POST 整包文件 (舊版客戶端)             → 覆寫並 +1 版本，回傳 "Success"
+// 讀寫都在 LockService 的腳本鎖內完成，兩台裝置同時存檔時只有一台能以同一個 base_version 寫入。
+//
+// 搬移舊資料：DB_SHEET 不存在或是空的時候，先從舊的儲存讀出整包文件、寫入 DB_SHEET 後才回應，
+// 來源由「專案設定 → 指令碼屬性」指定 (依序嘗試)：
+//   LEGACY_SCRIPT_URL  舊版網頁應用程式的網址 (GET 會回傳整包 JSON)
+//   LEGACY_SHEET       舊資料所在的工作表名稱 (A 欄為 JSON 字串，可分段)
+//   INIT_EMPTY_DB      設為 "true" 表示這是全新帳戶，允許以空文件開始
+// 都沒有設定 (或讀取失敗) 時回傳錯誤，客戶端視同離線，不會把空帳戶同步回雲端蓋掉舊資料。
+// ==============================================================================
+var DB_SHEET = "db_json";
+var CHUNK_SIZE = 40000;
+var LOCK_TIMEOUT_MS = 10000;
+
+function defaultDb_() {
+  return { password_hash: null, list: {}, costs: {}, _version: 0 };
+}
+
+function dbSheet_() {
+  var ss = SpreadsheetApp.getActiveSpreadsheet();
+  return ss.getSheetByName(DB_SHEET) || ss.insertSheet(DB_SHEET);
+}
+
+function readSheetText_(sheet) {
+  var rows = sheet.getLastRow();
+  if (rows === 0) return "";
+  return sheet.getRange(1, 1, rows, 1).getValues().map(function (r) { return r[0]; }).join("");
+}
+
+// 從舊的儲存讀出整包文件；沒有設定來源時回傳 null
+function readLegacyDb_() {
+  var props = PropertiesService.getScriptProperties();
+  var url = props.getProperty("LEGACY_SCRIPT_URL");
+  if (url) {
+    var response = UrlFetchApp.fetch(url, { followRedirects: true, muteHttpExceptions: true });
+    if (response.getResponseCode() !== 200) {
+      throw new Error("舊版端點讀取失敗 (HTTP " + response.getResponseCode() + ")");
+    }
+    return JSON.parse(response.getContentText());
+  }
+  var name = props.getProperty("LEGACY_SHEET");
+  if (name) {
+    var sheet = SpreadsheetApp.getActiveSpreadsheet().getSheetByName(name);
+    var text = sheet ? readSheetText_(sheet) : "";
+    if (!text) throw new Error("舊資料工作表 " + name + " 不存在或是空的");
+    return JSON.parse(text);
+  }
+  if (props.getProperty("INIT_EMPTY_DB") === "true") return defaultDb_();
+  return null;
+}
+
+// 呼叫端需持有腳本鎖：DB_SHEET 是空的時候只搬移一次，寫入後之後的讀取都直接走 DB_SHEET
+function readDb_() {
+  var text = readSheetText_(dbSheet_());
+  if (!text) {
+    var legacy = readLegacyDb_();
+    if (legacy === null) {
+      throw new Error(DB_SHEET + " 尚未初始化：請在指令碼屬性設定 LEGACY_SCRIPT_URL 或 LEGACY_SHEET (全新帳戶設定 INIT_EMPTY_DB=true)");
+    }
+    if (typeof legacy._version !== "number") legacy._version = 0;
+    writeDb_(legacy);
+    return legacy;
+  }
+  var db = JSON.parse(text);
+  if (typeof db._version !== "number") db._version = 0;
+  return db;
+}
+
+// 清單內以 key 找到同鍵的列原位替換，找不到的接在最後 (與 stock_app.py 的 _upsert_rows 相同)
+function upsertRows_(rows, key, values) {
+  values.forEach(function (value) {
+    for (var i = 0; i < rows.length; i++) {
+      if (rows[i] !== null && typeof rows[i] === "object" && rows[i][key] === value[key]) {
+        rows[i] = value;
+        return;
+      }
+    }
+    rows.push(value);
+  });
+}
+
+function writeDb_(db) {
+  var text = JSON.stringify(db);
+  var chunks = [];
+  for (var i = 0; i < text.length; i += CHUNK_SIZE) chunks.push([text.substring(i, i + CHUNK_SIZE)]);
+  var sheet = dbSheet_();
+  sheet.clearContents();
+  // 以純文字寫入，避免試算表把內容當成數字或公式
+  sheet.getRange(1, 1, chunks.length, 1).setNumberFormat("@").setValues(chunks);
+}
+
+// 與 stock_app.py 的 apply_db_patch 相同的規則：set / del 針對字典鍵，append 只追加帳本清單，
+// upsert 以 op.key (已實現損益的 tx_id) 原位更新帳本產生的列
+function applyOps_(db, ops) {
+  ops.forEach(function (op) {
+    var path = op.path.slice();
+    var leaf = path.pop();
+    var target = db;
+    path.forEach(function (key) {
+      if (typeof target[key] !== "object" || target[key] === null) target[key] = {};
+      target = target[key];
+    });
+    if (op.op === "set") {
+      target[leaf] = op.value;
+    } else if (op.op === "del") {
+      delete target[leaf];
+    } else if (op.op === "append") {
+      if (!Array.isArray(target[leaf])) target[leaf] = [];
+      Array.prototype.push.apply(target[leaf], op.values);
+    } else if (op.op === "upsert") {
+      if (!Array.isArray(target[leaf])) target[leaf] = [];
+      upsertRows_(target[leaf], op.key, op.values);
+    } else {
+      throw new Error("未知的 patch 操作: " + op.op);
+    }
+  });
+  return db;
+}
+
+// 實際處理一次寫入請求 (呼叫端需持有腳本鎖)；回傳 JSON 物件或舊版的 "Success" 字串
+function handleWrite_(body) {
+  var db = readDb_();
+  if (body.op === "patch") {
+    if (body.base_version !== db._version) {
+      return { status: "conflict", version: db._version, db: db };
+    }
+    applyOps_(db, body.ops || []);
+    db._version += 1;
+    writeDb_(db);
+    return { status: "ok", version: db._version };
+  }
+  // 舊版整包存檔：直接覆寫，但版本仍要往上加，讓持有舊版本的客戶端走衝突重送
+  body._version = db._version + 1;
+  writeDb_(body);
+  return "Success";
+}
+
+function jsonOutput_(obj) {
+  return ContentService.createTextOutput(JSON.stringify(obj)).setMimeType(ContentService.MimeType.JSON);
+}
+
+function doGet() {
+  var lock = LockService.getScriptLock();
+  try {
+    lock.waitLock(LOCK_TIMEOUT_MS);
+  } catch (err) {
+    return jsonOutput_({ status: "error", message: "伺服器忙碌中，請稍後重試" });
+  }
+  try {
+    return jsonOutput_(readDb_());
+  } catch (err) {
+    return jsonOutput_({ status: "error", message: String(err) });
+  } finally {
+    lock.releaseLock();
+  }
+}
+
+function doPost(e) {
+  var lock = LockService.getScriptLock();
+  try {
+    lock.waitLock(LOCK_TIMEOUT_MS);
+  } catch (err) {
+    return jsonOutput_({ status: "error", message: "伺服器忙碌中，請稍後重試" });
+  }
+  try {
+    var result = handleWrite_(JSON.parse(e.postData.contents));
+    return typeof result === "string" ? ContentService.createTextOutput(result) : jsonOutput_(result);
+  } catch (err) {
+    return jsonOutput_({ status: "error", message: String(err) });
+  } finally {
+    lock.releaseLock();
+  }
+}
+
+// ------------------------------------------------------------------------------
+// 在 Apps Script 編輯器手動執行：模擬兩台裝置以同一個 base_version 存檔，
+// 確認第二台拿到 conflict、以最新文件重新套用後能成功，且兩邊的交易都保留。
+// 會暫時改寫 DB_SHEET，結束後還原原本內容。
+// ------------------------------------------------------------------------------
+function testPatchConflict() {
+  var lock = LockService.getScriptLock();
+  lock.waitLock(LOCK_TIMEOUT_MS);
+  var original = readDb_();
+  try {
+    writeDb_({ password_hash: null, list: {}, costs: {}, transactions: [],
+               realized_pnl: [{ "獲利": 100 }, { tx_id: 3, "獲利": 200 }], _version: 5 });
+
+    var first = handleWrite_({ op: "patch", base_version: 5, ops: [
+      { op: "set", path: ["list", "2330.TW"], value: "台積電" },
+      { op: "append", path: ["transactions"], values: [{ id: 1, "代號": "2330.TW" }] }
+    ] });
+    assert_(first.status === "ok" && first.version === 6, "第一次 patch 應成功: " + JSON.stringify(first));
+
+    var secondOps = [{ op: "append", path: ["transactions"], values: [{ id: 2, "代號": "2317.TW" }] }];
+    var stale = handleWrite_({ op: "patch", base_version: 5, ops: secondOps });
+    assert_(stale.status === "conflict" && stale.version === 6, "舊版本應回傳 conflict: " + JSON.stringify(stale));
+    assert_(readDb_()._version === 6, "衝突時不可寫入");
+
+    var retry = handleWrite_({ op: "patch", base_version: stale.version, ops: secondOps });
+    assert_(retry.status === "ok" && retry.version === 7, "重送應成功: " + JSON.stringify(retry));
+
+    var db = readDb_();
+    assert_(db.transactions.length === 2 && db.list["2330.TW"] === "台積電", "兩次變更都應保留: " + JSON.stringify(db));
+
+    var upsert = handleWrite_({ op: "patch", base_version: 7, ops: [
+      { op: "upsert", path: ["realized_pnl"], key: "tx_id", values: [{ tx_id: 3, "獲利": 250 }, { tx_id: 4, "獲利": 50 }] }
+    ] });
+    assert_(upsert.status === "ok" && upsert.version === 8, "upsert 應成功: " + JSON.stringify(upsert));
+    db = readDb_();
+    assert_(db.realized_pnl.length === 3 && db.realized_pnl[1]["獲利"] === 250 && db.realized_pnl[2].tx_id === 4,
+            "upsert 應原位更新同 tx_id 的列、新的接在最後: " + JSON.stringify(db.realized_pnl));
+
+    assert_(handleWrite_({ password_hash: null, list: {}, costs: {} }) === "Success", "整包存檔應回傳 Success");
+    assert_(readDb_()._version === 9, "整包存檔也要推進版本");
+    Logger.log("testPatchConflict 通過");
+  } finally {
+    writeDb_(original);
+    lock.releaseLock();
+  }
+}
+
+function assert_(cond, message) {
+  if (!cond) throw new Error(message);
+}
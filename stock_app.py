@@ -1,18 +1,67 @@
+import time
+_RUN_T0 = time.perf_counter()  # 冷啟動計時起點 (要在所有 import 之前)
+
 import streamlit as st
-import yfinance as yf
-import plotly.graph_objects as go
-import pandas as pd
+import importlib
 import json
 import os
 import hashlib
-import requests
-import time
 import re
+import sys
+import bisect
+import sqlite3
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from contextlib import closing
 from datetime import datetime, timedelta
-from FinMind.data import DataLoader
-from plotly.subplots import make_subplots
-from streamlit_gsheets import GSheetsConnection
-from bs4 import BeautifulSoup
+
+st.set_page_config(page_title="小鐵的股票分析報告", layout="wide")
+
+# ==============================================================================
+# 【冷啟動優化】 - 重量級套件延遲到第一次使用時才 import
+# ==============================================================================
+class _LazyModule:
+    """第一次存取屬性時才真正 import，讓登入畫面不必等 yfinance / pandas / FinMind 載入"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+yf = _LazyModule("yfinance")
+go = _LazyModule("plotly.graph_objects")
+pd = _LazyModule("pandas")
+np = _LazyModule("numpy")
+requests = _LazyModule("requests")
+
+def make_subplots(*args, **kwargs):
+    from plotly.subplots import make_subplots as _make_subplots
+    return _make_subplots(*args, **kwargs)
+
+@st.cache_resource(show_spinner=False)
+def get_finmind_client():
+    """全程序共用一個 FinMind DataLoader，第一次使用時才建立並以 token 登入"""
+    from FinMind.data import DataLoader
+    token = st.secrets.get("FINMIND_TOKEN", "")
+    try:
+        return DataLoader(token=token)
+    except TypeError:
+        # 舊版 FinMind 的建構子不收 token
+        client = DataLoader()
+        if token:
+            client.login_by_token(api_token=token)
+        return client
+
+def mark_startup(stage):
+    """記錄本次執行到各階段的耗時 (ms)；每個 session 的第一次執行另存為冷啟動紀錄"""
+    timings = st.session_state.setdefault("run_timings", {})
+    timings[stage] = (time.perf_counter() - _RUN_T0) * 1000
+    if not st.session_state.get("cold_start_done"):
+        st.session_state.setdefault("cold_start_timings", {})[stage] = timings[stage]
 
 # ==============================================================================
 # 【CSS 優化】 - 針對 st.tabs 進行 TradingView 風格美化
@@ -73,14 +122,9 @@ def fetch_yf_data_cached(ticker, period=None, interval=None, start=None):
 
 @st.cache_data(ttl=3600, show_spinner=False)
 def fetch_chip_data_cached(stock_id):
-    dl_cache = DataLoader()
-    
-    # 1. 處理 Token
-    token = st.secrets.get("FINMIND_TOKEN", "")
-    if token:
-        dl_cache.token = token
-    
-    # 2. 確保代號正確 (00631L)
+    dl_cache = get_finmind_client()
+
+    # 確保代號正確 (00631L)
     clean_id = stock_id.split('.')[0].upper().strip()
     
     try:
@@ -127,109 +171,736 @@ def extract_real_url(entry):
         print("URL解析錯誤:", e)
         return entry.get("link", "")
 
-@st.cache_data(ttl=600)
-def fetch_news_data_cached(stock_code, keywords):
-
-    import requests
-    import pandas as pd
-    from datetime import datetime, timedelta
-
-    all_news = []
-
-    # =============================
-    # 🟢 1️⃣ FinMind 新聞
-    # =============================
+# ==============================================================================
+# 【本地資料庫】 - 1 分 K 歷史累積 (突破 yfinance 只保留近幾日 1m 資料的限制)
+# ==============================================================================
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+INTRADAY_DIR = os.path.join(DATA_DIR, "intraday_1m")
+OHLCV_COLS = ['Open', 'High', 'Low', 'Close', 'Volume']
+# 分析時間範圍對應的日曆天數 (用於從本地歷史切片)
+PERIOD_DAYS = {"5d": 7, "1mo": 31, "6mo": 183, "1y": 365, "2y": 730}
+
+def write_frame(df, path):
+    """以 gzip pickle 寫入本地檔 (先寫暫存檔再替換，避免讀到寫一半的檔案)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    df.to_pickle(tmp_path, compression="gzip")
+    os.replace(tmp_path, path)
+
+def read_frame(path):
+    """讀取本地 gzip pickle，不存在或損毀時回傳 None"""
+    if not os.path.exists(path):
+        return None
     try:
-        url = "https://api.finmindtrade.com/api/v4/data"
-
-        parameter = {
-            "dataset": "TaiwanStockNews",
-            "start_date": (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d'),
-            "end_date": datetime.now().strftime('%Y-%m-%d'),
-        }
-
-        if "FINMIND_TOKEN" in st.secrets:
-            parameter["token"] = st.secrets["FINMIND_TOKEN"]
+        return pd.read_pickle(path, compression="gzip")
+    except Exception as e:
+        print(f"本地檔讀取失敗 ({path}):", e)
+        return None
 
-        resp = requests.get(url, params=parameter, timeout=10)
-        data = resp.json()
+def _intraday_partition_path(ticker, day):
+    """每檔股票一個資料夾，每個交易日一個 gzip 壓縮檔 (YYYY-MM-DD.pkl.gz)"""
+    return os.path.join(INTRADAY_DIR, ticker.upper().strip(), f"{day}.pkl.gz")
+
+def _to_taipei_index(df):
+    """統一轉成台北時區，確保日期切分與合併時不會錯位"""
+    if df.index.tz is None:
+        df.index = df.index.tz_localize('UTC')
+    df.index = df.index.tz_convert('Asia/Taipei')
+    return df
+
+def collect_intraday_1m(tickers):
+    """下載每檔股票近 7 天的 1 分 K，依交易日切分後併入本地壓縮檔 (只會新增，不會刪除舊資料)"""
+    written = {}
+    for t in tickers:
+        try:
+            df = yf.download(t, period="7d", interval="1m", progress=False)
+            if df.empty:
+                continue
+            if isinstance(df.columns, pd.MultiIndex):
+                df.columns = df.columns.get_level_values(0)
+
+            df = df[[c for c in OHLCV_COLS if c in df.columns]].dropna(subset=['Close'])
+            df = _to_taipei_index(df)
+
+            count = 0
+            for day, part in df.groupby(df.index.strftime('%Y-%m-%d')):
+                path = _intraday_partition_path(t, day)
+                if os.path.exists(path):
+                    old = pd.read_pickle(path)
+                    merged = pd.concat([old, part])
+                    merged = merged[~merged.index.duplicated(keep='last')].sort_index()
+                    # 已存在且沒有新 K 棒就不重寫
+                    if len(merged) == len(old):
+                        continue
+                    part = merged
+
+                write_frame(part, path)
+                count += 1
+            written[t] = count
+        except Exception as e:
+            print(f"1分K收集失敗 ({t}):", e)
+    return written
+
+@st.cache_resource
+def _intraday_collector_state():
+    """全程序共用的收集狀態，確保每天只在背景跑一次"""
+    return {"last_day": None, "running": False, "result": {}, "lock": threading.Lock()}
+
+def schedule_intraday_collection(tickers, force=False):
+    """在背景執行緒收集今日 1 分 K，不阻塞畫面 (同一天只會執行一次，除非 force)"""
+    state = _intraday_collector_state()
+    today = datetime.now().strftime('%Y-%m-%d')
+    with state["lock"]:
+        if state["running"] or (state["last_day"] == today and not force):
+            return False
+        state["running"] = True
+
+    def _worker():
+        try:
+            state["result"] = collect_intraday_1m(list(tickers))
+            state["last_day"] = today
+            load_intraday_history.clear()
+        finally:
+            state["running"] = False
+
+    threading.Thread(target=_worker, daemon=True).start()
+    return True
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_intraday_history(ticker, start, end=None):
+    """從本地壓縮檔讀取 [start, end] 區間的 1 分 K (日期字串 YYYY-MM-DD)"""
+    folder = os.path.join(INTRADAY_DIR, ticker.upper().strip())
+    if not os.path.isdir(folder):
+        return pd.DataFrame()
 
-        if data.get("msg") == "success":
-            df = pd.DataFrame(data["data"])
+    end = end or "9999-12-31"
+    files = sorted(f for f in os.listdir(folder) if f.endswith(".pkl.gz") and start <= f[:10] <= end)
+    if not files:
+        return pd.DataFrame()
 
-            if not df.empty:
+    df = pd.concat([pd.read_pickle(os.path.join(folder, f)) for f in files])
+    return df[~df.index.duplicated(keep='last')].sort_index()
 
-                # 🎯 優先用 stock_id
-                if "stock_id" in df.columns:
-                    df_stock = df[df["stock_id"] == stock_code]
-                else:
-                    df_stock = pd.DataFrame()
+def load_intraday_extended(ticker, period):
+    """本地 1 分 K 歷史 + yfinance 最新 1 分 K，拼成超過 yfinance 滾動上限的長區間"""
+    start = (datetime.now() - timedelta(days=PERIOD_DAYS.get(period, 7))).strftime('%Y-%m-%d')
+    archived = load_intraday_history(ticker, start)
 
-                # 🔍 fallback keyword
-                if df_stock.empty:
-                    pattern = "|".join(keywords)
-                    df_stock = df[df["title"].str.contains(pattern, na=False)]
+    live = fetch_yf_data_cached(ticker, period="5d", interval="1m")
+    if not live.empty:
+        live = live.copy()
+        if isinstance(live.columns, pd.MultiIndex):
+            live.columns = live.columns.get_level_values(0)
+        live = _to_taipei_index(live[[c for c in OHLCV_COLS if c in live.columns]])
 
-                if not df_stock.empty:
-                    df_stock = df_stock.rename(columns={
-                        "date": "datetime",
-                        "title": "title",
-                        "link": "url"
-                    })
-
-                    df_stock["source"] = "FinMind"
-                    all_news.append(df_stock[["datetime", "title", "url", "source"]])
+    frames = [f for f in [archived, live] if not f.empty]
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames)
+    return df[~df.index.duplicated(keep='last')].sort_index()
 
-    except Exception as e:
-        print("FinMind error:", e)
+# ==============================================================================
+# 【本地資料庫】 - 日線價格庫 (還原權值 OHLCV，每檔一個檔案，只補抓缺少的區段)
+# ==============================================================================
+DAILY_DIR = os.path.join(DATA_DIR, "daily")
+DAILY_REFRESH_SECONDS = 3600  # 同一檔最新資料每小時最多補抓一次
+
+@st.cache_resource
+def _daily_store_state():
+    """全程序共用：記憶體中的日線表 + 最近一次補抓時間"""
+    return {"frames": {}, "checked_at": {}, "lock": threading.Lock()}
+
+def _daily_path(ticker):
+    return os.path.join(DAILY_DIR, f"{ticker.upper().strip()}.pkl.gz")
+
+def _get_daily_frame(ticker):
+    state = _daily_store_state()
+    if ticker not in state["frames"]:
+        state["frames"][ticker] = read_frame(_daily_path(ticker))
+    return state["frames"][ticker]
+
+def _download_daily(tickers, start, end=None):
+    """批次下載多檔日線 (end 不含當天)，回傳 {ticker: DataFrame}"""
+    raw = yf.download(list(tickers), start=start, end=end, interval="1d", auto_adjust=True,
+                      progress=False, group_by="ticker")
+    out = {}
+    for t in tickers:
+        try:
+            df = raw[t] if isinstance(raw.columns, pd.MultiIndex) else raw
+        except KeyError:
+            continue
+        df = df[[c for c in OHLCV_COLS if c in df.columns]].dropna(subset=['Close'])
+        if df.index.tz is not None:
+            df.index = df.index.tz_localize(None)
+        out[t] = df
+    return out
+
+def ensure_daily_history(tickers, start):
+    """確保本地日線涵蓋 start 至今：缺前段的只補前段、過期的從各自最後一根補到今天，需求相同的一起下載"""
+    state = _daily_store_state()
+    start = pd.Timestamp(start).normalize()
+    now = time.time()
+    need_head, need_tail = {}, {}  # need_head: {ticker: 補到哪一天為止 (None = 整段到今天)}
+
+    for t in tickers:
+        df = _get_daily_frame(t)
+        requested_from = df.attrs.get("requested_from") if df is not None else None
+        stale = now - state["checked_at"].get(t, 0) > DAILY_REFRESH_SECONDS
+        if df is None or requested_from is None or (df.empty and stale):
+            need_head[t] = None  # 沒有資料 (或之前抓不到，隔一段時間再整段重試)
+            continue
+        if start < pd.Timestamp(requested_from):
+            need_head[t] = pd.Timestamp(requested_from)
+        if stale and not df.empty:
+            need_tail[t] = df.index[-1]
+
+    batches = []
+    for end in set(need_head.values()):
+        batches.append(([t for t, e in need_head.items() if e == end], start, end))
+    # 依最後一根日期分批：停牌或久未更新的個股自成一批，不會拖著整批從很久以前重抓
+    for last in set(need_tail.values()):
+        batches.append(([t for t, l in need_tail.items() if l == last], last, None))
+
+    for batch, fetch_start, fetch_end in batches:
+        try:
+            fetched = _download_daily(batch, fetch_start.strftime('%Y-%m-%d'),
+                                      fetch_end.strftime('%Y-%m-%d') if fetch_end is not None else None)
+        except Exception as e:
+            print("日線下載失敗:", e)
+            continue
+        with state["lock"]:
+            for t in batch:
+                old = _get_daily_frame(t)
+                new = fetched.get(t)
+                parts = [f for f in [old, new] if f is not None and not f.empty]
+                merged = pd.concat(parts) if parts else pd.DataFrame(columns=OHLCV_COLS)
+                merged = merged[~merged.index.duplicated(keep='last')].sort_index()
+                prev_from = old.attrs.get("requested_from") if old is not None else None
+                requested_from = start if prev_from is None else min(start, pd.Timestamp(prev_from))
+                merged.attrs["requested_from"] = str(requested_from)
+                state["frames"][t] = merged
+                if fetch_end is None:
+                    state["checked_at"][t] = now
+                write_frame(merged, _daily_path(t))
+
+def load_daily_history(ticker, start):
+    """單檔日線 (還原權值)，從本地價格庫切出 start 之後的區段"""
+    ensure_daily_history([ticker], start)
+    df = _get_daily_frame(ticker)
+    if df is None:
+        return pd.DataFrame(columns=OHLCV_COLS)
+    return df[df.index >= pd.Timestamp(start)]
+
+def load_daily_panel(tickers, start, field='Close'):
+    """多檔同一欄位對齊成寬表 (index=日期, columns=代號)"""
+    ensure_daily_history(tickers, start)
+    cols = {}
+    for t in tickers:
+        df = _get_daily_frame(t)
+        if df is not None and not df.empty:
+            cols[t] = df.loc[df.index >= pd.Timestamp(start), field]
+    return pd.DataFrame(cols).sort_index()
+
+def load_price_data(ticker, period, use_intraday_archive=False):
+    """個股分析與河流圖共用的價格來源 (皆走快取，切換分頁不會重複下載)"""
+    if use_intraday_archive:
+        # 本地 1 分 K 歷史 + 最新分時資料
+        return load_intraday_extended(ticker, period)
+    f_period = "2d" if period == "1d" else period
+    f_interval = "1m" if period in ["1d", "5d"] else "1d"
+    # 【效能優化】使用快取取代 yf.download
+    return fetch_yf_data_cached(ticker, period=f_period, interval=f_interval)
 
-    # =============================
-    # 🟡 2️⃣ Google News RSS（保底一定有）
-    # =============================
-    try:
-        import feedparser
+# ==============================================================================
+# 【本地資料庫】 - FinMind 個股日資料 (外資買賣超 / 本益比)，每檔一個檔案，只補抓缺少的區段
+# ==============================================================================
+def foreign_daily_net(chip_df):
+    """FinMind 三大法人明細 -> 外資 (含外資自營) 每日淨買超股數"""
+    if chip_df is None or chip_df.empty:
+        return pd.Series(dtype=float)
+    name_col = 'institutional_investors' if 'institutional_investors' in chip_df.columns else 'name'
+    buy_col = 'buy' if 'buy' in chip_df.columns else 'buy_volume'
+    sell_col = 'sell' if 'sell' in chip_df.columns else 'sell_volume'
+    foreign = chip_df[chip_df[name_col].astype(str).str.contains('Foreign|外資|外陸資', case=False, na=False)]
+    net = (foreign[buy_col] - foreign[sell_col]).groupby(pd.to_datetime(foreign['date'])).sum()
+    return net.sort_index().astype(float)
+
+def per_pbr_frame(per_df):
+    """FinMind 本益比資料 -> index=日期，欄位 PER / PBR / dividend_yield"""
+    if per_df is None or per_df.empty:
+        return pd.DataFrame(columns=["PER", "PBR", "dividend_yield"])
+    df = per_df.rename(columns={"pe_ratio": "PER", "pb_ratio": "PBR"})
+    df.index = pd.to_datetime(df['date'])
+    return df[[c for c in ["PER", "PBR", "dividend_yield"] if c in df.columns]].astype(float).sort_index()
+
+FINMIND_STORES = {
+    "chips": {
+        "fetch": lambda dl, sid, start: dl.taiwan_stock_institutional_investors(stock_id=sid, start_date=start),
+        "parse": lambda raw: foreign_daily_net(raw).to_frame("foreign_net"),
+    },
+    "per_pbr": {
+        "fetch": lambda dl, sid, start: dl.taiwan_stock_per_pbr(stock_id=sid, start_date=start),
+        "parse": per_pbr_frame,
+    },
+}
+
+FINMIND_BACKFILL_MAX_REQUESTS = 300   # 一次補抓最多送出的請求數，其餘留到下次 (FinMind 免費額度約每小時 600 次)
+FINMIND_QUOTA_RETRY_SECONDS = 3600    # 額度用完後隔多久才再送請求
+
+@st.cache_resource
+def _finmind_store_state():
+    """全程序共用：(資料集, 股票代號) -> 記憶體中的表 + 最近一次補抓時間 + 額度 / 權限不足時的暫停期限"""
+    return {"frames": {}, "checked_at": {}, "blocked_until": 0.0, "lock": threading.Lock()}
+
+def _finmind_path(kind, stock_id):
+    return os.path.join(DATA_DIR, kind, f"{stock_id}.pkl.gz")
+
+def _get_finmind_frame(kind, stock_id):
+    state = _finmind_store_state()
+    key = (kind, stock_id)
+    if key not in state["frames"]:
+        state["frames"][key] = read_frame(_finmind_path(kind, stock_id))
+    return state["frames"][key]
+
+def _finmind_fetch_start(kind, stock_id, start, now):
+    """缺前段從 start 整段抓，過期的只抓最後一天之後；不需要補抓回傳 None"""
+    state = _finmind_store_state()
+    old = _get_finmind_frame(kind, stock_id)
+    requested_from = old.attrs.get("requested_from") if old is not None else None
+    if old is None or requested_from is None or start < pd.Timestamp(requested_from):
+        return start
+    if now - state["checked_at"].get((kind, stock_id), 0) > DAILY_REFRESH_SECONDS:
+        return old.index[-1] if not old.empty else start
+    return None
+
+def _update_finmind_history(kind, stock_id, start, fetch_start, now):
+    """單檔補抓 fetch_start 之後的資料併入本地表"""
+    state = _finmind_store_state()
+    old = _get_finmind_frame(kind, stock_id)
+    requested_from = old.attrs.get("requested_from") if old is not None else None
+    store = FINMIND_STORES[kind]
+    new = store["parse"](store["fetch"](get_finmind_client(), stock_id, fetch_start.strftime('%Y-%m-%d')))
+
+    with state["lock"]:
+        parts = [f for f in [old, new] if f is not None and not f.empty]
+        merged = pd.concat(parts) if parts else new
+        merged = merged[~merged.index.duplicated(keep='last')].sort_index()
+        prev = pd.Timestamp(requested_from) if requested_from is not None else start
+        merged.attrs["requested_from"] = str(min(start, prev))
+        state["frames"][(kind, stock_id)] = merged
+        state["checked_at"][(kind, stock_id)] = now
+        write_frame(merged, _finmind_path(kind, stock_id))
+
+def ensure_finmind_history(kind, stock_ids, start, max_workers=8, max_requests=FINMIND_BACKFILL_MAX_REQUESTS):
+    """確保多檔資料涵蓋 start 至今，缺的區段平行補抓 (單檔失敗不影響其他檔)。
+    與全市場估值庫相同的額度處理：每次最多送 max_requests 個請求，額度用完或權限不足就停止並暫停一段時間；
+    回傳這次沒補到、留待下次的檔數"""
+    state = _finmind_store_state()
+    start = pd.Timestamp(start).normalize()
+    now = time.time()
+    needed = []
+    for sid in stock_ids:
+        fetch_start = _finmind_fetch_start(kind, sid, start, now)
+        if fetch_start is not None:
+            needed.append((sid, fetch_start))
+    if not needed or now < state["blocked_until"]:
+        return len(needed)
+    batch = needed[:max_requests]
+    stop = threading.Event()
+    done = []
+
+    def _safe_update(item):
+        sid, fetch_start = item
+        if stop.is_set():
+            return
+        try:
+            _update_finmind_history(kind, sid, start, fetch_start, now)
+            done.append(sid)
+        except Exception as e:
+            error_kind = finmind_error_kind(e)
+            print(f"FinMind {kind} 下載失敗 ({sid}, {error_kind}):", e)
+            if error_kind in ("quota", "tier"):
+                # 額度用完 / 帳號等級不足：剩下的不再送出，已抓到的照常使用
+                stop.set()
+                pause = FINMIND_QUOTA_RETRY_SECONDS if error_kind == "quota" else VALUATION_TIER_RETRY_DAYS * 86400
+                state["blocked_until"] = max(state["blocked_until"], time.time() + pause)
+
+    if len(batch) == 1:
+        _safe_update(batch[0])
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_safe_update, batch))
+    return len(needed) - len(done)
+
+def load_chip_panel(stock_ids, start):
+    """多檔外資淨買超對齊成寬表 (index=日期, columns=股票代號)；attrs["pending"] 為額度限制下還沒補到的檔數"""
+    pending = ensure_finmind_history("chips", stock_ids, start)
+    cols = {}
+    for sid in stock_ids:
+        df = _get_finmind_frame("chips", sid)
+        if df is not None and not df.empty:
+            cols[sid] = df.loc[df.index >= pd.Timestamp(start), "foreign_net"]
+    panel = pd.DataFrame(cols).sort_index()
+    panel.attrs["pending"] = pending
+    return panel
+
+def load_per_pbr(stock_id, start):
+    """單檔本益比 / 股價淨值比 / 殖利率歷史 (本地優先)"""
+    ensure_finmind_history("per_pbr", [stock_id], start)
+    df = _get_finmind_frame("per_pbr", stock_id)
+    if df is None:
+        return per_pbr_frame(None)
+    return df[df.index >= pd.Timestamp(start)]
 
-        query = " OR ".join(keywords)
-        rss_url = f"https://news.google.com/rss/search?q={query}&hl=zh-TW&gl=TW&ceid=TW:zh-Hant"
 
-        feed = feedparser.parse(rss_url)
+# ==============================================================================
+# 【全市場估值庫】 - 每日整批抓全市場 PER / PBR / 殖利率，預先算好自身歷史與產業百分位
+# ==============================================================================
+MARKET_VALUATION_PATH = os.path.join(DATA_DIR, "market_valuation.pkl.gz")
+VALUATION_PERCENTILE_PATH = os.path.join(DATA_DIR, "valuation_percentiles.pkl.gz")
+MARKET_VALUATION_DAYS = 365 * 3
+# 全市場單日查詢一次一天，三年約 780 次請求：每次更新只補最新的一批，其餘留給之後幾天接著補
+VALUATION_MAX_REQUESTS = 100     # 每次更新最多送出的請求數 (FinMind 免費額度約每小時 600 次)
+VALUATION_REQUEST_INTERVAL = 0.5 # 請求間隔 (秒)，連續失敗時加倍
+VALUATION_MAX_ATTEMPTS = 3       # 同一天失敗超過這個次數就不再重試
+VALUATION_MAX_CONSECUTIVE_FAILS = 3
+VALUATION_TIER_RETRY_DAYS = 7    # 帳號等級不足以查全市場時，隔幾天才再試
+VALUATION_FIELDS = ["PER", "PBR", "dividend_yield"]
+RIVER_PERCENTILES = [10, 25, 50, 75, 90]
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def load_stock_info():
+    """上市櫃股票基本資料 (代號 / 名稱 / 產業 / 市場別)，一天更新一次"""
+    df = get_finmind_client().taiwan_stock_info()
+    df['stock_id'] = df['stock_id'].astype(str)
+    return df
+
+def compute_valuation_percentiles(market, info):
+    """每檔最新的 PER / PBR / 殖利率，以及在自身歷史與同產業中的百分位 (0~1，越低代表越便宜的 PER/PBR)"""
+    table = {}
+    for field in VALUATION_FIELDS:
+        wide = market.pivot(index='date', columns='stock_id', values=field).sort_index()
+        if field != "dividend_yield":
+            wide = wide.where(wide > 0)  # 虧損股 PER 為 0，不列入
+        latest = wide.ffill().iloc[-1]
+        valid = wide.notna()
+        table[field] = latest
+        table[f"{field}_hist_pct"] = (wide.lt(latest, axis=1) & valid).sum() / valid.sum().replace(0, np.nan)
+    table = pd.DataFrame(table)
+    industry = info.drop_duplicates('stock_id').set_index('stock_id')['industry_category']
+    table['industry'] = industry.reindex(table.index)
+    for field in VALUATION_FIELDS:
+        table[f"{field}_industry_pct"] = table.groupby('industry')[field].rank(pct=True)
+    table.attrs["as_of"] = str(market['date'].max().date())
+    return table
+
+def finmind_error_kind(error):
+    """依 FinMind 的錯誤訊息分類：tier (會員等級不足) / quota (請求次數達上限) / other"""
+    msg = str(error).lower()
+    if "level" in msg or "sponsor" in msg or "backer" in msg:
+        return "tier"
+    if "upper limit" in msg or "too many requests" in msg:
+        return "quota"
+    return "other"
+
+def update_market_valuation(days=MARKET_VALUATION_DAYS, max_requests=VALUATION_MAX_REQUESTS):
+    """由新到舊補抓還沒抓過的交易日 (一次一天、整個市場，依序送出並限制次數)，完成後重算百分位表。
+    抓取紀錄存在檔案 attrs：fetched_dates 已抓 (含休市的空日)、failed_dates 各日失敗次數、
+    tier_blocked_at 帳號權限不足的日期 (期間內不再嘗試，估值篩選與產業百分位先不顯示，河流圖仍用單檔資料)"""
+    old = read_frame(MARKET_VALUATION_PATH)
+    attrs = old.attrs if old is not None else {}
+    today = pd.Timestamp.now().normalize()
+    blocked = attrs.get("tier_blocked_at")
+    if blocked and today - pd.Timestamp(blocked) < pd.Timedelta(days=VALUATION_TIER_RETRY_DAYS):
+        return None
 
-        rows = []
-        for entry in feed.entries[:20]:
-            rows.append({
-                "datetime": entry.get("published", ""),
-                "title": entry.get("title", ""),
-                "url": extract_real_url(entry),
-                "source": "Google News"
-            })
+    fetched = set(attrs.get("fetched_dates", []))
+    failed = dict(attrs.get("failed_dates", {}))
+    wanted = [d.strftime('%Y-%m-%d') for d in pd.bdate_range(today - pd.Timedelta(days=days), today)]
+    missing = [d for d in reversed(wanted) if d not in fetched and failed.get(d, 0) < VALUATION_MAX_ATTEMPTS]
+    dl = get_finmind_client()
+
+    parts = [old] if old is not None else []
+    blocked, fails = None, 0
+    for i, day in enumerate(missing[:max_requests]):
+        if i:
+            time.sleep(VALUATION_REQUEST_INTERVAL * 2 ** fails)
+        try:
+            raw = dl.taiwan_stock_per_pbr(stock_id="", start_date=day, end_date=day)
+        except Exception as e:
+            kind = finmind_error_kind(e)
+            print(f"全市場估值下載失敗 ({day}, {kind}):", e)
+            if kind == "tier":
+                blocked = today.strftime('%Y-%m-%d')
+                break
+            if kind == "quota":
+                break  # 額度用完：已抓到的先存檔，下次更新接著補
+            failed[day] = failed.get(day, 0) + 1
+            fails += 1
+            if fails >= VALUATION_MAX_CONSECUTIVE_FAILS:
+                break
+            continue
+        fails = 0
+        failed.pop(day, None)
+        if raw is not None and not raw.empty:
+            raw = raw.rename(columns={"pe_ratio": "PER", "pb_ratio": "PBR"})
+            df = pd.DataFrame({"date": pd.to_datetime(raw['date']), "stock_id": raw['stock_id'].astype(str)})
+            for field in VALUATION_FIELDS:
+                df[field] = pd.to_numeric(raw[field], errors='coerce').astype(np.float32) if field in raw else np.float32(np.nan)
+            parts.append(df)
+            fetched.add(day)
+        elif day != wanted[-1]:
+            # 休市日回傳空表也記為已抓；今天的資料收盤後才有，空的話明天再試
+            fetched.add(day)
+
+    columns = ["date", "stock_id"] + VALUATION_FIELDS
+    market = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns)
+    market = market.drop_duplicates(['date', 'stock_id'], keep='last')
+    market = market[market['date'] >= pd.Timestamp(wanted[0])].reset_index(drop=True)
+    market.attrs["fetched_dates"] = sorted(d for d in fetched if d >= wanted[0])
+    market.attrs["failed_dates"] = {d: n for d, n in failed.items() if d >= wanted[0]}
+    if blocked:
+        market.attrs["tier_blocked_at"] = blocked
+    write_frame(market, MARKET_VALUATION_PATH)
+    if market.empty:
+        return None
+    if len(parts) == (old is not None) and os.path.exists(VALUATION_PERCENTILE_PATH):
+        return None  # 沒有新資料時沿用既有的百分位表
+    percentiles = compute_valuation_percentiles(market, load_stock_info())
+    write_frame(percentiles, VALUATION_PERCENTILE_PATH)
+    return percentiles
+
+@st.cache_resource
+def _market_valuation_state():
+    """全程序共用：每日更新只跑一次 + 百分位表的記憶體快取"""
+    return {"last_day": None, "running": False, "table": None, "mtime": None, "lock": threading.Lock()}
+
+def schedule_market_valuation_update(force=False):
+    """在背景執行緒更新全市場估值庫 (同一天只會執行一次，除非 force)"""
+    state = _market_valuation_state()
+    today = datetime.now().strftime('%Y-%m-%d')
+    with state["lock"]:
+        if state["running"] or (state["last_day"] == today and not force):
+            return False
+        state["running"] = True
+
+    def _worker():
+        try:
+            update_market_valuation()
+            state["last_day"] = today
+        except Exception as e:
+            print("全市場估值更新失敗:", e)
+        finally:
+            state["running"] = False
 
-        df_google = pd.DataFrame(rows)
+    threading.Thread(target=_worker, daemon=True).start()
+    return True
 
-        if not df_google.empty:
-            all_news.append(df_google)
+def load_valuation_percentiles():
+    """讀取預先算好的百分位表 (檔案更新後才重新讀取)；尚未建立時回傳 None"""
+    state = _market_valuation_state()
+    if not os.path.exists(VALUATION_PERCENTILE_PATH):
+        return None
+    mtime = os.path.getmtime(VALUATION_PERCENTILE_PATH)
+    if state["mtime"] != mtime:
+        state["table"], state["mtime"] = read_frame(VALUATION_PERCENTILE_PATH), mtime
+    return state["table"]
 
+# ==============================================================================
+# 【本地資料庫】 - 全市場新聞 (FinMind 每個間隔整批抓一次，依 stock_id 建索引，個股查詢只查記憶體)
+# ==============================================================================
+MARKET_NEWS_PATH = os.path.join(DATA_DIR, "market_news.pkl.gz")
+MARKET_NEWS_DAYS = 7
+MARKET_NEWS_REFRESH_SECONDS = 600
+NEWS_COLS = ["datetime", "title", "url", "source"]
+
+@st.cache_resource
+def _market_news_state():
+    """全程序共用：新聞表 (最新優先) + stock_id -> 列位置索引 + 最近一次抓取時間"""
+    return {"frame": None, "by_stock": {}, "fetched_at": 0.0, "lock": threading.Lock()}
+
+def fetch_finmind_market_news(start_date, end_date, timeout=10):
+    """FinMind TaiwanStockNews (不指定 stock_id = 全市場)，欄位整理成 stock_id + NEWS_COLS"""
+    parameter = {"dataset": "TaiwanStockNews", "start_date": start_date, "end_date": end_date}
+    if "FINMIND_TOKEN" in st.secrets:
+        parameter["token"] = st.secrets["FINMIND_TOKEN"]
+    data = requests.get("https://api.finmindtrade.com/api/v4/data", params=parameter, timeout=timeout).json()
+    if data.get("msg") != "success":
+        raise RuntimeError(data.get("msg"))
+    raw = pd.DataFrame(data["data"])
+    if raw.empty:
+        return pd.DataFrame(columns=["stock_id"] + NEWS_COLS)
+    return pd.DataFrame({
+        "stock_id": raw["stock_id"].astype(str) if "stock_id" in raw else "",
+        "datetime": pd.to_datetime(raw["date"], errors="coerce"),
+        "title": raw["title"],
+        "url": raw["link"] if "link" in raw else "",
+        "source": "FinMind",
+    })
+
+def _index_market_news(state, frame):
+    """排序並建立索引後一次換上 (呼叫端需持有 lock)"""
+    frame = frame.sort_values("datetime", ascending=False).reset_index(drop=True)
+    state["frame"], state["by_stock"] = frame, frame.groupby("stock_id", sort=False).indices
+
+def ensure_market_news():
+    """新聞庫每個間隔最多更新一次：只抓最新一筆的日期起 (含當天) 的新聞併入，保留近 7 天。
+    lock 只用來讀取狀態、認領這次更新與換上新表，網路請求在 lock 外進行，其他分頁照常查詢舊表"""
+    state = _market_news_state()
+    with state["lock"]:
+        if state["frame"] is None:
+            stored = read_frame(MARKET_NEWS_PATH)
+            if stored is not None:
+                _index_market_news(state, stored)
+                state["fetched_at"] = stored.attrs.get("fetched_at", 0.0)
+        now = time.time()
+        if now - state["fetched_at"] < MARKET_NEWS_REFRESH_SECONDS:
+            return state
+        # 認領這次更新 (失敗也等到下一個間隔再試)，同時間其他分頁會直接沿用舊表
+        state["fetched_at"] = now
+        old = state["frame"]
+
+    today = pd.Timestamp.now().normalize()
+    keep_from = today - pd.Timedelta(days=MARKET_NEWS_DAYS)
+    start = keep_from if old is None or old.empty else max(keep_from, old["datetime"].max().normalize())
+    try:
+        fresh = fetch_finmind_market_news(start.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d'))
     except Exception as e:
-        print("Google News error:", e)
-
-    # =============================
-    # 🔥 合併
-    # =============================
-    if all_news:
-        df_all = pd.concat(all_news, ignore_index=True)
-
-        # 去重
-        df_all = df_all.drop_duplicates(subset=["title"])
-
-        # 排序（最新優先）
-        df_all["datetime"] = pd.to_datetime(df_all["datetime"], errors="coerce")
-        df_all = df_all.sort_values(by="datetime", ascending=False)
+        print("FinMind 新聞下載失敗:", e)
+        return state
+
+    with state["lock"]:
+        parts = [f for f in [state["frame"], fresh] if f is not None and not f.empty]
+        if not parts:
+            return state
+        merged = pd.concat(parts).drop_duplicates(["stock_id", "title"], keep="last")
+        merged = merged[merged["datetime"] >= keep_from]
+        _index_market_news(state, merged)
+        state["frame"].attrs["fetched_at"] = now
+        frame = state["frame"]
+    write_frame(frame, MARKET_NEWS_PATH)
+    return state
+
+def lookup_stock_news(stock_code, keywords):
+    """從新聞庫取出個股新聞：先查 stock_id 索引，沒有的話用標題關鍵字比對"""
+    state = ensure_market_news()
+    with state["lock"]:
+        frame, by_stock = state["frame"], state["by_stock"]  # 同一版的表與索引
+    if frame is None or frame.empty:
+        return pd.DataFrame(columns=NEWS_COLS)
+    rows = by_stock.get(stock_code)
+    if rows is not None:
+        return frame.iloc[rows][NEWS_COLS]
+    pattern = "|".join(re.escape(k) for k in keywords)
+    return frame.loc[frame["title"].str.contains(pattern, na=False), NEWS_COLS]
 
-        return df_all
-
-    return pd.DataFrame()
-
-# 初始化 DataLoader (用於其他未快取的輕量操作)
-dl = DataLoader()
+# ==============================================================================
+# 【新聞來源】 - 各來源並行抓取、各自有截止時間；來不及的結果保留到下次重新整理再顯示
+# ==============================================================================
+NEWS_RESULT_TTL = 600  # 各來源結果保留 10 分鐘，過期後背景重抓 (重抓完成前先顯示舊的)
+NEWS_RETRY_SECONDS = 60  # 來源失敗後隔多久再重試 (期間沿用上一次的結果)
+NEWS_MAX_WORKERS = 8
+
+def fetch_rss_news(url, params, source, limit=20, timeout=8):
+    """通用 RSS：查詢參數交給 requests 編碼並設逾時，下載後再交給 feedparser 解析 (時間轉台北時間)"""
+    import feedparser
+
+    resp = requests.get(url, params=params, timeout=timeout)
+    resp.raise_for_status()
+    feed = feedparser.parse(resp.content)
+
+    rows = []
+    for entry in feed.entries[:limit]:
+        rows.append({
+            "datetime": entry.get("published", ""),
+            "title": entry.get("title", ""),
+            "url": extract_real_url(entry),
+            "source": source
+        })
+    df = pd.DataFrame(rows, columns=NEWS_COLS)
+    df["datetime"] = pd.to_datetime(df["datetime"], errors="coerce", utc=True).dt.tz_convert("Asia/Taipei").dt.tz_localize(None)
+    return df
+
+def fetch_google_news(stock_code, keywords):
+    """Google News RSS 關鍵字搜尋"""
+    return fetch_rss_news("https://news.google.com/rss/search",
+                          {"q": " OR ".join(keywords), "hl": "zh-TW", "gl": "TW", "ceid": "TW:zh-Hant"},
+                          "Google News")
+
+# 新聞來源登記表：名稱 -> (抓取函式 (stock_code, keywords) -> DataFrame[NEWS_COLS], 截止秒數)
+# 新增來源 (例如其他 RSS) 只要在這裡加一行，不會拉長其他來源的等待時間
+NEWS_SOURCES = {
+    "FinMind": (lookup_stock_news, 3.0),
+    "Google News": (fetch_google_news, 3.0),
+}
+
+@st.cache_resource
+def _news_fetch_state():
+    """全程序共用：抓新聞的執行緒池 + 進行中的請求 + 各來源最近一次結果 (key = (來源, 代號, 關鍵字))"""
+    return {"executor": concurrent.futures.ThreadPoolExecutor(max_workers=NEWS_MAX_WORKERS),
+            "pending": {}, "results": {}, "lock": threading.RLock()}
+
+def _submit_news_fetch(state, key, fetch, stock_code, keywords):
+    """送出一個來源的查詢；完成時 (即使呼叫端早已逾時放棄等待) 把結果存起來給下次使用"""
+    future = state["executor"].submit(fetch, stock_code, list(keywords))
+    state["pending"][key] = future
+
+    def _store(f):
+        with state["lock"]:
+            if state["pending"].get(key) is f:
+                state["pending"].pop(key)
+            try:
+                state["results"][key] = (time.time(), f.result())
+            except Exception as e:
+                print(f"新聞來源 {key[0]} 失敗:", e)
+                previous = state["results"].get(key)
+                rows = previous[1] if previous is not None else pd.DataFrame(columns=NEWS_COLS)
+                state["results"][key] = (time.time() - NEWS_RESULT_TTL + NEWS_RETRY_SECONDS, rows)
+
+    future.add_done_callback(_store)
+    return future
+
+def gather_news(stock_code, keywords):
+    """所有來源並行查詢、各自最多等到自己的截止時間；回傳 (合併後新聞 (最新優先), 尚未回應的來源)"""
+    state = _news_fetch_state()
+    keywords = tuple(keywords)
+    started, now = time.monotonic(), time.time()
+    waiting = {}
+    with state["lock"]:
+        state["results"] = {k: v for k, v in state["results"].items() if now - v[0] < NEWS_RESULT_TTL * 6}
+        for name, (fetch, deadline) in NEWS_SOURCES.items():
+            key = (name, stock_code, keywords)
+            cached = state["results"].get(key)
+            if cached is not None and now - cached[0] < NEWS_RESULT_TTL:
+                continue
+            future = state["pending"].get(key)
+            if future is None or future.done():
+                future = _submit_news_fetch(state, key, fetch, stock_code, keywords)
+            waiting[name] = (future, deadline)
+        cached = {name: state["results"].get((name, stock_code, keywords)) for name in NEWS_SOURCES}
+
+    all_news, late = [], []
+    for name in NEWS_SOURCES:
+        if name in waiting:
+            future, deadline = waiting[name]
+            try:
+                all_news.append(future.result(timeout=max(0.0, deadline - (time.monotonic() - started))))
+                continue
+            except concurrent.futures.TimeoutError:
+                late.append(name)
+            except Exception:
+                pass  # 錯誤已在 _store 記錄，沿用上一次的結果
+        if cached[name] is not None:
+            all_news.append(cached[name][1])
+
+    all_news = [df for df in all_news if df is not None and not df.empty]
+    if not all_news:
+        return pd.DataFrame(columns=NEWS_COLS), late
+
+    # 合併、去重、最新優先
+    df_all = pd.concat(all_news, ignore_index=True).drop_duplicates(subset=["title"])
+    df_all["datetime"] = pd.to_datetime(df_all["datetime"], errors="coerce")
+    return df_all.sort_values(by="datetime", ascending=False), late
 
 # ==========================================
 # 1. 強化版股票池讀取 (解決之前的 302 錯誤)
@@ -249,7 +920,41 @@ def load_stock_pool():
         return ["2330", "2317", "2454", "2603", "2609", "2303", "2382", "3037"]
 
 # ==========================================
-# 2. 法人籌碼與技術面掃描邏輯
+# 2. AI 評分規則 (即時掃描與歷史驗證共用同一組門檻)
+# ==========================================
+SCREEN_MA_WINDOW = 20          # 站上 MA20
+SCREEN_VOLUME_WINDOW = 20      # 量比 = 今日量 / 20 日均量
+SCREEN_VOLUME_RATIO = 1.2
+SCREEN_FOREIGN_WINDOW = 5      # 外資最近 5 日買超天數
+SCREEN_FOREIGN_MIN_DAYS = 3
+SCREEN_POINTS = {"above_ma": 40, "foreign_days": 40, "today_buy": 20, "volume": 20}
+SCREEN_SUGGESTIONS = [(80, "🔥 強勢關注"), (60, "✅ 可觀察布局"), (40, "⚠️ 中性觀察"), (0, "❌ 偏弱")]
+
+def screen_score(current_price, ma20, foreign_buy_days, today_buy, volume_ratio):
+    """單檔評分，回傳 (0~100 分, 評分原因)"""
+    score, reasons = 0, []
+    if current_price > ma20:
+        score += SCREEN_POINTS["above_ma"]
+        reasons.append("站上MA20")
+    if foreign_buy_days >= SCREEN_FOREIGN_MIN_DAYS:
+        score += SCREEN_POINTS["foreign_days"]
+        reasons.append(f"外資5日買超{foreign_buy_days}天")
+    if today_buy:
+        score += SCREEN_POINTS["today_buy"]
+        reasons.append("今日外資買超")
+    if volume_ratio >= SCREEN_VOLUME_RATIO:
+        score += SCREEN_POINTS["volume"]
+        reasons.append(f"量比放大({volume_ratio:.2f})")
+    return min(score, 100), reasons
+
+def screen_suggestion(score):
+    for threshold, label in SCREEN_SUGGESTIONS:
+        if score >= threshold:
+            return label
+    return SCREEN_SUGGESTIONS[-1][1]
+
+# ==========================================
+# 3. 法人籌碼與技術面掃描邏輯
 # ==========================================
 def fetch_stock_analysis_with_debug(stock_id, df_info):
 
@@ -292,7 +997,7 @@ def fetch_stock_analysis_with_debug(stock_id, df_info):
                 ticker,
                 period="3mo",
                 progress=False,
-                auto_adjust=False
+                auto_adjust=True  # 與歷史驗證共用的本地日線一致 (還原權值)
             )
 
             # --------------------------------
@@ -306,7 +1011,7 @@ def fetch_stock_analysis_with_debug(stock_id, df_info):
                     ticker,
                     period="3mo",
                     progress=False,
-                    auto_adjust=False
+                    auto_adjust=True
                 )
 
             debug_logs.append(
@@ -358,7 +1063,7 @@ def fetch_stock_analysis_with_debug(stock_id, df_info):
                         )
 
                         ma20 = float(
-                            close_series.tail(20).mean()
+                            close_series.tail(SCREEN_MA_WINDOW).mean()
                         )
 
                 # --------------------------------
@@ -371,14 +1076,14 @@ def fetch_stock_analysis_with_debug(stock_id, df_info):
                         errors='coerce'
                     ).dropna()
 
-                    if len(volume_series) >= 20:
+                    if len(volume_series) >= SCREEN_VOLUME_WINDOW:
 
                         today_volume = float(
                             volume_series.iloc[-1]
                         )
 
                         avg_volume_20 = float(
-                            volume_series.tail(20).mean()
+                            volume_series.tail(SCREEN_VOLUME_WINDOW).mean()
                         )
 
                         if avg_volume_20 > 0:
@@ -420,7 +1125,7 @@ def fetch_stock_analysis_with_debug(stock_id, df_info):
                 datetime.now() - timedelta(days=30)
             ).strftime('%Y-%m-%d')
 
-            chip_df = dl.taiwan_stock_institutional_investors(
+            chip_df = get_finmind_client().taiwan_stock_institutional_investors(
                 stock_id=sid,
                 start_date=start_date
             )
@@ -503,23 +1208,23 @@ def fetch_stock_analysis_with_debug(stock_id, df_info):
                             - foreign_df[sell_col]
                         )
 
-                        foreign_df = foreign_df.sort_values(
-                            'date',
-                            ascending=False
-                        )
+                        # 同一天可能有多列外資 (外資 / 外資自營)，先按日加總
+                        daily_net = foreign_df.groupby(
+                            'date'
+                        )['net_buy'].sum().sort_index(ascending=False)
 
                         # 最近5日
-                        recent_5 = foreign_df.head(5)
+                        recent_5 = daily_net.head(SCREEN_FOREIGN_WINDOW)
 
                         foreign_buy_days = int(
-                            (recent_5['net_buy'] > 0).sum()
+                            (recent_5 > 0).sum()
                         )
 
                         # 今日是否買超
-                        if len(foreign_df) > 0:
+                        if len(daily_net) > 0:
 
-                            today_buy = (
-                                foreign_df.iloc[0]['net_buy'] > 0
+                            today_buy = bool(
+                                daily_net.iloc[0] > 0
                             )
 
                         debug_logs.append(
@@ -545,71 +1250,14 @@ def fetch_stock_analysis_with_debug(stock_id, df_info):
         # =========================
         # AI 評分系統
         # =========================
-        score = 0
-
-        score_reason = []
-
-        # --------------------------------
-        # 技術面
-        # --------------------------------
-        if current_price > ma20:
-
-            score += 40
-
-            score_reason.append("站上MA20")
-
-        # --------------------------------
-        # 外資
-        # --------------------------------
-        if foreign_buy_days >= 3:
-
-            score += 40
-
-            score_reason.append(
-                f"外資5日買超{foreign_buy_days}天"
-            )
-
-        # --------------------------------
-        # 今日外資
-        # --------------------------------
-        if today_buy:
-
-            score += 20
-
-            score_reason.append("今日外資買超")
-
-        # --------------------------------
-        # 量能
-        # --------------------------------
-        if volume_ratio >= 1.2:
-
-            score += 20
-
-            score_reason.append(
-                f"量比放大({volume_ratio:.2f})"
-            )
-
-        # 最高 100
-        score = min(score, 100)
+        score, score_reason = screen_score(
+            current_price, ma20, foreign_buy_days, today_buy, volume_ratio
+        )
 
         # =========================
         # 投資建議
         # =========================
-        if score >= 80:
-
-            suggestion = "🔥 強勢關注"
-
-        elif score >= 60:
-
-            suggestion = "✅ 可觀察布局"
-
-        elif score >= 40:
-
-            suggestion = "⚠️ 中性觀察"
-
-        else:
-
-            suggestion = "❌ 偏弱"
+        suggestion = screen_suggestion(score)
 
         # =========================
         # 回傳
@@ -704,36 +1352,505 @@ def analyze_chip_trend(df_chip):
         # 這裡會捕捉到到底是哪裡出錯
         st.error(f"分析邏輯出錯: {e}")
         return {}
+
+# ==========================================
+# 4. 評分規則歷史驗證 (walk-forward：每天只用當天以前的資料重算分數，整個市場一次算)
+# ==========================================
+FORWARD_HORIZONS = (5, 20, 60)
+
+def load_screen_universe(scan_target, df_info):
+    """掃描範圍 -> 股票代號清單 (即時掃描與歷史驗證共用)"""
+    if scan_target == "我的股票池 (Sheets)":
+        full_list = []
+        for s in load_stock_pool():
+            try:
+                full_list.append(str(int(float(s))))
+            except: continue
+        return full_list
+    # 排除權證，只留普通股
+    return df_info[df_info['type'] == 'stock']['stock_id'].tolist()
+
+def screen_yf_ticker(stock_id, df_info):
+    """上櫃 (tpex) 用 .TWO，其餘用 .TW"""
+    row = df_info[df_info['stock_id'] == stock_id]
+    return f"{stock_id}.TWO" if not row.empty and row.iloc[0].get('type') == 'tpex' else f"{stock_id}.TW"
+
+def replay_screen_scores(close, volume, foreign_net):
+    """close / volume / foreign_net 為對齊的 (日期 × 股票) 寬表，回傳同形狀的每日分數 (資料不足為 NaN)"""
+    ma = close.rolling(SCREEN_MA_WINDOW).mean()
+    volume_ratio = volume / volume.rolling(SCREEN_VOLUME_WINDOW).mean()
+    buy = foreign_net.reindex(index=close.index, columns=close.columns) > 0
+    buy_days = buy.astype(float).rolling(SCREEN_FOREIGN_WINDOW, min_periods=1).sum()
+
+    score = (SCREEN_POINTS["above_ma"] * (close > ma)
+             + SCREEN_POINTS["foreign_days"] * (buy_days >= SCREEN_FOREIGN_MIN_DAYS)
+             + SCREEN_POINTS["today_buy"] * buy
+             + SCREEN_POINTS["volume"] * (volume_ratio >= SCREEN_VOLUME_RATIO))
+    return score.clip(upper=100).where(ma.notna() & volume_ratio.notna())
+
+def score_bucket_report(score, close, horizons=FORWARD_HORIZONS):
+    """依投資建議分組統計未來 N 日報酬。籌碼收盤後才公布，所以以次一交易日收盤進場"""
+    entry = close.shift(-1).to_numpy()
+    s = score.to_numpy().ravel()
+    bucket = np.full(s.shape, -1)
+    for i, (threshold, _) in reversed(list(enumerate(SCREEN_SUGGESTIONS))):
+        bucket[s >= threshold] = i
+
+    rows = {label: {"樣本數": int((bucket == i).sum())} for i, (_, label) in enumerate(SCREEN_SUGGESTIONS)}
+    rows["全部 (基準)"] = {"樣本數": int((bucket >= 0).sum())}
+    for h in horizons:
+        fwd = (close.shift(-1 - h).to_numpy() / entry - 1).ravel()
+        valid = np.isfinite(fwd) & (bucket >= 0)
+        for i, (_, label) in enumerate(SCREEN_SUGGESTIONS):
+            sel = valid & (bucket == i)
+            rows[label][f"{h}日平均報酬"] = fwd[sel].mean() if sel.any() else np.nan
+            rows[label][f"{h}日勝率"] = (fwd[sel] > 0).mean() if sel.any() else np.nan
+        rows["全部 (基準)"][f"{h}日平均報酬"] = fwd[valid].mean() if valid.any() else np.nan
+        rows["全部 (基準)"][f"{h}日勝率"] = (fwd[valid] > 0).mean() if valid.any() else np.nan
+    return pd.DataFrame.from_dict(rows, orient='index')
 # ==============================================================================
 # 第一部分：【雲端基礎設施】 - 處理 Google Sheets 連線與資料存取
 # ==============================================================================
 SCRIPT_URL = st.secrets["GOOGLE_SCRIPT_URL"]
 
 def load_db_from_sheets():
-    """透過 Apps Script 網址讀取 JSON 格式的整包雲端數據 (庫存+帳務+密碼)"""
+    """透過 Apps Script 網址讀取雲端備份的整包數據 (庫存+帳務+密碼)；失敗回傳 None"""
     try:
         response = requests.get(SCRIPT_URL, timeout=10)
         if response.status_code == 200:
-            return response.json()
+            db = response.json()
+            if db.get("status") == "error":
+                # 伺服器端無法提供帳戶 (例如尚未從舊儲存搬移)，視同讀取失敗，不可拿空帳戶頂替
+                st.error(f"雲端讀取失敗: {db.get('message')}")
+                return None
+            # 記下最後一次與雲端一致的內容，之後存檔只送出差異
+            write_synced_db(db)
+            return db
     except Exception as e:
         st.error(f"雲端讀取失敗，請檢查 Apps Script 網址: {e}")
-    return {"password_hash": None, "list": {}, "costs": {}}
-
-def save_db_to_sheets(db):
-    """將目前的 session_state 數據發送到雲端 Apps Script 進行儲存"""
-    try:
+    return None
+
+# ------------------------------------------------------------------------------
+# 差異同步協定：雲端文件帶 "_version"，存檔時送出
+#   {"op": "patch", "base_version": v, "ops": [...]}
+# ops 為 set / del (字典鍵)、append (帳本清單只追加新的一筆) 與 upsert
+# (帳本產生的已實現損益列以 tx_id 為鍵原位更新，補登交易只送出受影響的那幾列)。
+# 伺服器回傳 {"status": "ok", "version": v+1}，或版本不符時
+# {"status": "conflict", "version": 目前版本, "db": 目前文件}，客戶端據此重新套用後再送一次。
+# 雲端文件沒有 "_version" (舊版 Apps Script) 時退回整包 POST。
+# 伺服器端實作見 apps_script/Code.gs (含 testPatchConflict 驗證版本衝突流程)。
+# ------------------------------------------------------------------------------
+APPEND_ONLY_KEYS = ("realized_pnl", "transactions")
+KEYED_ROW_KEYS = {"realized_pnl": "tx_id"}   # 清單欄位 -> 可原位更新的列所帶的鍵
+
+def _keyed_list_ops(key, old, new):
+    """舊列都還在原位 (或同鍵的列被改寫)、新列接在最後時，回傳 upsert + append；否則回傳 None"""
+    row_key = KEYED_ROW_KEYS.get(key)
+    if len(new) < len(old):
+        return None
+    changed = []
+    for before, after in zip(old, new):
+        if before == after:
+            continue
+        if row_key is None or not isinstance(before, dict) or not isinstance(after, dict) \
+                or before.get(row_key) is None or before.get(row_key) != after.get(row_key):
+            return None
+        changed.append(after)
+    ops = []
+    if changed:
+        ops.append({"op": "upsert", "path": [key], "key": row_key, "values": changed})
+    if len(new) > len(old):
+        ops.append({"op": "append", "path": [key], "values": new[len(old):]})
+    return ops
+
+def _upsert_rows(rows, row_key, values):
+    """以 row_key 找到同鍵的列原位替換，找不到的接在最後"""
+    for value in values:
+        for i, row in enumerate(rows):
+            if isinstance(row, dict) and row.get(row_key) == value.get(row_key):
+                rows[i] = value
+                break
+        else:
+            rows.append(value)
+
+def diff_db(base, current):
+    """比對上次同步的內容與目前內容，產生最小的 patch 操作清單"""
+    ops = []
+    for key in sorted(set(base) | set(current)):
+        if key == "_version":
+            continue
+        if key not in current:
+            ops.append({"op": "del", "path": [key]})
+            continue
+        old, new = base.get(key), current[key]
+        if old == new:
+            continue
+        list_ops = None
+        if key in APPEND_ONLY_KEYS and isinstance(old, list) and isinstance(new, list):
+            list_ops = _keyed_list_ops(key, old, new)
+        if isinstance(old, dict) and isinstance(new, dict):
+            for sub in sorted(set(old) | set(new)):
+                if sub not in new:
+                    ops.append({"op": "del", "path": [key, sub]})
+                elif old.get(sub) != new[sub]:
+                    ops.append({"op": "set", "path": [key, sub], "value": new[sub]})
+        elif list_ops is not None:
+            ops.extend(list_ops)
+        else:
+            ops.append({"op": "set", "path": [key], "value": new})
+    return ops
+
+def apply_db_patch(db, ops):
+    """在文件副本上套用 patch (與 Apps Script 端相同的規則)，衝突重送時用來重新合併"""
+    db = json.loads(json.dumps(db))
+    for op in ops:
+        *parents, leaf = op["path"]
+        target = db
+        for key in parents:
+            target = target.setdefault(key, {})
+        if op["op"] == "set":
+            target[leaf] = op["value"]
+        elif op["op"] == "del":
+            target.pop(leaf, None)
+        elif op["op"] == "append":
+            target.setdefault(leaf, []).extend(op["values"])
+        elif op["op"] == "upsert":
+            _upsert_rows(target.setdefault(leaf, []), op["key"], op["values"])
+    return db
+
+def push_db_to_sheets(db, base):
+    """送出 db 相對上次同步內容 base 的差異 (版本衝突時以雲端最新內容重新套用一次)；
+    回傳 (是否成功, 雲端目前內容, 錯誤訊息)。不使用 session_state，可在背景執行緒呼叫"""
+    if base is None:
+        # 本機從未成功讀過雲端：內容可能只是預設的空帳戶，整包上傳會蓋掉雲端資料
+        return False, None, "本機帳戶未曾自雲端載入，暫不上傳"
+    if base.get("_version") is None:
         response = requests.post(SCRIPT_URL, json=db, timeout=15)
         if "Success" in response.text:
-            return True
-        else:
-            st.error(f"存檔回傳異常: {response.text}")
+            return True, db, None
+        return False, None, f"存檔回傳異常: {response.text}"
+
+    ops = diff_db(base, db)
+    if not ops:
+        return True, dict(db, _version=base["_version"]), None
+    for _ in range(2):
+        payload = {"op": "patch", "base_version": base["_version"], "ops": ops}
+        result = requests.post(SCRIPT_URL, json=payload, timeout=15).json()
+        if result.get("status") == "ok":
+            return True, dict(db, _version=result["version"]), None
+        if result.get("status") != "conflict":
+            return False, None, f"存檔回傳異常: {result}"
+        # 其他裝置已先存檔：以雲端最新內容為底重新套用本次的變更
+        base = dict(result["db"], _version=result["version"])
+        db = apply_db_patch(base, ops)
+    return False, None, "雲端資料持續被其他裝置更新，稍後重試"
+
+# ==============================================================================
+# 【本地寫入佇列】 - 每個帳戶只保留最新一份待同步內容 (連續存檔自動合併)，背景重試
+# ==============================================================================
+LOCAL_STORE_PATH = os.path.join(DATA_DIR, "local_store.db")
+SYNC_COALESCE_SECONDS = 2      # 喚醒後稍等，讓連續幾次存檔合併成一次上傳
+SYNC_POLL_SECONDS = 30
+SYNC_RETRY_MAX_SECONDS = 300
+
+def _account_key():
+    """以 Apps Script 網址區分帳戶，避免不同部署共用同一份本地佇列"""
+    return hashlib.sha256(SCRIPT_URL.encode()).hexdigest()[:16]
+
+def open_local_store():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(LOCAL_STORE_PATH, timeout=10)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS sync_outbox (
+            account TEXT PRIMARY KEY, doc TEXT NOT NULL, updated REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0, next_try REAL NOT NULL DEFAULT 0, last_error TEXT);
+        CREATE TABLE IF NOT EXISTS sync_snapshot (account TEXT PRIMARY KEY, doc TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS account_meta (account TEXT, key TEXT, value TEXT, PRIMARY KEY (account, key));
+        CREATE TABLE IF NOT EXISTS watchlist (account TEXT, ticker TEXT, value TEXT, PRIMARY KEY (account, ticker));
+        CREATE TABLE IF NOT EXISTS costs (account TEXT, ticker TEXT, value TEXT, PRIMARY KEY (account, ticker));
+        CREATE TABLE IF NOT EXISTS realized_pnl (account TEXT, seq INTEGER, record TEXT, PRIMARY KEY (account, seq));
+        CREATE TABLE IF NOT EXISTS transactions (account TEXT, seq INTEGER, record TEXT, PRIMARY KEY (account, seq));
+    """)
+    return conn
+
+def _enqueue_db(conn, db):
+    """以最新內容覆蓋待同步列 (同一帳戶永遠只有一列)"""
+    conn.execute(
+        "INSERT OR REPLACE INTO sync_outbox (account, doc, updated) VALUES (?, ?, ?)",
+        (_account_key(), json.dumps(db, ensure_ascii=False), time.time()),
+    )
+
+def read_pending_db():
+    with closing(open_local_store()) as conn:
+        row = conn.execute("SELECT doc FROM sync_outbox WHERE account = ?", (_account_key(),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def read_synced_db():
+    with closing(open_local_store()) as conn:
+        row = conn.execute("SELECT doc FROM sync_snapshot WHERE account = ?", (_account_key(),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def write_synced_db(db):
+    with closing(open_local_store()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO sync_snapshot VALUES (?, ?)",
+                     (_account_key(), json.dumps(db, ensure_ascii=False)))
+
+def flush_outbox():
+    """把待同步列推送到雲端；成功才刪除 (期間又有新存檔則保留新的)，失敗則指數退避"""
+    key = _account_key()
+    with closing(open_local_store()) as conn:
+        row = conn.execute(
+            "SELECT doc, updated, attempts, next_try FROM sync_outbox WHERE account = ?", (key,)
+        ).fetchone()
+    if not row or row[3] > time.time():
+        return
+    doc, updated, attempts = json.loads(row[0]), row[1], row[2]
+
+    try:
+        ok, synced, error = push_db_to_sheets(doc, read_synced_db())
     except Exception as e:
-        st.error(f"雲端存檔連線失敗: {e}")
-    return False
+        ok, synced, error = False, None, f"雲端存檔連線失敗: {e}"
+
+    done = 0
+    with closing(open_local_store()) as conn, conn:
+        if ok:
+            conn.execute("INSERT OR REPLACE INTO sync_snapshot VALUES (?, ?)", (key, json.dumps(synced, ensure_ascii=False)))
+            done = conn.execute("DELETE FROM sync_outbox WHERE account = ? AND updated = ?", (key, updated)).rowcount
+            if done:
+                # 衝突合併後雲端內容可能含其他裝置的變更，回寫本地 (期間有新存檔則留待下一輪)
+                _store_account_db(conn, synced)
+        else:
+            delay = min(SYNC_RETRY_MAX_SECONDS, 5 * 2 ** attempts)
+            conn.execute(
+                "UPDATE sync_outbox SET attempts = ?, next_try = ?, last_error = ? WHERE account = ? AND updated = ?",
+                (attempts + 1, time.time() + delay, error, key, updated),
+            )
+    if done and synced != doc:
+        refresh_shared_account()
 
-# 初始化 Session State (確保程式啟動時先從雲端抓資料)
-if 'db' not in st.session_state:
-    st.session_state.db = load_db_from_sheets()
+# ==============================================================================
+# 【本地帳戶資料庫】 - SQLite 為主要儲存 (自選/成本/已實現/交易/密碼)，Google Sheets 為非同步備份
+# ==============================================================================
+ACCOUNT_DICT_TABLES = {"list": "watchlist", "costs": "costs"}
+ACCOUNT_LIST_TABLES = {"realized_pnl": "realized_pnl", "transactions": "transactions"}
+
+def _read_account_tables(conn):
+    """從各資料表組回與雲端相同格式的帳戶文件；尚未匯入過回傳 None"""
+    account = _account_key()
+    meta = conn.execute("SELECT key, value FROM account_meta WHERE account = ?", (account,)).fetchall()
+    if not meta:
+        return None
+    db = {key: json.loads(value) for key, value in meta}
+    for key, table in ACCOUNT_DICT_TABLES.items():
+        rows = conn.execute(f"SELECT ticker, value FROM {table} WHERE account = ? ORDER BY rowid", (account,))
+        db[key] = {ticker: json.loads(value) for ticker, value in rows}
+    for key, table in ACCOUNT_LIST_TABLES.items():
+        rows = conn.execute(f"SELECT record FROM {table} WHERE account = ? ORDER BY seq", (account,))
+        db[key] = [json.loads(record) for (record,) in rows]
+    return db
+
+def _store_account_db(conn, db):
+    """把帳戶文件寫入各資料表：沿用同步協定的 diff，只更動有變的列 (帳本只追加新的一筆)"""
+    account = _account_key()
+    current = _read_account_tables(conn) or {}
+    for op in diff_db(current, db):
+        key = op["path"][0]
+        if key in ACCOUNT_DICT_TABLES and len(op["path"]) == 2:
+            table, ticker = ACCOUNT_DICT_TABLES[key], op["path"][1]
+            if op["op"] == "set":
+                # UPSERT 保留原本的 rowid，自選清單順序不變
+                conn.execute(f"INSERT INTO {table} VALUES (?, ?, ?) "
+                             "ON CONFLICT (account, ticker) DO UPDATE SET value = excluded.value",
+                             (account, ticker, json.dumps(op["value"], ensure_ascii=False)))
+            else:
+                conn.execute(f"DELETE FROM {table} WHERE account = ? AND ticker = ?", (account, ticker))
+        elif key in ACCOUNT_LIST_TABLES and op["op"] in ("append", "upsert"):
+            table, rows = ACCOUNT_LIST_TABLES[key], current.setdefault(key, [])
+            start = len(rows)
+            if op["op"] == "upsert":
+                _upsert_rows(rows, op["key"], op["values"])
+                for value in op["values"]:
+                    seq = next(i for i, r in enumerate(rows) if isinstance(r, dict) and r.get(op["key"]) == value.get(op["key"]))
+                    conn.execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)",
+                                 (account, seq, json.dumps(value, ensure_ascii=False)))
+            else:
+                rows.extend(op["values"])
+                conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?)", [
+                    (account, start + i, json.dumps(r, ensure_ascii=False)) for i, r in enumerate(op["values"])
+                ])
+        elif key in ACCOUNT_DICT_TABLES or key in ACCOUNT_LIST_TABLES:
+            # 整個欄位被替換或刪除：整批重寫
+            table = ACCOUNT_DICT_TABLES.get(key) or ACCOUNT_LIST_TABLES[key]
+            conn.execute(f"DELETE FROM {table} WHERE account = ?", (account,))
+            value = db.get(key)
+            if isinstance(value, dict):
+                conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?)", [
+                    (account, k, json.dumps(v, ensure_ascii=False)) for k, v in value.items()
+                ])
+            elif isinstance(value, list):
+                conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?)", [
+                    (account, i, json.dumps(r, ensure_ascii=False)) for i, r in enumerate(value)
+                ])
+        elif key in db:
+            conn.execute("INSERT OR REPLACE INTO account_meta VALUES (?, ?, ?)",
+                         (account, key, json.dumps(db[key], ensure_ascii=False)))
+        else:
+            conn.execute("DELETE FROM account_meta WHERE account = ? AND key = ?", (account, key))
+
+    if "_version" in db:
+        conn.execute("INSERT OR REPLACE INTO account_meta VALUES (?, '_version', ?)", (account, json.dumps(db["_version"])))
+    # 保證至少有一列 meta，作為「本地已匯入」的標記
+    conn.execute("INSERT OR IGNORE INTO account_meta VALUES (?, 'password_hash', 'null')", (account,))
+
+def read_account_db():
+    with closing(open_local_store()) as conn:
+        return _read_account_tables(conn)
+
+def load_account_db():
+    """讀取帳戶：直接讀本地 SQLite (毫秒級)；本機第一次使用時才從雲端匯入"""
+    db = read_account_db()
+    if db is not None:
+        ensure_sync_worker()
+        return db
+    db = load_db_from_sheets()
+    if db is None:
+        return None
+    with closing(open_local_store()) as conn, conn:
+        _store_account_db(conn, db)
+    return read_account_db()
+
+def pull_account_from_cloud():
+    """以雲端備份覆蓋本地 (仍有未同步的本地變更時保留本地，不覆蓋)"""
+    if read_pending_db() is not None:
+        ensure_sync_worker()["wake"].set()
+        return read_account_db()
+    db = load_db_from_sheets()
+    if db is not None:
+        with closing(open_local_store()) as conn, conn:
+            _store_account_db(conn, db)
+    # 雲端讀取失敗時只回傳本地現有內容 (本機未匯入過則為 None)，不再重打一次 10 秒的請求
+    return read_account_db()
+
+# ------------------------------------------------------------------------------
+# 全程序共用的帳戶狀態：所有分頁共用同一份 (視為唯讀，更新時整份替換)，rev 每次變更遞增。
+# 各 session 保留一份可編輯的副本，rerun 時發現 rev 變了就換成最新內容，不需任何網路請求。
+# ------------------------------------------------------------------------------
+ACCOUNT_RETRY_SECONDS = 60    # 本機未匯入且雲端讀取失敗後，冷卻多久才自動再試
+
+@st.cache_resource
+def _shared_account():
+    # lock 只保護記憶體中的狀態 (瞬間完成)；load_lock 讓同一時間只有一個 session 打雲端，網路請求不佔用 lock。
+    # book 是與 db["transactions"] 同步的部位簿，存檔時只吃進新交易
+    return {"db": None, "rev": 0, "failed_at": 0.0, "book": None,
+            "lock": threading.Lock(), "load_lock": threading.Lock()}
+
+def _account_ready(state):
+    """已載入，或仍在讀取失敗後的冷卻期 (呼叫端需持有 lock)"""
+    return state["db"] is not None or time.time() - state["failed_at"] < ACCOUNT_RETRY_SECONDS
+
+def get_shared_account():
+    state = _shared_account()
+    with state["lock"]:
+        if _account_ready(state):
+            return state["rev"], state["db"]
+    with state["load_lock"]:
+        # 等待期間可能已有其他 session 載入完成 (或剛失敗)，再檢查一次
+        with state["lock"]:
+            if _account_ready(state):
+                return state["rev"], state["db"]
+        db = load_account_db()  # 可能是 10 秒的雲端請求，不持有 lock，其他分頁的讀取與存檔照常進行
+        with state["lock"]:
+            if state["db"] is None:
+                if db is None:
+                    # 本機尚未匯入且雲端讀取失敗：記下時間，冷卻期間各分頁直接顯示離線，不再每次 rerun 阻塞重試
+                    state["failed_at"] = time.time()
+                else:
+                    state["db"], state["failed_at"] = db, 0.0
+                    state["rev"] += 1
+            return state["rev"], state["db"]
+
+def refresh_shared_account(from_cloud=False):
+    """以本地資料庫 (或先從雲端拉回) 重建共用狀態，其他分頁下次 rerun 就會看到"""
+    state = _shared_account()
+    if from_cloud:
+        with state["load_lock"]:
+            pull_account_from_cloud()  # 網路請求在 lock 外進行，結果已寫入本地資料庫
+    with state["lock"]:
+        # 一律以本地資料庫為準：拉取期間若有分頁存檔，讀到的也是存檔後的內容
+        state["db"] = read_account_db()
+        state["failed_at"] = time.time() if state["db"] is None else 0.0
+        state["rev"] += 1
+
+def sync_session_account():
+    """本 session 的副本落後共用版本時 (其他分頁存檔過或背景同步合併過) 換成最新內容；
+    帳戶無法載入時 db / db_base 皆為 None，由呼叫端顯示離線狀態，不會拿預設的空帳戶頂替"""
+    rev, db = get_shared_account()
+    if st.session_state.get("db_rev") != rev:
+        st.session_state.db = json.loads(json.dumps(db)) if db is not None else None
+        st.session_state.db_base = db
+        st.session_state.db_rev = rev
+
+def save_account_db(db):
+    """存檔：同一個交易內寫入本地資料表與同步佇列 (立即生效、斷線不遺失)，再由背景執行緒合併後備份到雲端。
+    若期間其他分頁已存檔，先把本 session 的變更重新套用到最新內容上，不會互相覆蓋"""
+    if st.session_state.get("db_base") is None:
+        st.error("帳戶尚未自雲端載入 (離線中)，無法存檔")
+        return False
+    state = _shared_account()
+    try:
+        with state["lock"]:
+            base = st.session_state.get("db_base")
+            if base is not None and state["db"] is not None and st.session_state.get("db_rev") != state["rev"]:
+                merged = apply_db_patch(state["db"], diff_db(base, db))
+                db.clear()
+                db.update(merged)
+            if state["book"] is None:
+                state["book"] = new_position_book()
+            reconcile_ledger(db, state["book"])
+            with closing(open_local_store()) as conn, conn:
+                _store_account_db(conn, db)
+                _enqueue_db(conn, db)
+            state["db"] = json.loads(json.dumps(db))
+            state["rev"] += 1
+            st.session_state.db_base, st.session_state.db_rev = state["db"], state["rev"]
+    except Exception as e:
+        # 部位簿可能已吃進沒存成功的交易，下次存檔整本重建
+        state["book"] = None
+        st.error(f"本地存檔失敗: {e}")
+        return False
+    ensure_sync_worker()["wake"].set()
+    return True
+
+@st.cache_resource
+def _sync_worker_state():
+    """全程序共用的同步執行緒"""
+    return {"wake": threading.Event(), "thread": None, "lock": threading.Lock()}
+
+def ensure_sync_worker():
+    state = _sync_worker_state()
+    with state["lock"]:
+        if state["thread"] is None or not state["thread"].is_alive():
+            def _loop():
+                while True:
+                    state["wake"].wait(timeout=SYNC_POLL_SECONDS)
+                    state["wake"].clear()
+                    time.sleep(SYNC_COALESCE_SECONDS)
+                    try:
+                        flush_outbox()
+                    except Exception as e:
+                        print("背景同步失敗:", e)
+
+            state["thread"] = threading.Thread(target=_loop, daemon=True)
+            state["thread"].start()
+    return state
+
+def get_sync_status():
+    """側邊欄用：(是否有待同步變更, 重試次數, 最後錯誤)"""
+    with closing(open_local_store()) as conn:
+        row = conn.execute(
+            "SELECT attempts, last_error FROM sync_outbox WHERE account = ?", (_account_key(),)
+        ).fetchone()
+    return (True, row[0], row[1]) if row else (False, 0, None)
 
 def hash_password(password):
     """安全機制：將明文密碼轉換為 SHA-256 雜湊碼儲存"""
@@ -741,6 +1858,974 @@ def hash_password(password):
         return None
     return hashlib.sha256(password.encode()).hexdigest()
 
+# ==============================================================================
+# 【投資組合引擎】 - 持股正規化一次，損益全部向量化計算
+# ==============================================================================
+LOT_SIZE = 1000  # 台股一張 = 1000 股
+
+@st.cache_data(show_spinner=False)
+def normalize_holdings(costs, names=None):
+    """把 db["costs"] 轉成型別固定的持股表 (index=代號；欄位 name/cost/qty)，舊版純數字成本視為 0 張"""
+    names = names or {}
+    rows = []
+    for t_code, info in (costs or {}).items():
+        if isinstance(info, dict):
+            cost, qty = info.get('cost', 0), info.get('qty', 0)
+        else:
+            cost, qty = info, 0.0
+        rows.append((t_code, names.get(t_code, t_code), cost, qty))
+
+    df = pd.DataFrame(rows, columns=['ticker', 'name', 'cost', 'qty']).set_index('ticker')
+    df['cost'] = pd.to_numeric(df['cost'], errors='coerce').fillna(0.0).astype(float)
+    df['qty'] = pd.to_numeric(df['qty'], errors='coerce').fillna(0.0).astype(float)
+    return df
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_latest_prices(tickers):
+    """一次下載所有代號近 5 日日線，回傳每檔最後一筆有效收盤價 (抓不到的為 NaN)"""
+    tickers = list(tickers)
+    if not tickers:
+        return pd.Series(dtype=float)
+    try:
+        df = yf.download(tickers, period="5d", interval="1d", progress=False)
+        close = df['Close']
+    except Exception as e:
+        print("報價下載失敗:", e)
+        return pd.Series(float('nan'), index=tickers)
+    if isinstance(close, pd.Series):
+        close = close.to_frame(tickers[0])
+    return close.ffill().iloc[-1].reindex(tickers).astype(float)
+
+@st.cache_data(show_spinner=False)
+def value_portfolio(holdings, prices):
+    """對價格向量一次算完投入本金、市值、損益、報酬率 (holdings 或 prices 改變才重算)"""
+    df = holdings.copy()
+    df['price'] = prices.reindex(df.index).astype(float)
+    df['invested'] = df['cost'] * df['qty'] * LOT_SIZE
+    df['market_value'] = df['price'] * df['qty'] * LOT_SIZE
+    df['pnl'] = df['market_value'] - df['invested']
+    df['roi'] = np.where(df['invested'] > 0, df['pnl'] / df['invested'].where(df['invested'] > 0) * 100, 0.0)
+    return df
+
+def get_portfolio_valuation(costs, names):
+    """目前持股 (張數 > 0) 的最新估值；沒有報價的列 price 為 NaN"""
+    holdings = normalize_holdings(costs, names)
+    held = holdings[holdings['qty'] > 0]
+    prices = fetch_latest_prices(tuple(held.index))
+    return value_portfolio(held, prices)
+
+# ==============================================================================
+# 【交易帳本】 - 逐筆買賣 -> FIFO 批次、平均成本、已實現損益 (只套用新進的交易)
+# ==============================================================================
+FEE_RATE = 0.001425       # 券商手續費
+FEE_MIN = 20              # 手續費最低 20 元
+TAX_RATE_STOCK = 0.003    # 股票證交稅 (賣出)
+TAX_RATE_ETF = 0.001      # ETF 證交稅 (賣出)
+
+def estimate_trade_costs(ticker, side, qty, price):
+    """預估手續費與證交稅 (ETF 代號以 00 開頭)"""
+    amount = qty * LOT_SIZE * price
+    fee = max(round(amount * FEE_RATE), FEE_MIN) if amount > 0 else 0
+    tax = 0
+    if side == "賣出":
+        tax = round(amount * trade_tax_rate(ticker))
+    return fee, tax
+
+def trade_tax_rate(ticker):
+    return TAX_RATE_ETF if ticker.startswith("00") else TAX_RATE_STOCK
+
+OPENING_SIDE = "期初"          # 帳本建立前就有的持股 (由 costs 轉入)
+OPENING_DATE = "1970-01-01"    # 期初批次排在所有交易之前，買進日期未知
+
+def opening_balance_tx(db, ticker):
+    """costs 已有持股、帳本卻還沒有該股任何交易時，把既有持股轉成一筆期初交易 (否則回傳 None)"""
+    info = db.get("costs", {}).get(ticker)
+    if not isinstance(info, dict) or float(info.get("qty", 0) or 0) <= 0:
+        return None
+    return {"id": None, "日期": OPENING_DATE, "代號": ticker, "名稱": db.get("list", {}).get(ticker, ticker),
+            "買賣": OPENING_SIDE, "張數": float(info["qty"]), "價格": float(info.get("cost", 0) or 0),
+            "手續費": 0, "交易稅": 0}
+
+def ledger_shortfall(book, tx, seed=None):
+    """把 tx 依 (日期, id) 插入部位簿中該股已排序的交易 (帳本還沒有該股時以期初批次 seed 起算)，
+    累加張數回傳最低點；小於 0 代表某次賣出當時的持股不足。只看這一檔，不重排整本帳"""
+    t = tx["代號"]
+    rows = list(book["index"].get(t, [])) or ([seed] if seed is not None else [])
+    keys = [(r["日期"], r["id"] if r.get("id") is not None else float("inf")) for r in rows]
+    rows.insert(bisect.bisect_right(keys, (tx["日期"], float("inf"))), tx)
+    held, low = 0.0, 0.0
+    for tx in rows:
+        held += -float(tx["張數"]) if tx["買賣"] == "賣出" else float(tx["張數"])
+        low = min(low, held)
+    return low
+
+def new_position_book():
+    return {
+        "applied": 0,       # transactions 已套用到第幾筆 (帳本只會附加)
+        "tail_id": None,    # 最後套用那筆的 id，用來偵測帳本被改寫
+        "index": {},        # 代號 -> 依 (日期, id) 排序的交易
+        "keys": {},         # 代號 -> 與 index 平行的 (日期, id)，供二分搜尋插入
+        "lots": {},         # 代號 -> 未平倉批次 [日期, 張數, 每股成本]
+        "realized": {},     # 代號 -> 每次賣出對應到的批次損益
+        "max_id": 0,        # 已套用交易中最大的 id，新交易從這裡往上編號
+    }
+
+def _apply_trade(book, tx):
+    """把一筆交易套用到該股的 FIFO 批次上"""
+    t = tx["代號"]
+    lots = book["lots"].setdefault(t, [])
+    qty, price = float(tx["張數"]), float(tx["價格"])
+    shares = qty * LOT_SIZE
+    if shares <= 0:
+        return
+
+    if tx["買賣"] in ("買進", OPENING_SIDE):
+        unit_cost = (price * shares + float(tx.get("手續費", 0))) / shares
+        lots.append([tx["日期"], qty, unit_cost])
+        return
+
+    # 賣出：扣掉費用與稅後的每股淨收入，從最早的批次開始沖銷
+    unit_proceeds = (price * shares - float(tx.get("手續費", 0)) - float(tx.get("交易稅", 0))) / shares
+    remaining = qty
+    while remaining > 1e-9 and lots:
+        lot = lots[0]
+        take = min(lot[1], remaining)
+        book["realized"].setdefault(t, []).append({
+            "tx_id": tx.get("id"), "日期": tx["日期"], "代號": t, "張數": take,
+            "成本": lot[2], "損益": (unit_proceeds - lot[2]) * take * LOT_SIZE,
+            "持有天數": None if lot[0] == OPENING_DATE else (pd.Timestamp(tx["日期"]) - pd.Timestamp(lot[0])).days,
+        })
+        lot[1] -= take
+        remaining -= take
+        if lot[1] <= 1e-9:
+            lots.pop(0)
+
+def _rebuild_ticker(book, t):
+    """某檔出現補登 (日期早於已套用的交易) 時，只重播這一檔"""
+    book["lots"][t] = []
+    book["realized"][t] = []
+    for tx in book["index"].get(t, []):
+        _apply_trade(book, tx)
+
+def apply_transactions(book, transactions):
+    """只處理 transactions[applied:]；依日期順序的直接套用，補登的只重建該股"""
+    if len(transactions) < book["applied"] or (
+            book["applied"] and transactions[book["applied"] - 1].get("id") != book["tail_id"]):
+        book.update(new_position_book())  # 帳本被刪改，整本重建
+
+    dirty = set()
+    for tx in transactions[book["applied"]:]:
+        t = tx["代號"]
+        txs = book["index"].setdefault(t, [])
+        keys = book["keys"].setdefault(t, [])
+        key = (tx["日期"], tx.get("id", 0))
+        pos = bisect.bisect_right(keys, key)
+        keys.insert(pos, key)
+        txs.insert(pos, tx)
+        if tx.get("id") is not None:
+            book["max_id"] = max(book["max_id"], tx["id"])
+        if pos == len(txs) - 1 and t not in dirty:
+            _apply_trade(book, tx)
+        else:
+            dirty.add(t)
+
+    for t in dirty:
+        _rebuild_ticker(book, t)
+
+    book["applied"] = len(transactions)
+    book["tail_id"] = transactions[-1].get("id") if transactions else None
+    return book
+
+def book_positions(book, tickers=None):
+    """每檔目前張數、平均成本 (含買進手續費)、已實現損益與最早批次日期"""
+    rows = []
+    for t in (tickers if tickers is not None else book["lots"]):
+        lots = book["lots"].get(t, [])
+        qty = sum(l[1] for l in lots)
+        cost = sum(l[1] * l[2] for l in lots) / qty if qty > 0 else 0.0
+        realized = sum(r["損益"] for r in book["realized"].get(t, []))
+        rows.append({"代號": t, "張數": qty, "平均成本": cost, "已實現損益": realized,
+                     "最早批次": lots[0][0] if lots else None})
+    return pd.DataFrame(rows, columns=["代號", "張數", "平均成本", "已實現損益", "最早批次"])
+
+def reconcile_ledger(db, book):
+    """存檔時 (持有共用帳戶鎖) 整理帳本：新交易以 max(id)+1 編號、第一次記帳的持股先轉成期初批次，
+    再把新交易吃進共用的部位簿 (補登只重播該股)，只重算受影響代號的已實現損益列，並回寫這些代號的持股"""
+    transactions = db.get("transactions") or []
+    committed = len(transactions)
+    while committed and transactions[committed - 1].get("id") is None:
+        committed -= 1  # 新交易都附加在最後
+    if committed == len(transactions):
+        return
+    apply_transactions(book, transactions[:committed])  # 平常是空操作；帳本被其他裝置改寫時才重建
+
+    ordered, touched = [], {}
+    next_id = book["max_id"] + 1
+    for tx in transactions[committed:]:
+        t = tx["代號"]
+        if t not in book["index"] and t not in touched:
+            seed = opening_balance_tx(db, t)
+            if seed is not None:
+                seed["id"], next_id = next_id, next_id + 1
+                ordered.append(seed)
+        tx["id"], next_id = next_id, next_id + 1
+        ordered.append(tx)
+        touched[t] = tx.get("名稱", t)
+    transactions[committed:] = ordered
+    apply_transactions(book, transactions)
+
+    def ledger_row(tx, rows):
+        pnl = sum(r["損益"] for r in rows)
+        basis = sum(r["成本"] * r["張數"] * LOT_SIZE for r in rows)
+        return {"日期": tx["日期"], "代號": tx["代號"], "名稱": tx.get("名稱", tx["代號"]),
+                "獲利": int(round(pnl)), "百分比": round(pnl / basis * 100, 2) if basis > 0 else 0.0,
+                "tx_id": tx["id"]}
+
+    # 只有受影響代號的賣出需要重算 (FIFO 配對不會跨股)
+    fresh = {}
+    for t in touched:
+        matched = {}
+        for r in book["realized"].get(t, []):
+            matched.setdefault(r["tx_id"], []).append(r)
+        for tx in book["index"].get(t, []):
+            if tx["買賣"] == "賣出":
+                fresh[tx["id"]] = ledger_row(tx, matched.get(tx["id"], []))
+
+    # 既有的列原位更新 (diff 時成為以 tx_id 為鍵的 upsert)，新的賣出依 id 附加在最後
+    realized = db.setdefault("realized_pnl", [])
+    for i, row in enumerate(realized):
+        if row.get("tx_id") in fresh:
+            realized[i] = fresh.pop(row["tx_id"])
+    realized.extend(fresh[tx_id] for tx_id in sorted(fresh))
+
+    positions = book_positions(book, list(touched)).set_index("代號")
+    for t, name in touched.items():
+        db.setdefault("costs", {})[t] = {"cost": round(float(positions.at[t, "平均成本"]), 4),
+                                         "qty": float(positions.at[t, "張數"])}
+        db.setdefault("list", {}).setdefault(t, name)
+
+def get_position_book(db):
+    """每個 session 保留一本部位簿，每次只吃進新增的交易"""
+    if "position_book" not in st.session_state:
+        st.session_state.position_book = new_position_book()
+    return apply_transactions(st.session_state.position_book, db.get("transactions", []))
+
+# ==============================================================================
+# 【帳戶淨值歷史】 - 依帳本日期重播部位 -> 每日 NAV / 投入本金 / 回撤，只補算新的交易日
+# ==============================================================================
+NAV_HISTORY_YEARS = 3
+NAV_PATH = os.path.join(DATA_DIR, "portfolio_nav.pkl.gz")
+
+def nav_transactions(costs, transactions):
+    """帳本交易 + 沒有任何交易紀錄的持股 (手動輸入的成本) 轉成的期初批次，視為區間開始前就已持有"""
+    transactions = list(transactions or [])
+    known = {tx["代號"] for tx in transactions}
+    db = {"costs": costs or {}}
+    for t in db["costs"]:
+        if t not in known:
+            seed = opening_balance_tx(db, t)
+            if seed is not None:
+                transactions.append(seed)
+    return transactions
+
+def replay_positions(transactions, index):
+    """依 (日期, id) 順序重播交易，回傳每個交易日收盤後的 (張數, 投入本金, 累計已實現) 三張寬表 (日期 x 代號)；
+    投入本金為未平倉批次的成本，已實現為 FIFO 沖銷的損益，兩者與當日持股一致"""
+    book = new_position_book()
+    rows = []
+    for tx in sorted(transactions, key=lambda tx: (tx["日期"], tx["id"] if tx.get("id") is not None else float("inf"))):
+        _apply_trade(book, tx)
+        t = tx["代號"]
+        lots = book["lots"].get(t, [])
+        rows.append((tx["日期"], t, sum(l[1] for l in lots), sum(l[1] * l[2] for l in lots) * LOT_SIZE,
+                     sum(r["損益"] for r in book["realized"].get(t, []))))
+
+    empty = pd.DataFrame(index=index, dtype=float)
+    if not rows:
+        return empty, empty, empty
+    df = pd.DataFrame(rows, columns=['date', 'ticker', 'qty', 'invested', 'realized'])
+    df['date'] = pd.to_datetime(df['date'], errors='coerce').dt.normalize()
+    # 同一天多筆取最後狀態；非交易日的交易歸到之後第一個交易日
+    wide = df.dropna(subset=['date']).groupby(['date', 'ticker']).last().unstack('ticker')
+    wide = wide.reindex(wide.index.union(index)).ffill().fillna(0.0).reindex(index)
+    return wide['qty'], wide['invested'], wide['realized']
+
+def manual_realized_rows(realized_pnl):
+    """已實現損益帳本中手動輸入的列 (沒有 tx_id)；帳本產生的列已由重播算出，不能重複計入"""
+    return [row for row in (realized_pnl or []) if row.get("tx_id") is None]
+
+def manual_realized_series(rows, index):
+    """手動已實現損益依賣出日期累加，非交易日的入帳歸到之後第一個交易日"""
+    if not rows:
+        return pd.Series(0.0, index=index)
+    df_pnl = pd.DataFrame(rows)
+    dates = pd.to_datetime(df_pnl['日期'], errors='coerce')
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_convert('Asia/Taipei').dt.tz_localize(None)
+    daily = pd.to_numeric(df_pnl['獲利'], errors='coerce').groupby(dates.dt.normalize()).sum().sort_index()
+    return daily.cumsum().reindex(index.union(daily.index)).ffill().reindex(index).fillna(0.0)
+
+def _nav_rows(transactions, manual_realized, closes):
+    """收盤價矩陣 (日期 x 代號) 對上當日實際持股，得到每日市值、投入本金與累計已實現損益 (帳本 + 手動)"""
+    qty, invested, realized = replay_positions(transactions, closes.index)
+    prices = closes.ffill().reindex(columns=qty.columns).fillna(0.0)
+    return pd.DataFrame({
+        'market_value': (qty * prices).sum(axis=1) * LOT_SIZE,
+        'invested': invested.sum(axis=1),
+        'realized': realized.sum(axis=1) + manual_realized_series(manual_realized, closes.index),
+    }, index=closes.index)
+
+def update_nav_history(transactions, manual_realized):
+    """本地淨值表只補算最後一天 (可能是盤中價) 之後的交易日；帳本、期初持股或手動已實現損益有任何變動就整段重播重算"""
+    key = data_fingerprint(transactions, manual_realized)
+    tickers = sorted({tx["代號"] for tx in transactions})
+    stored = read_frame(NAV_PATH)
+    if stored is not None and stored.attrs.get("ledger_key") != key:
+        stored = None  # 帳本已變，舊曲線作廢
+
+    if not tickers:
+        return pd.DataFrame(columns=['market_value', 'invested', 'realized'])
+    if stored is not None and not stored.empty:
+        last = stored.index[-1]
+        # 往前多抓幾天當作補值基準，避免新的一天某檔剛好沒有報價
+        closes = load_daily_panel(tickers, last - timedelta(days=10))
+        closes = closes.ffill()[closes.index >= last]
+        base = stored[stored.index < last]
+    else:
+        start = datetime.now() - timedelta(days=365 * NAV_HISTORY_YEARS)
+        closes = load_daily_panel(tickers, start)
+        base = None
+
+    if closes.empty:
+        return stored if stored is not None else pd.DataFrame(columns=['market_value', 'invested', 'realized'])
+
+    fresh = _nav_rows(transactions, manual_realized, closes)
+    nav = fresh if base is None else pd.concat([base, fresh])
+    nav.attrs["ledger_key"] = key
+    write_frame(nav, NAV_PATH)
+    return nav
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_nav_report(costs, transactions, realized_pnl):
+    """依帳本重播的每日市值 / 投入本金 / 已實現 (含手動輸入的已實現損益) -> 總資產、總損益與回撤曲線"""
+    nav = update_nav_history(nav_transactions(costs, transactions), manual_realized_rows(realized_pnl))
+    if nav.empty:
+        return nav
+
+    report = nav.copy()
+    report['total_assets'] = report['market_value'] + report['realized']
+    report['total_pnl'] = report['market_value'] - report['invested'] + report['realized']
+    report['drawdown'] = report['total_assets'] / report['total_assets'].cummax().where(lambda s: s > 0) - 1
+    report['drawdown'] = report['drawdown'].fillna(0.0)
+    return report
+
+# ==============================================================================
+# 【風險分析】 - 對齊的日報酬矩陣 (每日只追加新的一天) -> 波動、Beta、相關、VaR/CVaR
+# ==============================================================================
+RISK_BENCHMARK = "0050.TW"
+RISK_LOOKBACK_DAYS = 365 * 2
+TRADING_DAYS = 252
+VAR_CONFIDENCE = 0.95
+
+@st.cache_resource
+def _returns_state():
+    """全程序共用：目前這組代號的報酬矩陣與依最後日期快取的共變異數"""
+    return {"key": None, "returns": None, "stats": {}, "lock": threading.Lock()}
+
+def update_returns_matrix(tickers):
+    """持股 + 大盤基準的日報酬矩陣；同一組代號只重算最後一天 (可能是盤中價) 之後的報酬。
+    價格在 lock 外讀取 (可能要下載)，lock 只用來取出與換上矩陣"""
+    cols = sorted(set(tickers) | {RISK_BENCHMARK})
+    key = tuple(cols)
+    state = _returns_state()
+    with state["lock"]:
+        returns = state["returns"] if state["key"] == key else None
+    window_start = pd.Timestamp(datetime.now() - timedelta(days=RISK_LOOKBACK_DAYS)).normalize()
+
+    if returns is not None and not returns.empty:
+        last = returns.index[-1]
+        closes = load_daily_panel(cols, last - timedelta(days=10)).reindex(columns=cols)
+        fresh = closes.ffill().pct_change(fill_method=None)
+        fresh = fresh[fresh.index >= last]
+        returns = pd.concat([returns[returns.index < last], fresh])
+    else:
+        closes = load_daily_panel(cols, window_start).reindex(columns=cols)
+        returns = closes.ffill().pct_change(fill_method=None).iloc[1:]
+    returns = returns[returns.index >= window_start].dropna(how='all')
+
+    with state["lock"]:
+        if state["key"] != key:
+            state["stats"] = {}
+        state["key"], state["returns"] = key, returns
+    return returns
+
+def returns_covariance(returns):
+    """共變異數 / 相關係數矩陣，依 (代號組合, 最後日期) 快取，同一天內重複開啟不必重算"""
+    state = _returns_state()
+    cache_key = (tuple(returns.columns), returns.index[-1], len(returns))
+    if cache_key not in state["stats"]:
+        state["stats"] = {cache_key: (returns.cov(), returns.corr())}
+    return state["stats"][cache_key]
+
+def compute_portfolio_risk(returns, weights):
+    """weights: 代號 -> 市值權重 (加總為 1)；回傳個股風險表與組合 VaR/CVaR (日、報酬率)"""
+    cov, corr = returns_covariance(returns)
+    bench_var = cov.loc[RISK_BENCHMARK, RISK_BENCHMARK]
+    per_stock = pd.DataFrame({
+        "權重": weights,
+        "年化波動": np.sqrt(np.diag(cov.reindex(index=weights.index, columns=weights.index))) * np.sqrt(TRADING_DAYS),
+        "Beta": cov.loc[weights.index, RISK_BENCHMARK] / bench_var if bench_var > 0 else np.nan,
+    })
+
+    port = returns[weights.index].fillna(0.0).to_numpy() @ weights.to_numpy()
+    alpha = 1 - VAR_CONFIDENCE
+    q = np.quantile(port, alpha)
+    hist_var, hist_cvar = float(-q), float(-port[port <= q].mean())
+
+    w = weights.to_numpy()
+    sub_cov = cov.loc[weights.index, weights.index].fillna(0.0).to_numpy()
+    mu = float(returns[weights.index].mean().fillna(0.0).to_numpy() @ w)
+    sigma = float(np.sqrt(w @ sub_cov @ w))
+    z = -1.6448536269514722  # 常態分配 5% 分位
+    pdf_z = np.exp(-z ** 2 / 2) / np.sqrt(2 * np.pi)
+    param_var, param_cvar = -(mu + z * sigma), float(-(mu - sigma * pdf_z / alpha))
+
+    return {
+        "per_stock": per_stock,
+        "corr": corr,
+        "vol": sigma * np.sqrt(TRADING_DAYS),
+        "beta": float((per_stock["權重"] * per_stock["Beta"]).sum()),
+        "hist_var": hist_var, "hist_cvar": hist_cvar,
+        "param_var": param_var, "param_cvar": param_cvar,
+    }
+
+# ==============================================================================
+# 【同業比較】 - 比較面板直接由日線價格庫組出 (新增一檔只下載那一檔，切換區間不重抓)
+# ==============================================================================
+COMPARE_PERIODS = {"1mo": 1, "3mo": 3, "6mo": 6, "1y": 12}  # 區間 -> 月數 (ytd 另外處理)
+
+def comparison_start(period):
+    today = pd.Timestamp.now().normalize()
+    if period == "ytd":
+        return today.replace(month=1, day=1)
+    return today - pd.DateOffset(months=COMPARE_PERIODS[period])
+
+def load_comparison_panel(tickers, period):
+    """比較對象的還原收盤寬表，每檔以自己區間內第一個有價的日子為 100"""
+    tickers = list(tickers)
+    panel = load_daily_panel(tickers, comparison_start(period)).reindex(columns=tickers)
+    panel = panel.dropna(axis=1, how='all').dropna(how='all').ffill()
+    if panel.empty:
+        return panel
+    return panel / panel.bfill().iloc[0] * 100
+
+ROLLING_WINDOWS = (20, 60, 120)
+ROLLING_LOOKBACK_DAYS = 365 * 2
+ROLLING_CACHE_SETS = 8           # 全程序最多保留幾組比較組合 (LRU)，多人各自比較不會互相洗掉
+
+@st.cache_resource
+def _rolling_state():
+    """全程序共用的 LRU：(代號組合, 基準) -> (日報酬, 與基準配對的累積和 (第一列為 0))"""
+    return {"entries": OrderedDict(), "lock": threading.Lock()}
+
+def _pair_terms(r, b):
+    """每天的 r, b, r·b, r², b², 有效 (兩邊都有報酬) 天數，形狀 (6, 天數, 檔數)"""
+    valid = ~(np.isnan(r) | np.isnan(b)[:, None])
+    r0 = np.where(valid, r, 0.0)
+    b0 = np.where(valid, b[:, None], 0.0)
+    return np.stack([r0, b0, r0 * b0, r0 * r0, b0 * b0, valid.astype(float)])
+
+def update_rolling_sums(tickers, benchmark):
+    """比較組合 (含基準) 的日報酬與配對累積和；同一組代號只重算最後一天 (可能是盤中價) 之後的部分。
+    以排序後的代號當 key，順序不同的同一組代號共用同一份；回傳的欄位依代號排序。
+    價格在 lock 外讀取 (可能要下載)，lock 只用來取出與存回累積和"""
+    cols = sorted(set(tickers) | {benchmark})
+    key = (tuple(cols), benchmark)
+    state = _rolling_state()
+    with state["lock"]:
+        cached = state["entries"].get(key)
+    returns = cached[0] if cached is not None else None
+    window_start = pd.Timestamp(datetime.now() - timedelta(days=ROLLING_LOOKBACK_DAYS)).normalize()
+
+    if returns is not None and not returns.empty:
+        last = returns.index[-1]
+        closes = load_daily_panel(cols, last - timedelta(days=10)).reindex(columns=cols)
+        fresh = closes.ffill().pct_change(fill_method=None)
+        keep = int((returns.index < last).sum())
+        returns = pd.concat([returns.iloc[:keep], fresh[fresh.index >= last]])
+        cums = cached[1][:, :keep + 1]
+    else:
+        closes = load_daily_panel(cols, window_start).reindex(columns=cols)
+        returns = closes.ffill().pct_change(fill_method=None).iloc[1:]
+        keep, cums = 0, np.zeros((6, 1, len(cols)))
+
+    # 只對新加入的日子做 cumsum，接在原本的累積和後面
+    terms = _pair_terms(returns.iloc[keep:].to_numpy(dtype=float),
+                        returns[benchmark].iloc[keep:].to_numpy(dtype=float))
+    cums = np.concatenate([cums, cums[:, -1:] + np.cumsum(terms, axis=1)], axis=1)
+
+    drop = int((returns.index < window_start).sum())
+    returns, cums = returns.iloc[drop:], cums[:, drop:]
+    with state["lock"]:
+        state["entries"][key] = (returns, cums)
+        state["entries"].move_to_end(key)
+        while len(state["entries"]) > ROLLING_CACHE_SETS:
+            state["entries"].popitem(last=False)
+    return returns, cums
+
+def rolling_corr_beta(returns, cums, window):
+    """每個視窗的和 = 兩個累積和相減 (視窗滑動一天不必重掃)，回傳 (滾動相關, 滾動 Beta)，有效天數不足 8 成為 NaN"""
+    if cums.shape[1] <= window:
+        empty = pd.DataFrame(columns=returns.columns, dtype=float)
+        return empty, empty
+    sr, sb, srb, srr, sbb, n = cums[:, window:] - cums[:, :-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = (srb - sr * sb / n) / (n - 1)
+        var_r = (srr - sr ** 2 / n) / (n - 1)
+        var_b = (sbb - sb ** 2 / n) / (n - 1)
+        corr = cov / np.sqrt(var_r * var_b)
+        beta = cov / var_b
+    enough = n >= window * 0.8
+    index = returns.index[window - 1:]
+    return (pd.DataFrame(np.where(enough, corr, np.nan), index=index, columns=returns.columns),
+            pd.DataFrame(np.where(enough, beta, np.nan), index=index, columns=returns.columns))
+
+def relative_strength(returns, benchmark, start):
+    """相對強弱 = 個股累積報酬 / 基準累積報酬 (start 後第一個交易日為 100)，高於 100 代表跑贏基準"""
+    period_returns = returns[returns.index >= start].fillna(0.0)
+    period_returns.iloc[:1] = 0.0  # 起點當天收盤為基準，不計入當天漲跌
+    growth = (1 + period_returns).cumprod()
+    return growth.div(growth[benchmark], axis=0) * 100
+
+# ==============================================================================
+# 【產業指數】 - 依 industry_category 分組，只替使用者實際查看的產業在背景由日線價格庫算好等權 / 市值加權指數
+# ==============================================================================
+SECTOR_INDEX_DIR = os.path.join(DATA_DIR, "sector_indices")
+SECTOR_INDEX_DAYS = 365 * 2
+SECTOR_DOWNLOAD_BATCH = 200  # 產業成員日線分批補抓，避免單次請求過大
+SECTOR_PEER_LIMIT = 15       # 同業比較的候選清單最多列幾檔 (依市值排序)
+SECTOR_EXCLUDED = {"ETF", "ETN", "Index", "大盤", "所有證券", "受益證券", "存託憑證",
+                   "上櫃指數股票型基金(ETF)", "指數投資證券(ETN)"}
+def sector_members(info):
+    """產業 -> 成員代號 (yfinance 格式)；只收一般股票 (4 碼、非 0 開頭)，同一檔可屬於多個產業"""
+    stocks = info[info['stock_id'].str.fullmatch(r'[1-9]\d{3}')
+                  & ~info['industry_category'].isin(SECTOR_EXCLUDED)]
+    tickers = stocks['stock_id'] + np.where(stocks['type'] == 'tpex', '.TWO', '.TW')
+    return {k: sorted(set(v)) for k, v in tickers.groupby(stocks['industry_category'])}
+
+def ticker_sector(ticker, info):
+    """代號 (2330.TW / 2330) -> 所屬產業；找不到時回傳 None"""
+    stock_id = ticker.upper().split('.')[0]
+    rows = info[(info['stock_id'] == stock_id) & ~info['industry_category'].isin(SECTOR_EXCLUDED)]
+    return rows['industry_category'].iloc[0] if not rows.empty else None
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def load_market_caps():
+    """最近一個交易日的個股市值 (key 為 stock_id)；資料集需權限，抓不到時回傳空表，產業指數改用等權"""
+    try:
+        start = (datetime.now() - timedelta(days=10)).strftime('%Y-%m-%d')
+        raw = get_finmind_client().taiwan_stock_market_value(stock_id="", start_date=start)
+    except Exception as e:
+        print("個股市值下載失敗:", e)
+        return pd.Series(dtype=float)
+    if raw is None or raw.empty or 'market_value' not in raw.columns:
+        return pd.Series(dtype=float)
+    latest = raw.sort_values('date').drop_duplicates('stock_id', keep='last')
+    return pd.Series(pd.to_numeric(latest['market_value'], errors='coerce').to_numpy(),
+                     index=latest['stock_id'].astype(str)).dropna()
+
+def compute_sector_indices(close, members, caps):
+    """close: (日期 × 代號) 還原收盤寬表。回傳欄位為 (產業, 等權/市值加權) 的指數表 (起點 100)
+    市值加權：以最新市值反推股數 (區間內股數視為不變)，每天用前一日市值當權重"""
+    returns = close.pct_change(fill_method=None).iloc[1:]
+    shares = None
+    if not caps.empty:
+        last_price = close.ffill().iloc[-1]
+        stock_caps = caps.reindex(close.columns.str.split('.').str[0]).to_numpy()
+        shares = pd.Series(stock_caps, index=close.columns) / last_price
+    prev_cap = (close.ffill() * shares).shift(1).iloc[1:] if shares is not None else None
+
+    columns = {}
+    for sector, tickers in members.items():
+        tickers = [t for t in tickers if t in close.columns]
+        if not tickers:
+            continue
+        r = returns[tickers]
+        equal = r.mean(axis=1).fillna(0.0)
+        columns[(sector, "等權")] = 100 * (1 + equal).cumprod()
+        if prev_cap is not None:
+            w = prev_cap[tickers].where(r.notna())
+            cap = ((r * w).sum(axis=1) / w.sum(axis=1)).fillna(equal)  # 當天都沒有市值時用等權
+            columns[(sector, "市值加權")] = 100 * (1 + cap).cumprod()
+        else:
+            columns[(sector, "市值加權")] = columns[(sector, "等權")]
+    indices = pd.DataFrame(columns)
+    indices.columns = pd.MultiIndex.from_tuples(indices.columns)
+    indices.attrs["cap_weighted"] = prev_cap is not None
+    return indices
+
+def _sector_index_path(sector):
+    return os.path.join(SECTOR_INDEX_DIR, re.sub(r'[\\/:*?"<>|]', '_', sector) + ".pkl.gz")
+
+def update_sector_index(sector, days=SECTOR_INDEX_DAYS):
+    """補齊單一產業成員的日線 (分批、只抓缺少的區段) 後重算該產業指數；
+    attrs["members_by_cap"] 記下成員依市值由大到小的順序 (沒有市值時依代號)，給同業候選清單用"""
+    tickers = sector_members(load_stock_info()).get(sector, [])
+    if not tickers:
+        return None
+    start = pd.Timestamp.now().normalize() - pd.Timedelta(days=days)
+    panels = [load_daily_panel(tickers[i:i + SECTOR_DOWNLOAD_BATCH], start)
+              for i in range(0, len(tickers), SECTOR_DOWNLOAD_BATCH)]
+    panels = [p for p in panels if not p.empty]
+    if not panels:
+        return None
+    close = pd.concat(panels, axis=1).sort_index()
+    caps = load_market_caps()
+    indices = compute_sector_indices(close, {sector: tickers}, caps)
+    ranked = caps.reindex([t.split('.')[0] for t in tickers]).fillna(-1).to_numpy()
+    indices.attrs["members_by_cap"] = [tickers[i] for i in np.argsort(-ranked, kind='stable')]
+    write_frame(indices, _sector_index_path(sector))
+    return indices
+
+@st.cache_resource
+def _sector_index_state():
+    """全程序共用：各產業每日更新只跑一次 + 指數表的記憶體快取"""
+    return {"last_day": {}, "running": set(), "tables": {}, "lock": threading.Lock()}
+
+def schedule_sector_index_update(sector, force=False):
+    """在背景執行緒更新某個產業的指數 (有人查看該產業時才觸發，同一產業同一天只會執行一次，除非 force)"""
+    state = _sector_index_state()
+    today = datetime.now().strftime('%Y-%m-%d')
+    with state["lock"]:
+        if sector in state["running"] or (state["last_day"].get(sector) == today and not force):
+            return False
+        state["running"].add(sector)
+
+    def _worker():
+        try:
+            update_sector_index(sector)
+            state["last_day"][sector] = today
+        except Exception as e:
+            print(f"產業指數更新失敗 ({sector}):", e)
+        finally:
+            state["running"].discard(sector)
+
+    threading.Thread(target=_worker, daemon=True).start()
+    return True
+
+def load_sector_index(sector):
+    """讀取某個產業算好的指數 (檔案更新後才重新讀取)；尚未建立時回傳 None"""
+    state = _sector_index_state()
+    path = _sector_index_path(sector)
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    cached = state["tables"].get(sector)
+    if cached is None or cached[0] != mtime:
+        state["tables"][sector] = cached = (mtime, read_frame(path))
+    return cached[1]
+
+# ==============================================================================
+# 【回測引擎】 - 單筆 / 定期定額全部以陣列運算，含手續費、證交稅，價格用還原權息價 (股利再投入)
+# ==============================================================================
+BACKTEST_MODES = ("單筆投入", "定期定額")
+
+def contribution_mask(dates, mode):
+    """投入日：單筆只有第一個交易日；定期定額為每月第一個交易日。
+    dates 可為 (情境數, 天數) 的 datetime64 陣列，每列是一段不同起始日的區間"""
+    if np.ndim(dates) == 1:
+        dates = pd.DatetimeIndex(dates)
+        months = np.asarray(dates.year * 12 + dates.month)
+    else:
+        months = np.asarray(dates, dtype="datetime64[M]")
+    mask = np.zeros(months.shape, dtype=bool)
+    if months.shape[-1] == 0:
+        return mask
+    mask[..., 0] = True
+    if mode == "定期定額":
+        mask[..., 1:] = months[..., 1:] != months[..., :-1]
+    return mask
+
+def run_backtest(prices, dates, mode, amount, tax_rate=TAX_RATE_STOCK):
+    """prices 為 (天數,) 或 (路徑數, 天數) 的還原收盤價 (不可有 NaN)；多條路徑一次算完。
+    dates 為共用的 (天數,)，或與 prices 同形狀、每列各自的日期 (參數掃描的不同起始日)。
+    回傳逐日的累計投入 / 市值 / 回撤曲線，以及期末全數賣出 (扣手續費與證交稅) 後的報酬、CAGR、MDD"""
+    prices = np.asarray(prices)
+    if not np.issubdtype(prices.dtype, np.floating):
+        prices = prices.astype(float)
+    mask = contribution_mask(dates, mode)
+
+    fee = max(amount * FEE_RATE, FEE_MIN)
+    shares = np.cumsum(np.where(mask, (amount - fee) / prices, 0.0), axis=-1)
+    invested = np.cumsum(mask * float(amount), axis=-1)
+    value = shares * prices
+    peak = np.maximum.accumulate(value, axis=-1)
+    drawdown = np.divide(value, peak, out=np.ones_like(value), where=peak > 0) - 1
+
+    final_value = value[..., -1]
+    net_value = final_value - np.maximum(final_value * FEE_RATE, FEE_MIN) - final_value * tax_rate
+    # 以實際資料涵蓋的時間長度年化 (不是使用者選的年數)
+    if np.ndim(dates) == 1:
+        span_years = max((pd.Timestamp(dates[-1]) - pd.Timestamp(dates[0])).days, 1) / 365.25
+    else:
+        span_days = (dates[:, -1] - dates[:, 0]).astype("timedelta64[D]").astype(float)
+        span_years = np.maximum(span_days, 1) / 365.25
+    growth = net_value / invested[..., -1]
+    return {
+        "invested": invested, "value": value, "drawdown": drawdown,
+        "final_value": final_value, "net_value": net_value, "total_invested": invested[..., -1],
+        "roi": growth - 1, "cagr": np.maximum(growth, 0) ** (1 / span_years) - 1,
+        "mdd": drawdown.min(axis=-1), "years": span_years,
+    }
+
+# ------------------------------------------------------------------------------
+# 蒙地卡羅：把歷史日報酬按區塊重新抽樣成上千條路徑 (保留短期的波動聚集)，以 float32 批次回測
+# ------------------------------------------------------------------------------
+MC_BLOCK_DAYS = 20
+MC_CHUNK_PATHS = 2000            # 每批路徑數，控制記憶體用量
+MC_FAN_POINTS = 250              # 扇形圖每條分位線保留的點數
+MC_PERCENTILES = (5, 25, 50, 75, 95)
+
+def bootstrap_price_paths(returns, p0, n_days, n_paths, block, rng):
+    """區塊拔靴：每條路徑由隨機起點的連續 block 日報酬串接而成，回傳 (路徑數, n_days + 1) 價格"""
+    returns = np.asarray(returns, dtype=np.float32)
+    block = min(block, len(returns))
+    n_blocks = -(-n_days // block)
+    starts = rng.integers(0, len(returns) - block + 1, size=(n_paths, n_blocks))
+    idx = (starts[:, :, None] + np.arange(block)).reshape(n_paths, -1)[:, :n_days]
+    growth = np.cumprod(1 + returns[idx], axis=1, dtype=np.float32)
+    return np.concatenate([np.ones((n_paths, 1), dtype=np.float32), growth], axis=1) * np.float32(p0)
+
+def simulate_backtest(returns, p0, dates, mode, amount, tax_rate=TAX_RATE_STOCK,
+                      n_paths=10000, block=MC_BLOCK_DAYS, seed=None):
+    """分批產生路徑並回測；保留每條路徑的期末值 / CAGR / MDD，逐日市值只留扇形圖需要的分位數"""
+    rng = np.random.default_rng(seed)
+    n_days = len(dates) - 1
+    fan_idx = np.unique(np.linspace(0, n_days, min(MC_FAN_POINTS, n_days + 1)).astype(int))
+    finals, cagrs, mdds, fan_values = [], [], [], []
+    invested = None
+    for done in range(0, n_paths, MC_CHUNK_PATHS):
+        prices = bootstrap_price_paths(returns, p0, n_days, min(MC_CHUNK_PATHS, n_paths - done), block, rng)
+        res = run_backtest(prices, dates, mode, amount, tax_rate=tax_rate)
+        finals.append(res["net_value"])
+        cagrs.append(res["cagr"])
+        mdds.append(res["mdd"])
+        fan_values.append(res["value"][:, fan_idx])
+        invested = res["invested"]
+    fan = np.percentile(np.concatenate(fan_values), MC_PERCENTILES, axis=0)
+    return {
+        "net_value": np.concatenate(finals), "cagr": np.concatenate(cagrs), "mdd": np.concatenate(mdds),
+        "total_invested": float(invested[-1]), "fan_dates": pd.DatetimeIndex(dates)[fan_idx],
+        "fan": dict(zip(MC_PERCENTILES, fan)), "invested": invested[fan_idx],
+    }
+
+# ------------------------------------------------------------------------------
+# 參數掃描：代號 × 模式 × 金額 × 年數 × 起始日，全部共用同一份價格陣列
+# ------------------------------------------------------------------------------
+SWEEP_BENCHMARKS = ["0050.TW", "006208.TW"]
+SWEEP_START_STEPS = {"每月": 1, "每季": 3, "每年": 12}
+SWEEP_START_SPAN_YEARS = 5   # 起始日往回推的範圍
+
+def sweep_scenarios(dates, tickers, modes, amounts, horizons, step_months):
+    """展開參數格點，每個情境以 (代號, 模式, 金額, 年數, 起始位置, 結束位置) 表示"""
+    dates = pd.DatetimeIndex(dates)
+    windows = []
+    for years in horizons:
+        start = dates[-1] - pd.DateOffset(years=years)
+        while start >= dates[0]:
+            i0 = dates.searchsorted(start)
+            i1 = dates.searchsorted(start + pd.DateOffset(years=years), side='right')
+            windows.append((years, i0, i1))
+            start -= pd.DateOffset(months=step_months)
+    return [(t, mode, amount, years, i0, i1)
+            for t in tickers for mode in modes for amount in amounts for years, i0, i1 in windows]
+
+def run_backtest_sweep(panel, scenarios):
+    """同代號 / 模式 / 金額、且區間天數相同的情境疊成一個 (情境數, 天數) 陣列，一次 run_backtest 算完
+    (純 numpy 向量化，不受 GIL 限制)；盤中缺漏的日子沿用前一天收盤價，只略過起始日早於上市 (第一筆價格) 的區間"""
+    values = panel.ffill().to_numpy(dtype=float)
+    dates = panel.index.to_numpy()
+    col = {t: i for i, t in enumerate(panel.columns)}
+    valid = ~np.isnan(values)
+    first_valid = np.where(valid.any(axis=0), valid.argmax(axis=0), len(values))
+
+    groups = {}
+    for t, mode, amount, years, i0, i1 in scenarios:
+        if i1 - i0 >= 2:
+            groups.setdefault((t, mode, amount, i1 - i0), []).append((years, i0))
+
+    frames = []
+    for (t, mode, amount, n_days), items in groups.items():
+        years, starts = map(np.asarray, zip(*items))
+        idx = starts[:, None] + np.arange(n_days)
+        ok = starts >= first_valid[col[t]]
+        if not ok.any():
+            continue
+        idx, years, starts = idx[ok], years[ok], starts[ok]
+        r = run_backtest(values[idx, col[t]], dates[idx], mode, amount, tax_rate=trade_tax_rate(t))
+        frames.append(pd.DataFrame({
+            "代號": t, "模式": mode, "金額": amount, "年數": years, "起始日": pd.DatetimeIndex(dates[starts]).date,
+            "CAGR": r["cagr"], "MDD": r["mdd"], "總報酬": r["roi"],
+        }))
+    columns = ["代號", "模式", "金額", "年數", "起始日", "CAGR", "MDD", "總報酬"]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)[columns]
+
+# ==============================================================================
+# 【圖表降採樣】 - K 線 OHLC 分箱 + 線圖 LTTB，讓傳到瀏覽器的點數固定
+# ==============================================================================
+CHART_TARGET_PX = 1200   # 主圖大約的渲染寬度 (px)，線圖每像素保留一個點就足夠
+CANDLE_MIN_PX = 3        # 一根 K 棒至少要 3px 才看得清楚
+
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets：回傳要保留的點索引 (保留首尾與視覺上的極值)"""
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # 下一個桶的平均點當作三角形的第三個頂點
+        nxt_lo, nxt_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[nxt_lo:nxt_hi].mean()
+        avg_y = y[nxt_lo:nxt_hi].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+def downsample_line(series, n_out=CHART_TARGET_PX):
+    """對單條線做 LTTB，跳過 NaN (例如均線前段)"""
+    s = series.dropna()
+    if len(s) <= n_out:
+        return s
+    x = s.index.asi8.astype(float) if isinstance(s.index, pd.DatetimeIndex) else np.arange(len(s), dtype=float)
+    return s.iloc[lttb_indices(x, s.to_numpy(dtype=float), n_out)]
+
+def downsample_ohlc(df, n_out=CHART_TARGET_PX // CANDLE_MIN_PX):
+    """把 K 線等量分箱：開=首筆、高=最高、低=最低、收=末筆、量=加總，時間取箱內第一根"""
+    if len(df) <= n_out:
+        return df
+    bucket = np.arange(len(df)) * n_out // len(df)
+    grouped = df.groupby(bucket)
+    out = grouped.agg({'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'})
+    out.index = df.index[np.searchsorted(bucket, out.index)]
+    return out
+
+# ==============================================================================
+# 【圖表後端】 - 依點數自動選擇 SVG / WebGL / ECharts
+# ==============================================================================
+WEBGL_POINT_THRESHOLD = 2000      # 單條線超過此點數改用 WebGL (Scattergl)
+ECHARTS_POINT_THRESHOLD = 30000   # 整張線圖總點數超過此數改用 ECharts (large + progressive)
+
+@st.cache_resource(show_spinner=False)
+def load_echarts():
+    """第一次需要時才載入 streamlit-echarts；未安裝或版本不相容時回傳 None (退回 Plotly WebGL)"""
+    try:
+        from streamlit_echarts import st_echarts
+        return st_echarts
+    except Exception:
+        return None
+
+def pick_chart_backend(n_points):
+    """回傳 'echarts'、'webgl' 或 'svg'"""
+    if n_points >= ECHARTS_POINT_THRESHOLD and load_echarts() is not None:
+        return "echarts"
+    if n_points >= WEBGL_POINT_THRESHOLD:
+        return "webgl"
+    return "svg"
+
+def line_trace(x, y, **kwargs):
+    """建立線圖 trace：點數多時用 Scattergl (stackgroup 只有 SVG 支援)"""
+    if len(x) >= WEBGL_POINT_THRESHOLD and "stackgroup" not in kwargs:
+        return go.Scattergl(x=x, y=y, **kwargs)
+    return go.Scatter(x=x, y=y, **kwargs)
+
+def build_line_figure(df, highlight=None, layout=None):
+    """把 DataFrame 的每一欄畫成一條線 (Plotly)，highlight 欄位加粗"""
+    fig = go.Figure()
+    for col in df.columns:
+        s = df[col].dropna()
+        fig.add_trace(line_trace(s.index, s, name=str(col), mode='lines',
+                                 line=dict(width=3 if col == highlight else 1.5)))
+    if layout:
+        fig.update_layout(**layout)
+    return fig
+
+def build_line_echarts_option(df, title=None):
+    """ECharts 版本：時間軸 + large/progressive/LTTB 取樣，適合數萬點以上的序列"""
+    ts = (df.index.tz_localize(None) if getattr(df.index, "tz", None) is not None else df.index)
+    ts_ms = (pd.DatetimeIndex(ts).asi8 // 10**6).tolist()
+    series = []
+    for col in df.columns:
+        vals = df[col].astype(float).round(4)
+        series.append({
+            "name": str(col), "type": "line", "showSymbol": False,
+            "data": [[t, None if pd.isna(v) else v] for t, v in zip(ts_ms, vals)],
+            "large": True, "largeThreshold": 2000,
+            "progressive": 5000, "progressiveThreshold": 10000,
+            "sampling": "lttb",
+        })
+    return {
+        "backgroundColor": "#131722",
+        "title": {"text": title or "", "textStyle": {"color": "#d1d4dc", "fontSize": 14}},
+        "tooltip": {"trigger": "axis"},
+        "legend": {"type": "scroll", "top": 25, "textStyle": {"color": "#d1d4dc"}},
+        "xAxis": {"type": "time"},
+        "yAxis": {"type": "value", "scale": True, "splitLine": {"lineStyle": {"color": "#2A2E39"}}},
+        "dataZoom": [{"type": "inside"}, {"type": "slider"}],
+        "series": series,
+    }
+
+def render_line_chart(df, highlight=None, layout=None, title=None, height=450):
+    """多序列線圖的統一入口：依總點數挑選渲染後端"""
+    backend = pick_chart_backend(int(df.notna().sum().sum()))
+    if backend == "echarts":
+        load_echarts()(options=build_line_echarts_option(df, title), theme="dark", height=f"{height}px")
+        return
+    layout = dict(layout or {}, height=height)
+    if title:
+        layout.setdefault("title", title)
+    show_cached_figure("line", lambda: build_line_figure(df, highlight, layout), df,
+                       highlight=highlight, layout=layout)
+
+# ==============================================================================
+# 【圖表快取】 - 以資料指紋 + 圖表參數為 key，重複 rerun 不必重建 / 重新序列化
+# ==============================================================================
+FIGURE_CACHE_MAX_ENTRIES = 64   # 全程序最多保留幾張已序列化的圖表
+
+def data_fingerprint(*parts):
+    """DataFrame / Series 用 pandas 內建雜湊 (整張含索引，中間任何一根被修正都會換 key，成本遠低於建圖)，
+    numpy 陣列用原始位元組，其餘參數用排序後的 JSON"""
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (pd.DataFrame, pd.Series)):
+            cols = list(part.columns) if isinstance(part, pd.DataFrame) else [part.name]
+            h.update(repr((cols, part.shape)).encode())
+            h.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+        elif isinstance(part, np.ndarray):
+            h.update(repr((part.shape, part.dtype.str)).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+@st.cache_data(max_entries=FIGURE_CACHE_MAX_ENTRIES, show_spinner=False)
+def _plotly_chart_by_key(key, _builder):
+    """只以 key 當快取鍵；命中時 Streamlit 直接重播已序列化好的 plotly_chart 元素，不建圖也不重新轉 JSON"""
+    st.plotly_chart(_builder(), use_container_width=True)
+
+def show_cached_figure(name, builder, *inputs, **options):
+    """顯示圖表：資料指紋 + 圖表參數相同時沿用快取的圖表規格，未命中才呼叫 builder() 建圖"""
+    _plotly_chart_by_key(f"{name}:{data_fingerprint(*inputs, options)}", builder)
+
+
 # ==============================================================================
 # 第二部分：【互動對話視窗 (Dialogs)】 - UI 彈窗功能定義
 # ==============================================================================
@@ -752,58 +2837,26 @@ def show_full_portfolio_report(active_costs, active_list):
         st.warning("目前庫存中沒有帳務資料。")
         return
 
-    report_data = []
     with st.spinner("正在獲取最新報價..."):
-        for t_code, info in active_costs.items():
-            try:
-                # 取得股價資料
-                df_recent = fetch_yf_data_cached(t_code, period="1d", interval="1d")
-                if df_recent.empty:
-                    continue
-                
-                # 處理 yfinance 多層索引問題
-                if isinstance(df_recent.columns, pd.MultiIndex):
-                    df_recent.columns = df_recent.columns.get_level_values(0)
-                
-                c_price = float(df_recent['Close'].iloc[-1])
-                name = active_list.get(t_code, "未知")
-                
-                # 讀取成本與張數 (支援 dict 或直接數值型態)
-                if isinstance(info, dict):
-                    cost = float(info.get('cost', 0))
-                    qty = float(info.get('qty', 0))
-                else:
-                    cost = float(info)
-                    qty = 0.0
-                
-                if qty <= 0: continue # 跳過張數為 0 的股票
+        pf = get_portfolio_valuation(active_costs, active_list)
+    pf = pf[pf['price'].notna()]
 
-                total_cost = cost * qty * 1000
-                market_value = c_price * qty * 1000
-                diff = market_value - total_cost
-                roi = (diff / total_cost * 100) if total_cost > 0 else 0
-                
-                report_data.append({
-                    "代號": t_code,
-                    "名稱": name,
-                    "成本價": round(cost, 2),
-                    "現價": round(c_price, 2),
-                    "張數": qty,
-                    "投入本金": int(total_cost),
-                    "目前市值": int(market_value),
-                    "損益": int(diff),
-                    "報酬率": round(roi, 2)
-                })
-            except Exception as e:
-                # 可以選擇列印錯誤以便除錯: print(f"Error processing {t_code}: {e}")
-                continue
-
-    if not report_data:
+    if pf.empty:
         st.info("尚無有效庫存資料可顯示。")
         return
 
     # 轉為 DataFrame
-    df_report = pd.DataFrame(report_data)
+    df_report = pd.DataFrame({
+        "代號": pf.index,
+        "名稱": pf['name'].to_numpy(),
+        "成本價": pf['cost'].round(2).to_numpy(),
+        "現價": pf['price'].round(2).to_numpy(),
+        "張數": pf['qty'].to_numpy(),
+        "投入本金": pf['invested'].astype(int).to_numpy(),
+        "目前市值": pf['market_value'].astype(int).to_numpy(),
+        "損益": pf['pnl'].astype(int).to_numpy(),
+        "報酬率": pf['roi'].round(2).to_numpy(),
+    })
     df_report = df_report.sort_values(by='報酬率', ascending=False)
 
     # 樣式定義
@@ -835,6 +2888,17 @@ def show_full_portfolio_report(active_costs, active_list):
     st.divider()
     st.metric("合計預估總損益", f"NT$ {int(total_p):,}", delta=f"{int(total_p):,}")
 
+    # 交易帳本的未平倉批次與持有天數
+    book = get_position_book(st.session_state.db)
+    lot_rows = [
+        {"代號": t, "買進日期": OPENING_SIDE if d == OPENING_DATE else d, "張數": q, "每股成本": round(c, 2),
+         "持有天數": None if d == OPENING_DATE else (pd.Timestamp(datetime.now().date()) - pd.Timestamp(d)).days}
+        for t, lots in book["lots"].items() for d, q, c in lots
+    ]
+    if lot_rows:
+        with st.expander("📒 未平倉批次 (FIFO)"):
+            st.dataframe(pd.DataFrame(lot_rows), hide_index=True, use_container_width=True)
+
 # 2. 新增庫存股票
 @st.dialog("➕ 新增股票至清單")
 def add_stock_dialog():
@@ -846,7 +2910,7 @@ def add_stock_dialog():
             st.session_state.db["list"][new_ticker] = new_name
             st.session_state.db["costs"][new_ticker] = {"cost": 0.0, "qty": 0.0}
             
-            success = save_db_to_sheets(st.session_state.db)
+            success = save_account_db(st.session_state.db)
             if success:
                 st.success(f"已成功新增 {new_name} ({new_ticker}) 並同步至雲端！")
                 st.rerun()
@@ -867,7 +2931,7 @@ def delete_confirm_dialog(ticker, name):
     if c2.button("確認刪除", type="primary", use_container_width=True):
         st.session_state.db["list"].pop(ticker, None)
         st.session_state.db["costs"].pop(ticker, None)
-        success = save_db_to_sheets(st.session_state.db)
+        success = save_account_db(st.session_state.db)
         if success:
             st.session_state.selected_ticker = None
             st.session_state.temp_ticker = None
@@ -899,7 +2963,7 @@ def record_sale_dialog():
                 "獲利": profit_amt, "百分比": profit_pct
             }
             st.session_state.db.setdefault("realized_pnl", []).append(record)
-            success = save_db_to_sheets(st.session_state.db)
+            success = save_account_db(st.session_state.db)
             if success:
                 st.success(f"✅ 已紀錄 {manual_name} 的獲利並同步至雲端！")
                 st.rerun()
@@ -908,6 +2972,73 @@ def record_sale_dialog():
         else:
             st.error("請填寫股票代號與名稱")
 
+# 4-1. 紀錄買賣交易 (交易帳本，自動以 FIFO 計算已實現損益)
+@st.dialog("📒 紀錄買賣交易")
+def record_trade_dialog():
+    date = st.date_input("交易日期", datetime.now())
+    col_a, col_b = st.columns(2)
+    manual_id = col_a.text_input("股票代號", placeholder="例如: 2330")
+    manual_name = col_b.text_input("股票名稱", placeholder="例如: 台積電")
+    side = st.radio("買賣別", ["買進", "賣出"], horizontal=True)
+
+    col1, col2 = st.columns(2)
+    qty = col1.number_input("張數", min_value=0.0, value=1.0, step=1.0)
+    price = col2.number_input("成交價", min_value=0.0, value=0.0, step=0.05, format="%.2f")
+
+    formatted_id = manual_id.upper().strip()
+    if formatted_id and "." not in formatted_id: formatted_id = f"{formatted_id}.TW"
+    fee_est, tax_est = estimate_trade_costs(formatted_id, side, qty, price)
+    col3, col4 = st.columns(2)
+    fee = col3.number_input("手續費", min_value=0, value=int(fee_est), step=1)
+    tax = col4.number_input("證交稅", min_value=0, value=int(tax_est), step=1)
+
+    db = st.session_state.db
+    book = get_position_book(db)
+    lots = book["lots"].get(formatted_id, [])
+    transactions = db.get("transactions", [])
+    seed = None
+    if formatted_id and not any(t["代號"] == formatted_id for t in transactions):
+        seed = opening_balance_tx(db, formatted_id)
+    if lots:
+        st.caption(f"目前 {formatted_id} 未平倉批次 (FIFO)")
+        st.dataframe(pd.DataFrame(lots, columns=["買進日期", "張數", "每股成本"]), hide_index=True, use_container_width=True)
+        ledger_pos = book_positions(book, [formatted_id]).iloc[0]
+        manual = normalize_holdings({formatted_id: db.get("costs", {}).get(formatted_id, {})}).iloc[0]
+        if abs(manual['qty'] - ledger_pos['張數']) > 1e-9 or abs(manual['cost'] - ledger_pos['平均成本']) > 1e-4:
+            st.warning(f"側邊欄手動設定的持股 ({manual['qty']:g} 張 / 成本 {manual['cost']:.2f}) 與帳本不同 "
+                       f"({ledger_pos['張數']:g} 張 / 成本 {ledger_pos['平均成本']:.2f})；存檔後會以帳本重算的數字覆蓋")
+    elif seed is not None:
+        st.caption(f"{formatted_id} 尚無帳本紀錄：存檔時會先把目前持股 {seed['張數']:g} 張 (成本 {seed['價格']:.2f}) 轉為期初批次")
+
+    st.write("---")
+    if st.button("確認存入帳本並同步雲端", type="primary", use_container_width=True):
+        if not (formatted_id and manual_name and qty > 0 and price > 0):
+            st.error("請填寫代號、名稱、張數與成交價")
+            return
+        # id 於存檔時在共用帳戶鎖內以 max(id)+1 編號，兩個分頁同時存檔也不會重複
+        tx = {
+            "id": None, "日期": str(date), "代號": formatted_id, "名稱": manual_name, "買賣": side,
+            "張數": qty, "價格": price, "手續費": fee, "交易稅": tax,
+        }
+        if side == "賣出":
+            # 以交易日期檢查：插入這筆後，這天與之後每一次賣出時的持股都不能是負的
+            low = ledger_shortfall(book, tx, seed)
+            if low < -1e-9:
+                st.error(f"{date} 賣出 {qty:g} 張會使帳本持股不足 (最多短少 {-low:g} 張)")
+                return
+
+        # 期初批次、平均成本 / 張數回寫 costs、已實現損益都由 save_account_db 依整本帳重算；
+        # 在副本上存檔，失敗時 session 內不會留下沒有 id 的交易
+        candidate = json.loads(json.dumps(db))
+        candidate.setdefault("transactions", []).append(tx)
+
+        if save_account_db(candidate):
+            st.session_state.db = candidate
+            st.success(f"✅ 已紀錄 {manual_name} {side} {qty:g} 張並同步至雲端！")
+            st.rerun()
+        else:
+            st.error("❌ 雲端同步失敗，請檢查 Apps Script 設定。")
+
 # 5. 年度獲利報表 (時區校準版)
 @st.dialog("🗓️ 年度獲利結算報表", width="large")
 def show_annual_report_dialog():
@@ -967,107 +3098,216 @@ def show_annual_report_dialog():
 def backtest_dialog(ticker):
     st.write(f"### 模擬標的：{ticker}")
     col_mode, col_amt, col_year = st.columns([1.5, 2, 2])
-    mode = col_mode.radio("選擇投資模式", ["單筆投入", "定期定額"])
+    mode = col_mode.radio("選擇投資模式", BACKTEST_MODES)
     invest_amt = col_amt.number_input(f"{mode}金額 (NT$)", value=100000 if mode == "單筆投入" else 10000, step=5000)
     years = col_year.slider("回測年數", 1, 10, 3)
+    method = st.radio("模擬方式", ["歷史回測", "蒙地卡羅 (區塊拔靴)"], horizontal=True,
+                      help="蒙地卡羅把過去 10 年的日報酬以 20 日為一塊重新抽樣，產生上千條可能的未來路徑")
+    if method != "歷史回測":
+        st.divider()
+        render_monte_carlo(ticker, mode, invest_amt, years)
+        return
+    freq = st.radio("資料頻率", ["日線", "本地 1 分 K"], horizontal=True,
+                    help="本地 1 分 K 只涵蓋已累積的日期，年化報酬以實際資料區間計算")
     start_date = datetime.now() - timedelta(days=years*365)
     st.divider()
-    
+
     with st.spinner("數據計算中..."):
-        # 【效能優化】改用快取函數
-        data = fetch_yf_data_cached(ticker, start=start_date)
-        if data.empty:
+        if freq == "本地 1 分 K":
+            close_prices = load_intraday_history(ticker, start_date.strftime('%Y-%m-%d')).get('Close', pd.Series(dtype=float))
+        else:
+            # 本地日線庫的還原權息價：配息視同再投入
+            close_prices = load_daily_panel([ticker], start_date).get(ticker, pd.Series(dtype=float))
+        close_prices = close_prices.dropna()
+        if close_prices.empty:
             st.error("無法取得歷史數據。")
             return
-        if isinstance(data.columns, pd.MultiIndex): data.columns = data.columns.get_level_values(0)
-        
-        close_prices = data['Close']
-        history_data = []
-        if mode == "單筆投入":
-            first_price = float(close_prices.iloc[0])
-            total_shares = invest_amt / first_price
-            total_invested = invest_amt
-            for date, price in close_prices.items():
-                history_data.append({"日期": date, "累計投入": total_invested, "當前市值": total_shares * float(price)})
-        else:
-            monthly_data = close_prices.resample('MS').first()
-            total_shares, total_invested = 0, 0
-            for date, price in monthly_data.items():
-                if pd.isna(price): continue
-                price_val = float(price)
-                total_shares += invest_amt / price_val
-                total_invested += invest_amt
-                history_data.append({"日期": date, "累計投入": total_invested, "當前市值": total_shares * price_val})
-
-        df_res = pd.DataFrame(history_data)
-        final_value = df_res["當前市值"].iloc[-1]
-        total_invested = df_res["累計投入"].iloc[-1]
-        total_profit = final_value - total_invested
-        total_roi = (total_profit / total_invested) * 100
-        cagr = ((final_value / total_invested) ** (1 / years) - 1) * 100
-        df_res['rolling_max'] = df_res['當前市值'].cummax()
-        df_res['drawdown'] = (df_res['當前市值'] - df_res['rolling_max']) / df_res['rolling_max']
-        mdd = df_res['drawdown'].min() * 100
+
+        res = run_backtest(close_prices.to_numpy(), close_prices.index, mode, invest_amt, tax_rate=trade_tax_rate(ticker))
+        df_res = pd.DataFrame({"日期": close_prices.index, "累計投入": res["invested"], "當前市值": res["value"],
+                               "drawdown": res["drawdown"]})
+        years = res["years"]
+        final_value = float(res["net_value"])
+        total_profit = final_value - float(res["total_invested"])
+        total_roi = float(res["roi"]) * 100
+        cagr = float(res["cagr"]) * 100
+        mdd = float(res["mdd"]) * 100
 
         c1, c2, c3, c4 = st.columns(4)
         c1.metric("最終市值", f"${final_value:,.0f}", delta=f"{total_profit:,.0f}")
         c2.metric("總報酬率", f"{total_roi:.2f}%")
         c3.metric("年化報酬率", f"{cagr:.2f}%")
         c4.metric("最大跌幅 (MDD)", f"{mdd:.2f}%", delta_color="inverse")
+        st.caption(f"最終市值為期末全數賣出、扣除手續費 {FEE_RATE:.4%} 與證交稅 {trade_tax_rate(ticker):.1%} 後金額；"
+                   f"每次投入扣手續費 (最低 {FEE_MIN} 元)，股利以還原權息價計入")
 
         # 【圖表優化】加入雙 Y 軸與 MDD 水下圖
-        fig = make_subplots(specs=[[{"secondary_y": True}]])
-        fig.add_trace(go.Scatter(x=df_res["日期"], y=df_res["累計投入"], name="成本線", line=dict(color='gray', dash='dot')), secondary_y=False)
-        fig.add_trace(go.Scatter(x=df_res["日期"], y=df_res["當前市值"], name="價值走勢", fill='tozeroy', line=dict(color='#FF4B4B' if total_profit > 0 else '#26A69A')), secondary_y=False)
-        fig.add_trace(go.Scatter(x=df_res["日期"], y=df_res['drawdown'] * 100, name="回撤幅度(%)", fill='tozeroy', line=dict(color='rgba(255, 82, 82, 0.3)', width=1)), secondary_y=True)
-        
-        fig.update_layout(title=f"{ticker} {years}年績效 (CAGR: {cagr:.1f}% / MDD: {mdd:.1f}%)", template="plotly_dark")
-        fig.update_yaxes(title_text="資產市值", secondary_y=False)
-        fig.update_yaxes(title_text="回撤幅度 %", secondary_y=True, showgrid=False)
-        st.plotly_chart(fig, use_container_width=True)
+        title = f"{ticker} {years:.0f}年績效 (CAGR: {cagr:.1f}% / MDD: {mdd:.1f}%)"
+
+        def build_backtest_chart():
+            fig = make_subplots(specs=[[{"secondary_y": True}]])
+            fig.add_trace(line_trace(df_res["日期"], df_res["累計投入"], name="成本線", line=dict(color='gray', dash='dot')), secondary_y=False)
+            fig.add_trace(line_trace(df_res["日期"], df_res["當前市值"], name="價值走勢", fill='tozeroy', line=dict(color='#FF4B4B' if total_profit > 0 else '#26A69A')), secondary_y=False)
+            fig.add_trace(line_trace(df_res["日期"], df_res['drawdown'] * 100, name="回撤幅度(%)", fill='tozeroy', line=dict(color='rgba(255, 82, 82, 0.3)', width=1)), secondary_y=True)
+
+            fig.update_layout(title=title, template="plotly_dark")
+            fig.update_yaxes(title_text="資產市值", secondary_y=False)
+            fig.update_yaxes(title_text="回撤幅度 %", secondary_y=True, showgrid=False)
+            return fig
+
+        show_cached_figure("backtest", build_backtest_chart, df_res, title=title)
+
+def render_monte_carlo(ticker, mode, invest_amt, years):
+    """回測對話框的蒙地卡羅模式：分位數扇形圖 + 期末市值 / CAGR / MDD 分布"""
+    c1, c2 = st.columns(2)
+    n_paths = c1.select_slider("模擬路徑數", [1000, 5000, 10000, 20000], value=10000)
+    block = c2.slider("抽樣區塊 (交易日)", 5, 60, MC_BLOCK_DAYS)
+
+    history = load_daily_panel([ticker], datetime.now() - timedelta(days=3650)).get(ticker, pd.Series(dtype=float)).dropna()
+    returns = history.pct_change().dropna().to_numpy()
+    if len(returns) < block * 2:
+        st.error("歷史數據不足，無法進行模擬。")
+        return
+
+    dates = pd.bdate_range(datetime.now().date(), periods=years * 252 + 1)
+    t0 = time.perf_counter()
+    sim = simulate_backtest(returns, float(history.iloc[-1]), dates, mode, invest_amt,
+                            tax_rate=trade_tax_rate(ticker), n_paths=n_paths, block=block, seed=0)
+    elapsed = time.perf_counter() - t0
+
+    pct = {q: (np.percentile(sim["net_value"], q), np.percentile(sim["cagr"], q) * 100, np.percentile(sim["mdd"], q) * 100)
+           for q in (5, 50, 95)}
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("期末市值中位數", f"${pct[50][0]:,.0f}", delta=f"{pct[50][0] - sim['total_invested']:,.0f}")
+    c2.metric("年化報酬 (P5 / P50 / P95)", f"{pct[5][1]:.1f}% / {pct[50][1]:.1f}% / {pct[95][1]:.1f}%")
+    c3.metric("MDD 中位數", f"{pct[50][2]:.1f}%", delta_color="inverse")
+    c4.metric("虧損機率", f"{(sim['net_value'] < sim['total_invested']).mean() * 100:.1f}%")
+    st.caption(f"{n_paths:,} 條路徑 × {len(dates) - 1} 個交易日，耗時 {elapsed:.2f} 秒；已扣手續費與證交稅")
+
+    fan, fan_dates = sim["fan"], sim["fan_dates"]
+    def build_fan_chart():
+        fig = go.Figure()
+        for lo, hi, color in ((5, 95, 'rgba(255, 75, 75, 0.15)'), (25, 75, 'rgba(255, 75, 75, 0.3)')):
+            fig.add_trace(line_trace(fan_dates, fan[hi], line=dict(width=0), showlegend=False, hoverinfo='skip'))
+            fig.add_trace(line_trace(fan_dates, fan[lo], line=dict(width=0), fill='tonexty', fillcolor=color, name=f"P{lo}–P{hi}"))
+        fig.add_trace(line_trace(fan_dates, fan[50], name="中位數", line=dict(color='#FF4B4B', width=2)))
+        fig.add_trace(line_trace(fan_dates, sim["invested"], name="累計投入", line=dict(color='gray', dash='dot')))
+        fig.update_layout(title=f"{ticker} {years}年 {mode} 市值分位數", template="plotly_dark", height=380,
+                          margin=dict(l=10, r=10, t=40, b=10))
+        return fig
+    show_cached_figure("mc_fan", build_fan_chart, *fan.values(), title=f"{ticker}{years}{mode}")
+
+    def build_dist_chart():
+        fig = make_subplots(rows=1, cols=2, subplot_titles=("年化報酬率 (%)", "最大跌幅 MDD (%)"))
+        fig.add_trace(go.Histogram(x=sim["cagr"] * 100, nbinsx=60, marker_color='#FF4B4B', showlegend=False), row=1, col=1)
+        fig.add_trace(go.Histogram(x=sim["mdd"] * 100, nbinsx=60, marker_color='#26A69A', showlegend=False), row=1, col=2)
+        fig.update_layout(template="plotly_dark", height=300, margin=dict(l=10, r=10, t=40, b=10))
+        return fig
+    show_cached_figure("mc_dist", build_dist_chart, sim["cagr"], sim["mdd"])
+
+@st.dialog("🧮 參數掃描回測", width="large")
+def sweep_backtest_dialog(holdings, names):
+    c1, c2 = st.columns(2)
+    options = list(dict.fromkeys(list(holdings) + SWEEP_BENCHMARKS))
+    tickers = c1.multiselect("標的 (持股 + 大盤)", options, default=options, format_func=lambda t: f"{t} {names.get(t, '')}")
+    modes = c2.multiselect("投資模式", BACKTEST_MODES, default=list(BACKTEST_MODES))
+    c3, c4, c5 = st.columns(3)
+    horizons = c3.multiselect("回測年數", [1, 3, 5, 10], default=[1, 3, 5])
+    amounts = c4.multiselect("每次投入金額", [3000, 10000, 50000, 100000], default=[10000])
+    step = c5.selectbox("起始日間隔", list(SWEEP_START_STEPS), index=1)
+    if not (tickers and modes and horizons and amounts):
+        st.info("請至少各選一個參數")
+        return
+    if not st.button("開始掃描", type="primary", use_container_width=True):
+        return
+
+    with st.spinner("批次回測中..."):
+        t0 = time.perf_counter()
+        start = datetime.now() - timedelta(days=365 * (max(horizons) + SWEEP_START_SPAN_YEARS))
+        panel = load_daily_panel(tickers, start).reindex(columns=tickers)
+        if panel.empty:
+            st.error("無法取得歷史數據。")
+            return
+        scenarios = sweep_scenarios(panel.index, tickers, modes, amounts, horizons, SWEEP_START_STEPS[step])
+        results = run_backtest_sweep(panel, scenarios)
+        elapsed = time.perf_counter() - t0
+    if results.empty:
+        st.warning("所選區間沒有足夠的歷史資料")
+        return
+    skipped = len(scenarios) - len(results)
+    st.caption(f"共 {len(results):,} 個情境，耗時 {elapsed:.2f} 秒 (熱力圖為各起始日與金額的中位數)"
+               + (f"；略過 {skipped:,} 個起始日早於上市或區間不足的情境" if skipped else ""))
+
+    results.insert(1, "名稱", results["代號"].map(lambda t: names.get(t, t)))
+    results["情境"] = results["模式"] + " " + results["年數"].astype(str) + "年"
+    for metric in ("CAGR", "MDD"):
+        grid = results.pivot_table(index="名稱", columns="情境", values=metric, aggfunc="median") * 100
+
+        def build_heatmap(grid=grid, metric=metric):
+            fig = go.Figure(go.Heatmap(z=grid.to_numpy(), x=list(grid.columns), y=list(grid.index), colorscale="RdYlGn",
+                                       text=grid.round(1).to_numpy(), texttemplate="%{text}%"))
+            fig.update_layout(template="plotly_dark", height=120 + 40 * len(grid), title=f"{metric} 中位數 (%)",
+                              margin=dict(l=10, r=10, t=40, b=10))
+            return fig
+        show_cached_figure("sweep", build_heatmap, grid, metric=metric)
+
+    st.dataframe(results.drop(columns="情境").style.format({"CAGR": "{:.2%}", "MDD": "{:.2%}", "總報酬": "{:.2%}", "金額": "{:,}"}),
+                 use_container_width=True, hide_index=True)
 
 # ==============================================================================
 # 第三部分：【系統初始化與側邊欄管理】 - 密碼、同步、庫存管理
 # ==============================================================================
-st.set_page_config(page_title="小鐵的股票分析報告", layout="wide")
 st.title("📈 小鐵的股票分析報告")
 
 # 初始化 Widget 狀態
 if 'selected_ticker' not in st.session_state: st.session_state.selected_ticker = None
 if 'temp_ticker' not in st.session_state: st.session_state.temp_ticker = None
 
-# API Token 設定
-FINMIND_TOKEN = st.secrets.get("FINMIND_TOKEN", "")
-GEMINI_API_KEY = st.secrets.get("GEMINI_API_KEY", "")
-try: dl.set_token(token=FINMIND_TOKEN)
-except: pass
+# API Token 直接從 st.secrets 讀取：FinMind 連線於第一次使用時才建立 (見 get_finmind_client / fetch_finmind_market_news)
 
 # 側邊欄：帳戶管理
 st.sidebar.title("☁️ 雲端帳戶管理")
-if st.session_state.db:
-    st.sidebar.success("✅ 已連線至 Google Sheets")
-else:
-    if st.sidebar.button("🔄 重新連線雲端"):
-        st.session_state.db = load_db_from_sheets()
-        st.rerun()
-
+conn_slot = st.sidebar.empty()
 st.sidebar.divider()
 
+# 先畫出登入框，再讀取雲端資料 (登入畫面不必等 import 與網路)
+login_slot = st.sidebar.empty()
+input_pwd = login_slot.text_input("🔑 輸入 4 位數密碼開啟報告", type="password", max_chars=4, key="login_pwd")
+mark_startup("登入畫面")
+st.session_state.setdefault("modules_at_login", [
+    m for m in ("yfinance", "pandas", "plotly.graph_objects", "FinMind", "requests") if m in sys.modules
+])
+
+# 初始化 Session State (登入框出現後才從雲端抓資料)
+sync_session_account()
+mark_startup("帳戶讀取")
+
+if st.session_state.db_base is None:
+    # 離線：沒有帳戶內容就無法驗證密碼，也不能讓預設的空帳戶被存檔覆蓋雲端
+    login_slot.empty()
+    st.error(f"⚠️ 無法載入帳戶：本機尚未匯入且雲端讀取失敗 ({ACCOUNT_RETRY_SECONDS} 秒後自動重試)")
+    if conn_slot.button("🔄 重新連線雲端"):
+        refresh_shared_account(from_cloud=True)
+        st.rerun()
+    st.session_state.cold_start_done = True
+    st.stop()
+conn_slot.success("✅ 已載入本地帳戶 (Google Sheets 背景備份)")
+
 # 權限驗證邏輯
 is_authenticated = False
 if st.session_state.db.get("password_hash") is None:
+    login_slot.empty()
     st.sidebar.info("🔓 此雲端帳戶尚未設置密碼")
     if st.sidebar.checkbox("🔒 設置 4 位數登入密碼"):
         new_pwd = st.sidebar.text_input("設定新密碼", type="password", max_chars=4)
         if st.sidebar.button("確認設置"):
             if len(new_pwd) == 4:
                 st.session_state.db["password_hash"] = hash_password(new_pwd)
-                save_db_to_sheets(st.session_state.db)
+                save_account_db(st.session_state.db)
                 st.success("密碼已設定！")
                 st.rerun()
     is_authenticated = True 
 else:
-    input_pwd = st.sidebar.text_input("🔑 輸入 4 位數密碼開啟報告", type="password", max_chars=4)
     if input_pwd:
         if hash_password(input_pwd) == st.session_state.db["password_hash"]:
             is_authenticated = True
@@ -1076,19 +3316,39 @@ else:
 
 if not is_authenticated:
     st.warning("🔒 請輸入正確密碼以解鎖報告")
+    st.session_state.cold_start_done = True
     st.stop()
 
+# 側邊欄：雲端同步狀態 (存檔先寫本地，背景同步)
+has_pending, sync_attempts, sync_error = get_sync_status()
+if has_pending:
+    ensure_sync_worker()["wake"].set()
+    msg = "⏳ 有變更尚未同步至雲端"
+    if sync_attempts:
+        msg += f" (已重試 {sync_attempts} 次：{sync_error})"
+    st.sidebar.warning(msg)
+else:
+    st.sidebar.caption("☁️ 所有變更皆已同步至雲端")
+
 # 側邊欄：進階設定與存檔
 with st.sidebar.expander("⚙️ 進階設定"):
     if st.button("♻️ 強制刷新雲端數據"):
-        # 清除所有快取
-        st.cache_data.clear()
-        st.session_state.db = load_db_from_sheets()
-        st.toast("已同步最新數據並清除快取")
+        # 只重建共用帳戶狀態，行情等快取保留
+        refresh_shared_account(from_cloud=True)
+        sync_session_account()
+        st.toast("已從雲端同步最新帳戶數據")
     if st.button("💾 手動存檔至雲端"):
-        save_db_to_sheets(st.session_state.db)
+        save_account_db(st.session_state.db)
         st.success("存檔完成")
 
+    cold = st.session_state.get("cold_start_timings", {})
+    last = st.session_state.get("run_timings", {})
+    if cold:
+        st.caption("⏱️ 冷啟動：" + " / ".join(f"{k} {v:.0f}ms" for k, v in cold.items()))
+    if last:
+        st.caption("⏱️ 本次執行：" + " / ".join(f"{k} {v:.0f}ms" for k, v in last.items()))
+    st.caption("登入畫面出現時已載入：" + (", ".join(st.session_state.get("modules_at_login", [])) or "無重量級套件"))
+
 # 庫存資產總覽卡片
 active_list = st.session_state.db["list"]
 active_costs = st.session_state.db["costs"]
@@ -1099,6 +3359,7 @@ if st.sidebar.button("➕ 新增股票項目", use_container_width=True): add_st
 if st.sidebar.button("🔍 查看目前全帳戶明細", use_container_width=True): show_full_portfolio_report(active_costs, active_list)
 
 st.sidebar.write("### 📈 績效追蹤")
+if st.sidebar.button("📒 紀錄買賣交易", use_container_width=True): record_trade_dialog()
 col_pnl1, col_pnl2 = st.sidebar.columns(2)
 if col_pnl1.button("💰 紀錄賣出", use_container_width=True): record_sale_dialog() 
 if col_pnl2.button("📊 查看報表", use_container_width=True): show_annual_report_dialog()
@@ -1132,9 +3393,28 @@ if selected_ticker:
 custom_search = st.sidebar.text_input("🔍 全域搜尋 (不加入庫存)", "")
 ticker_input = custom_search if custom_search else selected_ticker
 period = st.sidebar.selectbox("分析時間範圍", ["5d", "1mo", "6mo", "1y", "2y"], index=2)
+use_intraday_archive = st.sidebar.checkbox("📦 使用本地 1 分 K 歷史", value=False,
+                                           help="以本地累積的 1 分 K 取代日線，可查看超過 yfinance 5 日上限的分時走勢")
+
+# 每天自動在背景收集庫存 + 清單的 1 分 K (不阻塞畫面)
+schedule_intraday_collection(tuple(sorted(set(active_list) | set(active_costs))))
+collector_state = _intraday_collector_state()
+if st.sidebar.button("📥 立即收集 1 分 K 歷史", use_container_width=True):
+    if schedule_intraday_collection(tuple(sorted(set(active_list) | set(active_costs))), force=True):
+        st.sidebar.info("已在背景開始收集")
+if collector_state["running"]:
+    st.sidebar.caption("⏳ 1 分 K 收集中...")
+elif collector_state["last_day"]:
+    st.sidebar.caption(f"📦 1 分 K 最近收集：{collector_state['last_day']}")
+
+# 每天在背景更新一次全市場估值庫 (選股估值篩選、河流圖百分位用)
+schedule_market_valuation_update()
 
 if st.sidebar.button("🧪 執行投資模擬回測", use_container_width=True):
     if ticker_input: backtest_dialog(ticker_input)
+if st.sidebar.button("🧮 參數掃描回測", use_container_width=True):
+    sweep_holdings = normalize_holdings(active_costs)
+    sweep_backtest_dialog(list(sweep_holdings.index[sweep_holdings['qty'] > 0]), active_list)
 
 # 個股帳務快速編輯
 current_costs = active_costs.get(selected_ticker, {"cost": 0.0, "qty": 0.0})
@@ -1142,9 +3422,11 @@ st.sidebar.write("---")
 st.sidebar.subheader(f"💰 帳務編輯: {active_list.get(selected_ticker, '未知')}")
 new_cost = st.sidebar.number_input("買入成本", value=float(current_costs["cost"]), step=0.01, key=f"cost_input_{selected_ticker}")
 new_qty = st.sidebar.number_input("持有張數", value=float(current_costs["qty"]), step=1.0, key=f"qty_input_{selected_ticker}")
+if any(tx["代號"] == selected_ticker for tx in st.session_state.db.get("transactions", [])):
+    st.sidebar.caption("⚠️ 此股已有交易帳本：手動修改的成本與張數會在下次紀錄買賣時被帳本重算的數字覆蓋")
 if st.sidebar.button("💾 儲存帳務修改", use_container_width=True):
     st.session_state.db["costs"][selected_ticker] = {"cost": new_cost, "qty": new_qty}
-    save_db_to_sheets(st.session_state.db) 
+    save_account_db(st.session_state.db) 
     st.sidebar.success("已更新")
     st.rerun()
 
@@ -1153,9 +3435,11 @@ show_news = st.sidebar.checkbox("顯示相關新聞", value=True)
 # ==============================================================================
 # 【新增 UI 優化】 - st.tabs 模組化分頁架構
 # ==============================================================================
+# on_change="rerun" 讓分頁追蹤狀態，只有目前開啟的分頁 (tab.open) 會執行；
+# 每個分頁本體是獨立的 st.fragment，分頁內的元件只會重跑該分頁
 tab_portfolio, tab_analysis,  tab_news, tab_fundamental, tab_comparison, tab_ai = st.tabs([
     "🏢 庫存總覽", "📈 個股深度分析",  "📰 產經動態", "💎 基本面河流圖", "⚖️ 同業比較","🤖 AI選股（法人連買排行榜）"
-])
+], key="main_tabs", on_change="rerun")
 
 # ==============================================================================
 # 第四部分：【技術指標與數據分析】 - 計算公式與資料抓取
@@ -1177,43 +3461,24 @@ def calculate_atr(df, window=14):
     tr = pd.concat([df['High']-df['Low'], (df['High']-df['Close'].shift()).abs(), (df['Low']-df['Close'].shift()).abs()], axis=1).max(axis=1)
     return tr.rolling(window=window).mean()
 
-
 # ==============================================================================
 # Tab 1: 庫存總覽 (移入 Tab)
 # ==============================================================================
-with tab_portfolio:
+@st.fragment
+def render_portfolio_tab(active_costs, active_list, transactions, realized_pnl):
     total_cost, total_value = 0.0, 0.0
     processed_data = []
 
     if active_costs:
         with st.spinner("正在同步雲端數據並計算總資產..."):
-            for t_code, info in active_costs.items():
-                try:
-                    # 【效能優化】使用快取取代每次都要重新下載
-                    temp_df = fetch_yf_data_cached(t_code, period="5d", interval="1d")
-                    
-                    if not temp_df.empty:
-                        if isinstance(temp_df.columns, pd.MultiIndex):
-                            temp_df.columns = temp_df.columns.get_level_values(0)
-                        
-                        valid_close = temp_df['Close'].dropna()
-                        if not valid_close.empty:
-                            c_price = float(valid_close.iloc[-1])
-                            
-                            c = float(info['cost']) if isinstance(info, dict) else float(info)
-                            q = float(info['qty']) if isinstance(info, dict) else 0.0
-                            
-                            current_market_val = c_price * q * 1000
-                            total_cost += (c * q * 1000)
-                            total_value += current_market_val
-                            
-                            if current_market_val > 0:
-                                processed_data.append({
-                                    "label": active_list.get(t_code, t_code),
-                                    "value": current_market_val
-                                })
-                except Exception as e:
-                    continue
+            pf = get_portfolio_valuation(active_costs, active_list)
+        pf = pf[pf['price'].notna()]
+        total_cost = float(pf['invested'].sum())
+        total_value = float(pf['market_value'].sum())
+        processed_data = [
+            {"label": name, "value": val}
+            for name, val in zip(pf['name'], pf['market_value']) if val > 0
+        ]
 
     # 計算損益
     profit = total_value - total_cost
@@ -1294,10 +3559,74 @@ with tab_portfolio:
         else:
             st.info(f"✅ **小鐵點評**：資產配置比例健康。目前以 **{max_stock}** 為核心持股。")
 
+    # =============================
+    # 🛡️ 風險分析 (報酬矩陣每日增量更新)
+    # =============================
+    if processed_data:
+        with st.expander("🛡️ 風險分析 (波動 / Beta / 相關係數 / VaR)"):
+            weights = pf.loc[pf['market_value'] > 0, 'market_value']
+            weights = weights / weights.sum()
+            returns = update_returns_matrix(list(weights.index))
+            if len(returns) < 30:
+                st.info("歷史報酬資料不足 30 天，暫不計算風險指標。")
+            else:
+                risk = compute_portfolio_risk(returns, weights)
+                r1, r2, r3, r4 = st.columns(4)
+                r1.metric("組合年化波動", f"{risk['vol'] * 100:.2f}%")
+                r2.metric(f"組合 Beta (vs {RISK_BENCHMARK})", f"{risk['beta']:.2f}")
+                r3.metric("單日 VaR 95% (歷史 / 參數)", f"{risk['hist_var'] * 100:.2f}% / {risk['param_var'] * 100:.2f}%")
+                r4.metric("單日 CVaR 95% (歷史 / 參數)", f"{risk['hist_cvar'] * 100:.2f}% / {risk['param_cvar'] * 100:.2f}%")
+                st.caption(f"以目前總市值 NT$ {int(total_value):,} 計，歷史法單日 95% VaR 約 NT$ {int(risk['hist_var'] * total_value):,}")
+
+                per_stock = risk["per_stock"].rename(index=lambda t: active_list.get(t, t))
+                st.dataframe(per_stock.style.format({"權重": "{:.1%}", "年化波動": "{:.1%}", "Beta": "{:.2f}"}),
+                             use_container_width=True)
+
+                corr = risk["corr"]
+                def build_corr_chart():
+                    fig = go.Figure(go.Heatmap(z=corr.to_numpy(), x=list(corr.columns), y=list(corr.index),
+                                               zmin=-1, zmax=1, colorscale="RdBu_r", text=corr.round(2).to_numpy(),
+                                               texttemplate="%{text}"))
+                    fig.update_layout(template="plotly_dark", height=400, margin=dict(l=10, r=10, t=30, b=10), title="報酬相關係數")
+                    return fig
+                show_cached_figure("corr", build_corr_chart, corr)
+
+    # =============================
+    # 📈 帳戶淨值走勢 (本地增量更新)
+    # =============================
+    if active_costs or transactions:
+        nav_report = get_nav_report(active_costs, transactions, realized_pnl)
+        if not nav_report.empty:
+            st.write("### 📈 帳戶淨值走勢")
+            last_nav = nav_report.iloc[-1]
+            n1, n2, n3 = st.columns(3)
+            n1.metric("總資產 (市值 + 已實現)", f"NT$ {int(last_nav['total_assets']):,}")
+            n2.metric("累計總損益", f"NT$ {int(last_nav['total_pnl']):,}")
+            n3.metric("最大回撤", f"{nav_report['drawdown'].min() * 100:.2f}%")
+
+            def build_nav_chart():
+                fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.05, row_heights=[0.7, 0.3])
+                fig.add_trace(line_trace(nav_report.index, nav_report['total_assets'], name="總資產", line=dict(color='#2962FF')), row=1, col=1)
+                fig.add_trace(line_trace(nav_report.index, nav_report['market_value'], name="持股市值", line=dict(color='#FF9900', width=1)), row=1, col=1)
+                fig.add_trace(line_trace(nav_report.index, nav_report['invested'], name="投入本金", line=dict(color='gray', dash='dot')), row=1, col=1)
+                fig.add_trace(line_trace(nav_report.index, nav_report['drawdown'] * 100, name="回撤幅度(%)", fill='tozeroy', line=dict(color='rgba(255, 82, 82, 0.5)', width=1)), row=2, col=1)
+                fig.update_layout(template="plotly_dark", height=450, hovermode="x unified", margin=dict(l=10, r=10, t=10, b=10))
+                return fig
+
+            show_cached_figure("nav", build_nav_chart, nav_report)
+            st.caption("依交易帳本的日期逐日重播持股與投入本金，已實現損益取自帳本的 FIFO 沖銷；"
+                       "沒有交易紀錄的持股視為區間開始前就已持有，手動輸入的已實現獲利依賣出日期累加。")
+
+with tab_portfolio:
+    if tab_portfolio.open:
+        render_portfolio_tab(active_costs, active_list, st.session_state.db.get("transactions", []),
+                             st.session_state.db.get("realized_pnl", []))
+
 # ==============================================================================
 # Tab 2: 個股深度分析 (移入 Tab 且更新 UI)
 # ==============================================================================
-with tab_analysis:
+@st.fragment
+def render_analysis_tab(ticker_input, period, use_intraday_archive, active_costs):
     # 🎨 TradingView UI 強化 【優化：注入專業波斯綠 #26A69A 與 hover 效果】
     st.markdown("""
     <style>
@@ -1328,11 +3657,7 @@ with tab_analysis:
     df_chip = pd.DataFrame()
 
     if ticker_input:
-        f_period = "2d" if period == "1d" else period
-        f_interval = "1m" if period in ["1d", "5d"] else "1d"
-
-        # 【效能優化】使用快取取代 yf.download
-        data = fetch_yf_data_cached(ticker_input, period=f_period, interval=f_interval)
+        data = load_price_data(ticker_input, period, use_intraday_archive)
 
         if not data.empty:
             if isinstance(data.columns, pd.MultiIndex):
@@ -1364,12 +3689,12 @@ with tab_analysis:
             if ticker_input in active_costs:
                 st.markdown('<div class="section-title">💰 持倉分析</div>', unsafe_allow_html=True)
 
-                info = active_costs[ticker_input]
-                c = float(info['cost']) if isinstance(info, dict) else float(info)
-                q = float(info['qty']) if isinstance(info, dict) else 1.0
-
-                pft = (price*q*1000)-(c*q*1000)
-                pft_r = (pft/(c*q*1000))*100 if c>0 else 0
+                holding = value_portfolio(
+                    normalize_holdings(active_costs).loc[[ticker_input]],
+                    pd.Series({ticker_input: price})
+                ).iloc[0]
+                c = holding['cost']
+                pft, pft_r = holding['pnl'], holding['roi']
 
                 cols = st.columns(4)
 
@@ -1384,8 +3709,8 @@ with tab_analysis:
 
                 card(cols[0], "損益", f"{int(pft):,} ({pft_r:.2f}%)", "up" if pft>0 else "down")
                 card(cols[1], "成本", f"{c:.2f}")
-                card(cols[2], "投入", f"{int(c*q*1000):,}")
-                card(cols[3], "市值", f"{int(price*q*1000):,}")
+                card(cols[2], "投入", f"{int(holding['invested']):,}")
+                card(cols[3], "市值", f"{int(holding['market_value']):,}")
 
             # =============================
             # 📊 即時概況（卡片化）
@@ -1512,60 +3837,86 @@ with tab_analysis:
                     df_trend['自營商'] = df_trend[dealer_cols].sum(axis=1)
                     df_trend = df_trend.drop(columns=dealer_cols, errors='ignore')
 
-                fig_chip = go.Figure()
-
-                for label,color in {'外資':'#2962FF','投信':'#FF6D00','自營商':'#00C853'}.items():
-                    if label in df_trend.columns:
-                        fig_chip.add_trace(go.Scatter(x=df_trend.index,y=df_trend[label],name=label,line=dict(color=color)))
+                def build_chip_chart():
+                    fig_chip = go.Figure()
+                    for label,color in {'外資':'#2962FF','投信':'#FF6D00','自營商':'#00C853'}.items():
+                        if label in df_trend.columns:
+                            fig_chip.add_trace(line_trace(df_trend.index,df_trend[label],name=label,line=dict(color=color)))
+                    fig_chip.update_layout(template="plotly_dark",height=300,hovermode="x unified")
+                    return fig_chip
 
-                fig_chip.update_layout(template="plotly_dark",height=300,hovermode="x unified")
-                st.plotly_chart(fig_chip,use_container_width=True)
+                show_cached_figure("chip", build_chip_chart, df_trend)
 
             # =============================
             # 📊🔥 合併主圖（TV風格）
             # =============================
             st.markdown('<div class="section-title">📊 技術分析</div>', unsafe_allow_html=True)
 
-            fig = make_subplots(
-                rows=3, cols=1,
-                shared_xaxes=True,
-                vertical_spacing=0.03,
-                row_heights=[0.6,0.2,0.2]
-            )
+            # 🔍 縮放：伺服器端依可視區間重新分箱，點數固定不隨區間變大
+            view = data
+            if len(data) > CHART_TARGET_PX:
+                x_min = data.index[0].to_pydatetime().replace(tzinfo=None)
+                x_max = data.index[-1].to_pydatetime().replace(tzinfo=None)
+                zoom = st.slider("🔍 縮放區間", min_value=x_min, max_value=x_max, value=(x_min, x_max),
+                                 format="YYYY-MM-DD HH:mm")
+                naive_index = data.index.tz_localize(None) if data.index.tz is not None else data.index
+                view = data[(naive_index >= zoom[0]) & (naive_index <= zoom[1])]
+
+            chart_cols = ['Open', 'High', 'Low', 'Close', 'Volume', 'MA5', 'MA20', 'MA60', 'ATR_Trailing', 'RSI', 'MACD']
+
+            def build_tech_chart():
+                candles = downsample_ohlc(view[['Open', 'High', 'Low', 'Close', 'Volume']])
+
+                def line(col):
+                    return downsample_line(view[col])
+
+                fig = make_subplots(
+                    rows=3, cols=1,
+                    shared_xaxes=True,
+                    vertical_spacing=0.03,
+                    row_heights=[0.6,0.2,0.2]
+                )
 
-            # K線 (【UI優化】將下降 K 線改為波斯綠色)
-            fig.add_trace(go.Candlestick(
-                x=data.index,
-                open=data['Open'],
-                high=data['High'],
-                low=data['Low'],
-                close=data['Close'],
-                increasing_line_color='#FF4B4B',
-                decreasing_line_color='#26A69A'
-            ), row=1,col=1)
-
-            # MA + ATR
-            fig.add_trace(go.Scatter(x=data.index,y=data['MA5'],name="5日均線",line=dict(color='white',width=1)),row=1,col=1)
-            fig.add_trace(go.Scatter(x=data.index,y=data['MA20'],name="20日均線",line=dict(color='orange',width=1)),row=1,col=1)
-            fig.add_trace(go.Scatter(x=data.index,y=data['MA60'],name="60日均線",line=dict(color='green',width=1)),row=1,col=1)
-            fig.add_trace(go.Scatter(x=data.index,y=data['ATR_Trailing'],name="ATR 停損線",line=dict(color='magenta',dash='dot')),row=1,col=1)
-
-            fig.add_trace(go.Bar(x=data.index,y=data['Volume'],name="成交量",marker_color='rgba(100,149,237,0.4)'),row=2,col=1)
-
-            fig.add_trace(go.Scatter(x=data.index,y=data['RSI'],name="RSI 指標",line=dict(color='yellow')),row=3,col=1)
-            fig.add_trace(go.Scatter(x=data.index,y=data['MACD'],name="MACD 動能",line=dict(color='#00CCFF')),row=3,col=1)
-
-            fig.update_layout(
-                template="plotly_dark",
-                height=800,
-                hovermode="x unified",
-                margin=dict(l=10,r=10,t=10,b=10),
-                xaxis_rangeslider_visible=False
-            )
+                # K線 (【UI優化】將下降 K 線改為波斯綠色)
+                fig.add_trace(go.Candlestick(
+                    x=candles.index,
+                    open=candles['Open'],
+                    high=candles['High'],
+                    low=candles['Low'],
+                    close=candles['Close'],
+                    increasing_line_color='#FF4B4B',
+                    decreasing_line_color='#26A69A'
+                ), row=1,col=1)
+
+                # MA + ATR
+                for col_name, label, style in [
+                    ('MA5', "5日均線", dict(color='white',width=1)),
+                    ('MA20', "20日均線", dict(color='orange',width=1)),
+                    ('MA60', "60日均線", dict(color='green',width=1)),
+                    ('ATR_Trailing', "ATR 停損線", dict(color='magenta',dash='dot')),
+                ]:
+                    s_line = line(col_name)
+                    fig.add_trace(line_trace(s_line.index,s_line,name=label,line=style),row=1,col=1)
+
+                fig.add_trace(go.Bar(x=candles.index,y=candles['Volume'],name="成交量",marker_color='rgba(100,149,237,0.4)'),row=2,col=1)
+
+                rsi_line, macd_line = line('RSI'), line('MACD')
+                fig.add_trace(line_trace(rsi_line.index,rsi_line,name="RSI 指標",line=dict(color='yellow')),row=3,col=1)
+                fig.add_trace(line_trace(macd_line.index,macd_line,name="MACD 動能",line=dict(color='#00CCFF')),row=3,col=1)
+
+                fig.update_layout(
+                    template="plotly_dark",
+                    height=800,
+                    hovermode="x unified",
+                    margin=dict(l=10,r=10,t=10,b=10),
+                    xaxis_rangeslider_visible=False
+                )
 
-            fig.update_yaxes(gridcolor="#2A2E39")
+                fig.update_yaxes(gridcolor="#2A2E39")
+                return fig
 
-            st.plotly_chart(fig,use_container_width=True)
+            # 資料與區間都沒變時直接沿用快取的圖表
+            show_cached_figure("technical", build_tech_chart, view[chart_cols])
 
             # =============================
             # 🤖 AI 專業評分系統（升級版）
@@ -1730,10 +4081,15 @@ with tab_analysis:
             - 風控：{atr_label}
             """)
 
+with tab_analysis:
+    if tab_analysis.open:
+        render_analysis_tab(ticker_input, period, use_intraday_archive, active_costs)
+
 # ==============================================================================
 # Tab 4: 產經動態 (移入 Tab)
 # ==============================================================================
-with tab_news:
+@st.fragment
+def render_news_tab(ticker_input, show_news):
     if show_news and ticker_input:
         st.subheader("📰 台灣產經新聞")
 
@@ -1751,18 +4107,23 @@ with tab_news:
                 keywords += stock_map[stock_code]
 
             # =============================================================
-            # ✅ 核心修正：直接呼叫一次，傳入「代碼」與「關鍵字清單」兩個參數！
+            # ✅ 各來源並行查詢、各自有截止時間；來不及回應的來源下次重新整理會補上
             # =============================================================
-            df_news = fetch_news_data_cached(stock_code, keywords)
+            df_news, late_sources = gather_news(stock_code, keywords)
 
             # =============================
             # 🔄 Fallback (如果該股完全沒新聞，改抓產業大盤新聞)
             # =============================
-            if df_news.empty:
+            if df_news.empty and not late_sources:
                 st.warning("⚠️ 個股新聞較少，改為顯示產業新聞")
                 fallback_keywords = ["台股", "半導體", "電子產業"]
                 # 傳入大盤虛擬代碼 "TSE" 與產業關鍵字
-                df_news = fetch_news_data_cached("TSE", fallback_keywords)
+                df_news, late_sources = gather_news("TSE", fallback_keywords)
+
+            if late_sources:
+                c_note, c_btn = st.columns([4, 1])
+                c_note.caption(f"⏳ {', '.join(late_sources)} 尚未回應，先顯示已取得的新聞，重新整理即可補上。")
+                c_btn.button("🔄 重新整理", key="news_refresh")
 
             # =============================
             # 🎨 UI 呈現 (對齊你快取輸出的欄位)
@@ -1806,120 +4167,192 @@ with tab_news:
         except Exception as e:
             st.error(f"新聞模組錯誤：{e}")
 
-with tab_fundamental:
+with tab_news:
+    if tab_news.open:
+        render_news_tab(ticker_input, show_news)
+
+@st.fragment
+def render_fundamental_tab(ticker_input):
     st.subheader("💎 本益比河流圖 (Valuation Bands)")
     
     try:
         stock_id = ticker_input.split('.')[0]
-        dl = DataLoader()
-        
-        # 登入相容性處理
-        if "FINMIND_TOKEN" in st.secrets:
-            token = st.secrets["FINMIND_TOKEN"]
-            if hasattr(dl, 'login'): dl.login(token=token)
-            elif hasattr(dl, 'set_token'): dl.set_token(token=token)
-            else: dl.token = token
-
-        # 1. 抓取 FinMind 的 PE 資料
-        df_per = dl.taiwan_stock_per_pbr(
-            stock_id=stock_id,
-            start_date=(datetime.now() - timedelta(days=365*3)).strftime('%Y-%m-%d')
-        )
-        
-        if not df_per.empty:
-            # --- 💡 關鍵修正區：處理 yfinance 的 MultiIndex ---
-            df_per['date'] = pd.to_datetime(df_per['date'])
-            
-            # 複製一份 data 來處理，避免影響到其他 Tab
-            temp_yf_data = data.copy()
-            
-            # 【修正點 1】壓平 MultiIndex：將 ('Close', '2330.TW') 變成 'Close'
-            if isinstance(temp_yf_data.columns, pd.MultiIndex):
-                temp_yf_data.columns = temp_yf_data.columns.get_level_values(0)
-            
-            # 【修正點 2】提取收盤價並重設索引
-            price_df = temp_yf_data[['Close']].reset_index()
-            price_df.columns = ['date', 'close_from_yf']
-            
-            # 【修正點 3】統一日期格式（移除時區）：這是為了讓 merge 能對上
-            price_df['date'] = pd.to_datetime(price_df['date']).dt.tz_localize(None)
-            df_per['date'] = pd.to_datetime(df_per['date']).dt.tz_localize(None)
+        start = datetime.now() - timedelta(days=365*3)
 
-            # 2. 合併兩份資料
-            df_combined = pd.merge(df_per, price_df, on='date', how='inner')
+        # 1. 本益比與近三年日線都從本地資料庫讀取 (只補抓缺少的天數)
+        df_per = load_per_pbr(stock_id, start)
+        
+        if not df_per.empty and 'PER' in df_per.columns:
+            close = load_daily_history(ticker_input, start)['Close'].dropna()
+            price_df = close.rename('close').rename_axis('date').reset_index()
+
+            # 2. as-of 合併：每個交易日對上當日 (或最近一筆已公布) 的本益比，不會被其他分頁的期間截斷
+            df_combined = pd.merge_asof(
+                price_df.sort_values('date'),
+                df_per[['PER']].rename_axis('date').reset_index().sort_values('date'),
+                on='date', direction='backward', tolerance=pd.Timedelta(days=7)
+            )
+            df_combined = df_combined[df_combined['PER'] > 0]
             
             if not df_combined.empty:
-                # 確保 PE 大於 0 才計算
-                per_col = None
-
-                if 'pe_ratio' in df_combined.columns:
-                    per_col = 'pe_ratio'
-                elif 'PER' in df_combined.columns:
-                    per_col = 'PER'
-
-                if per_col is None:
-                    st.error("❌ 找不到 PER 欄位")
-                    st.stop()
-
-                # 過濾與計算
-                df_combined = df_combined[df_combined[per_col] > 0]
-
-                df_combined['hist_eps'] = (
-                    df_combined['close_from_yf'] / df_combined[per_col]
-                )
+                # 還原權息價 / 本益比：價格與河流同比例還原，相對位置不變
+                df_combined['hist_eps'] = df_combined['close'] / df_combined['PER']
                 
-                # 3. 繪圖
-                multiples = [10, 15, 20, 25, 30] 
-                fig_river = go.Figure()
+                # 3. 河流倍數取自該股近三年本益比的百分位 (取代固定的 10~30 倍)
+                multiples = [round(float(m), 2) for m in np.percentile(df_combined['PER'], RIVER_PERCENTILES)]
+                current_pct = (df_combined['PER'] < df_combined['PER'].iloc[-1]).mean()
+                st.caption(f"目前本益比 {df_combined['PER'].iloc[-1]:.1f} 倍，高於近三年 {current_pct:.0%} 的交易日")
+                valuation = load_valuation_percentiles()
+                if valuation is not None and stock_id in valuation.index and pd.notna(valuation.at[stock_id, 'PER_industry_pct']):
+                    st.caption(f"在 {valuation.at[stock_id, 'industry']} 產業中的本益比百分位：{valuation.at[stock_id, 'PER_industry_pct']:.0%}")
+
+                def build_river_chart():
+                    fig_river = go.Figure()
                 
-                # 使用你先前的河流區塊邏輯
-                for m in multiples:
-                    fig_river.add_trace(go.Scatter(
-                        x=df_combined['date'], 
-                        y=df_combined['hist_eps'] * m, 
-                        name=f"{m}x PER", 
-                        line=dict(width=0.5),
-                        stackgroup='one',
-                        fill='tonexty'
-                    ))
+                    # 各百分位倍數一條線，線與線之間填色成河流 (不堆疊)
+                    for i, (q, m) in enumerate(zip(RIVER_PERCENTILES, multiples)):
+                        fig_river.add_trace(line_trace(
+                            df_combined['date'],
+                            df_combined['hist_eps'] * m,
+                            name=f"P{q} ({m:.1f}x PER)", 
+                            line=dict(width=0.5),
+                            fill='tonexty' if i else None
+                        ))
                 
-                # 疊加實際股價
-                fig_river.add_trace(go.Scatter(
-                    x=df_combined['date'], 
-                    y=df_combined['close_from_yf'],
-                    name="實際股價", 
-                    line=dict(color='#FF4B4B', width=2)
-                ))
+                    # 疊加實際股價
+                    fig_river.add_trace(line_trace(
+                        df_combined['date'],
+                        df_combined['close'],
+                        name="實際股價", 
+                        line=dict(color='#FF4B4B', width=2)
+                    ))
                 
-                fig_river.update_layout(
-                    template="plotly_dark",
-                    paper_bgcolor='rgba(0,0,0,0)',
-                    plot_bgcolor='rgba(0,0,0,0)',
-                    xaxis_title="日期",
-                    yaxis_title="股價",
-                    hovermode="x unified"
-                )
-                st.plotly_chart(fig_river, use_container_width=True)
+                    fig_river.update_layout(
+                        template="plotly_dark",
+                        paper_bgcolor='rgba(0,0,0,0)',
+                        plot_bgcolor='rgba(0,0,0,0)',
+                        xaxis_title="日期",
+                        yaxis_title="股價 (還原權息)",
+                        hovermode="x unified"
+                    )
+                    return fig_river
+
+                show_cached_figure("river", build_river_chart,
+                                   df_combined[['date', 'hist_eps', 'close']], multiples=multiples)
             else:
-                st.warning("⚠️ 合併資料後無相符日期，請確認 yfinance 數據範圍是否包含近三年。")
+                st.warning("⚠️ 近三年股價與本益比資料沒有重疊的日期。")
         else:
             st.info("⚠️ FinMind 暫無該股之 PER 歷史資料")
             
     except Exception as e:
         st.error(f"河流圖載入失敗: {e}")
-    except Exception as e:
-        # 如果報錯，把錯誤原因印出來方便 debug
-        st.error(f"河流圖載入失敗: {str(e)}")
-        # 選項：顯示目前 df_per 的欄位名稱，幫你確認問題
-        if 'df_per' in locals() and not df_per.empty:
-            st.write("目前的資料欄位有:", list(df_per.columns))
 
-with tab_comparison:
+with tab_fundamental:
+    if tab_fundamental.open:
+        render_fundamental_tab(ticker_input)
+
+def render_sector_relative(ticker, sector, period, layout):
+    """個股 vs 所屬產業指數 (等權 / 市值加權) vs 大盤，同一區間起點皆為 100"""
+    if sector is None:
+        st.caption("ℹ️ 查無此代號的產業分類，略過產業相對表現。")
+        return
+    # 只建有人查看的產業 (每個產業每天一次)，不必為全市場約 1800 檔下載日線
+    schedule_sector_index_update(sector)
+    indices = load_sector_index(sector)
+    if indices is None or sector not in indices.columns.get_level_values(0):
+        st.caption(f"⏳ {sector} 產業指數建立中 (背景下載成員日線)，稍後重新整理即可看到相對表現。")
+        return
+
+    own = load_comparison_panel([ticker, RISK_BENCHMARK], period)
+    sector_idx = indices[sector]
+    sector_idx = sector_idx[sector_idx.index >= comparison_start(period)]
+    if own.empty or sector_idx.empty:
+        return
+    sector_idx = sector_idx / sector_idx.iloc[0] * 100
+    kinds = ["等權", "市值加權"] if indices.attrs.get("cap_weighted") else ["等權"]
+    relative = own.rename(columns={RISK_BENCHMARK: f"大盤 ({RISK_BENCHMARK})"})
+    for kind in kinds:
+        relative[f"{sector} {kind}"] = sector_idx[kind].reindex(relative.index, method='ffill')
+
+    render_line_chart(relative, highlight=ticker, layout=layout, height=350,
+                      title=f"{ticker} vs {sector} 產業指數 vs 大盤 ({period})")
+    last = relative.ffill().iloc[-1] - 100
+    cols = st.columns(len(relative.columns))
+    for col, (name, ret) in zip(cols, last.items()):
+        diff = None if name == ticker or pd.isna(last.get(ticker)) else last[ticker] - ret
+        col.metric(name, f"{ret:+.1f}%", None if diff is None else f"{ticker} 相對 {diff:+.1f}%",
+                   delta_color="inverse")
+
+def render_rolling_stats(tickers, period, layout):
+    """比較組合的滾動相關、滾動 Beta、相對強弱，以及最近一個視窗的相關矩陣"""
+    window = st.radio("滾動視窗 (交易日)", ROLLING_WINDOWS, index=1, horizontal=True, key="rolling_window")
+    returns, cums = update_rolling_sums(tickers, RISK_BENCHMARK)
+    if len(returns) <= window:
+        st.info(f"歷史報酬資料不足 {window} 天。")
+        return
+    start = comparison_start(period)
+    corr, beta = rolling_corr_beta(returns, cums, window)
+    corr, beta = corr.loc[corr.index >= start, tickers], beta.loc[beta.index >= start, tickers]
+    rs = relative_strength(returns, RISK_BENCHMARK, start)[tickers]
+    others = [t for t in tickers if t != RISK_BENCHMARK] or tickers
+
+    summary = pd.DataFrame({
+        f"相關係數 ({window}日)": corr.iloc[-1] if not corr.empty else np.nan,
+        f"Beta ({window}日)": beta.iloc[-1] if not beta.empty else np.nan,
+        "相對強弱": rs.iloc[-1] if not rs.empty else np.nan,
+    }).loc[others]
+    st.dataframe(summary.style.format("{:.2f}"), use_container_width=True)
+
+    c1, c2 = st.columns(2)
+    with c1:
+        render_line_chart(corr[others], layout=layout, height=320, title=f"滾動相關係數 ({window} 日)")
+    with c2:
+        render_line_chart(beta[others], layout=layout, height=320, title=f"滾動 Beta ({window} 日)")
+    render_line_chart(rs[others], layout=layout, height=320, title=f"相對強弱 (vs {RISK_BENCHMARK}，起點 100)")
+
+    matrix = returns[tickers].tail(window).corr()
+    def build_corr_chart():
+        fig = go.Figure(go.Heatmap(z=matrix.to_numpy(), x=list(matrix.columns), y=list(matrix.index),
+                                   zmin=-1, zmax=1, colorscale="RdBu_r", text=matrix.round(2).to_numpy(),
+                                   texttemplate="%{text}"))
+        fig.update_layout(template="plotly_dark", height=max(400, 18 * len(tickers)),
+                          margin=dict(l=10, r=10, t=30, b=10), title=f"最近 {window} 日報酬相關係數")
+        return fig
+    show_cached_figure("compare_corr", build_corr_chart, matrix)
+
+@st.fragment
+def render_comparison_tab(ticker_input):
     st.subheader("⚖️ 同業動態績效比較")
     
     # --- 1. 時間區間選擇器 (讓功能更有彈性) ---
     time_period = st.radio("選擇比較區間", ["1mo", "3mo", "6mo", "1y", "ytd"], 
                            index=2, horizontal=True) # 預設 6mo
+
+    # TradingView 黑色專業佈局 (兩張圖共用)
+    dark_layout = dict(
+        template="plotly_dark",
+        hovermode="x unified",
+        paper_bgcolor='#131722',
+        plot_bgcolor='#131722',
+        xaxis=dict(gridcolor='#2A2E39', zeroline=False, showspikes=True, spikecolor="gray"),
+        yaxis=dict(gridcolor='#2A2E39', zeroline=False, showspikes=True, spikecolor="gray"),
+        legend=dict(bgcolor='rgba(0,0,0,0)'),
+        margin=dict(l=0, r=0, t=50, b=0)
+    )
+
+    # --- 1.5 所屬產業與大盤的相對表現 (產業指數在第一次查看該產業時於背景建立，每日更新) ---
+    try:
+        info = load_stock_info()
+        sector = ticker_sector(ticker_input, info)
+        peers = sector_members(info).get(sector, []) if sector else []
+        built = load_sector_index(sector) if sector else None
+        if built is not None and built.attrs.get("members_by_cap"):
+            peers = built.attrs["members_by_cap"]
+        peers = peers[:SECTOR_PEER_LIMIT]
+    except Exception as e:
+        print("產業資料讀取失敗:", e)
+        sector, peers = None, []
+    render_sector_relative(ticker_input, sector, time_period, dark_layout)
     
     # --- 2. 確保初始化 ---
     if 'comparison_selector' not in st.session_state:
@@ -1937,7 +4370,8 @@ with tab_comparison:
     st.text_input("➕ 新增比較代號 (例如: 2454.TW)", 
                   key="new_stock_input", on_change=handle_add_stock)
 
-    base_options = ["0050.TW", "2330.TW", "2317.TW", "0056.TW"]
+    # 同產業個股自動列為候選 (再加上大盤 ETF)
+    base_options = peers + ["0050.TW", "0056.TW"] if peers else ["0050.TW", "2330.TW", "2317.TW", "0056.TW"]
     all_options = sorted(list(set(base_options + st.session_state.comparison_selector)))
 
     compare_targets = st.multiselect("目前比較對象", options=all_options, key="comparison_selector")
@@ -1945,44 +4379,21 @@ with tab_comparison:
     # --- 3. 繪圖與數據邏輯 ---
     if compare_targets:
         try:
-            # 根據選擇的 time_period 抓取資料
-            df_raw = yf.download(compare_targets, period=time_period, interval="1d", auto_adjust=True)
-            comp_data = df_raw['Close']
+            # 價格走本地日線庫：已有的代號不再下載，只補新加入的代號 / 缺少的區段
+            comp_norm = load_comparison_panel(compare_targets, time_period)
+            missing = [t for t in compare_targets if t not in comp_norm.columns]
+            if missing:
+                st.caption(f"⚠️ 找不到資料：{', '.join(missing)}")
             
-            if not comp_data.empty:
-                # 核心邏輯：歸一化 (將區間起點設為 100)
-                comp_norm = (comp_data / comp_data.iloc[0]) * 100
-                
-                fig_comp = go.Figure()
-                
-                # 轉成 DataFrame 統一處理
-                if isinstance(comp_norm, pd.Series):
-                    comp_norm = comp_norm.to_frame()
-
-                for col in comp_norm.columns:
-                    is_self = (col == ticker_input)
-                    fig_comp.add_trace(go.Scatter(
-                        x=comp_norm.index, 
-                        y=comp_norm[col], 
-                        name=col,
-                        line=dict(width=3 if is_self else 1.5),
-                        mode='lines'
-                    ))
-                
-                # TradingView 黑色專業佈局
-                fig_comp.update_layout(
+            if not comp_norm.empty:
+
+                # 點數多時自動改用 WebGL / ECharts
+                render_line_chart(
+                    comp_norm,
+                    highlight=ticker_input,
                     title=f"累積報酬率比較 ({time_period}) - 起始點為 100",
-                    template="plotly_dark",
-                    hovermode="x unified",
-                    paper_bgcolor='#131722',
-                    plot_bgcolor='#131722',
-                    xaxis=dict(gridcolor='#2A2E39', zeroline=False, showspikes=True, spikecolor="gray"),
-                    yaxis=dict(gridcolor='#2A2E39', zeroline=False, showspikes=True, spikecolor="gray"),
-                    legend=dict(bgcolor='rgba(0,0,0,0)'),
-                    margin=dict(l=0, r=0, t=50, b=0)
+                    layout=dark_layout
                 )
-
-                st.plotly_chart(fig_comp, use_container_width=True)
                 
                 # --- 4. 績效排行榜  ---
                 st.write(f"🏆 **{time_period} 績效排行 (紅漲綠跌模式)**")
@@ -2005,48 +4416,54 @@ with tab_comparison:
                             delta=f"{net_return:+.1f}%",
                             delta_color=color_logic
                         )
+
+                # --- 5. 滾動相關 / Beta / 相對強弱 (對大盤基準) ---
+                with st.expander(f"📐 滾動相關係數 / Beta / 相對強弱 (vs {RISK_BENCHMARK})"):
+                    render_rolling_stats(list(comp_norm.columns), time_period, dark_layout)
             else:
                 st.warning("⚠️ 找不到資料")
 
         except Exception as e:  
             st.error(f"繪圖發生錯誤: {e}")
 
-        except Exception as e:  
-            st.error(f"繪圖發生錯誤: {e}")
-
-import concurrent.futures
-import pandas as pd
-import streamlit as st
-from datetime import datetime, timedelta
-
-with tab_ai:
+with tab_comparison:
+    if tab_comparison.open:
+        render_comparison_tab(ticker_input)
+
+def valuation_note(row):
+    """結果卡片上的估值說明 (沒有估值資料時為空字串)"""
+    if pd.isna(row.get('PER歷史百分位', np.nan)):
+        return ""
+    return (f" ｜ PER: {row['PER']:.1f} (歷史 {row['PER歷史百分位']:.0%} / 產業 {row['PER產業百分位']:.0%})"
+            f" ｜ 殖利率: {row['殖利率']:.2f}%")
+
+@st.fragment
+def render_ai_tab():
     st.markdown("### 🤖 全台股 AI 掃描模式")
     
     scan_target = st.selectbox("選擇掃描範圍", ["我的股票池 (Sheets)", "全市場 (上市櫃股票)"])
     scan_limit = st.slider("掃描標的數量", 10, 2000, 500)
     
+    valuation = load_valuation_percentiles()
+    if valuation is not None:
+        max_per_pct = st.slider("估值篩選：PER 位於自身歷史百分位 ≤", 0, 100, 100, step=5,
+                                help=f"全市場估值庫資料日：{valuation.attrs.get('as_of')}；100 代表不篩選") / 100
+    else:
+        max_per_pct = 1.0
+        st.caption("⏳ 全市場估值庫建立中 (背景每日更新)，完成後可依估值百分位篩選")
+
     if st.button("🚀 啟動高效能掃描"):
-        df_info = dl.taiwan_stock_info()
-        df_info['stock_id'] = df_info['stock_id'].astype(str)
+        df_info = load_stock_info()
         
         # 1. 準備清單並徹底清洗格式
-        if scan_target == "我的股票池 (Sheets)":
-            raw_list = load_stock_pool()
-            full_list = []
-            for s in raw_list:
-                try:
-                    full_list.append(str(int(float(s))))
-                except: continue
-        else:
-            # 排除權證，只留普通股
-            full_list = df_info[df_info['type'] == 'stock']['stock_id'].tolist()
+        full_list = load_screen_universe(scan_target, df_info)
         
         test_list = full_list[:scan_limit]
         total_count = len(test_list)
         
         if total_count == 0:
             st.error("❌ 清單為空，請確認資料源。")
-            st.stop()
+            return
 
         st.info(f"⚡️ 啟動多執行緒分析 {total_count} 檔標的...")
         
@@ -2101,9 +4518,17 @@ with tab_ai:
             else:
                 st.error("❌ 完全沒有抓到資料。可能原因：假日 API 未更新或 yfinance 被限流。")
 
-        # 4. 顯示結果卡片
+        # 4. 顯示結果卡片 (估值百分位直接查預先算好的表，不必另外下載)
         if results:
             df_res = pd.DataFrame(results).sort_values(by="分數", ascending=False)
+            if valuation is not None:
+                val = valuation.reindex(df_res['股票'].astype(str))
+                df_res['PER'] = val['PER'].to_numpy()
+                df_res['PER歷史百分位'] = val['PER_hist_pct'].to_numpy()
+                df_res['PER產業百分位'] = val['PER_industry_pct'].to_numpy()
+                df_res['殖利率'] = val['dividend_yield'].to_numpy()
+                if max_per_pct < 1.0:
+                    df_res = df_res[df_res['PER歷史百分位'] <= max_per_pct]
             st.success(f"✅ 篩選出 {len(df_res)} 檔標的")
             for _, row in df_res.head(20).iterrows():
                 card_color = "#00E676" if row['分數'] >= 60 else "#FFD54F"
@@ -2114,7 +4539,58 @@ with tab_ai:
                         <span style="color:{card_color}; font-size:18px;"><b>AI 評分: {row['分數']}</b></span>
                     </div>
                     <div style="color:#9BA3AF; font-size:14px; margin-top:5px;">
-                        外資連買: {row['外資買超天數']}天 ｜ 現價: {row['現價']} ｜ MA20: {row['MA20']:.2f}
+                        外資連買: {row['外資買超天數']}天 ｜ 現價: {row['現價']} ｜ MA20: {row['MA20']:.2f}{valuation_note(row)}
                     </div>
                 </div>
                 """, unsafe_allow_html=True)
+
+    # =============================
+    # 📊 評分規則歷史驗證
+    # =============================
+    with st.expander("📊 評分規則歷史驗證 (walk-forward)"):
+        st.caption("以本地日線與外資買賣超庫，逐日重算每檔的 AI 評分 (不使用未來資料)，統計各分數區間之後 5 / 20 / 60 日的報酬。")
+        c1, c2, c3 = st.columns(3)
+        replay_target = c1.selectbox("驗證範圍", ["我的股票池 (Sheets)", "全市場 (上市櫃股票)"], key="replay_target")
+        replay_years = c2.slider("回測年數", 1, 5, 2, key="replay_years")
+        replay_limit = c3.slider("標的數量上限", 10, 2000, 200, key="replay_limit")
+
+        if st.button("▶️ 執行歷史驗證", key="replay_run"):
+            df_info = load_stock_info()
+            stock_ids = load_screen_universe(replay_target, df_info)[:replay_limit]
+            if not stock_ids:
+                st.error("❌ 清單為空，請確認資料源。")
+                return
+
+            t0 = time.perf_counter()
+            # 多抓 3 個月讓 MA20 / 量比在區間起點就有值
+            start = datetime.now() - timedelta(days=365 * replay_years + 90)
+            tickers = {sid: screen_yf_ticker(sid, df_info) for sid in stock_ids}
+            with st.spinner(f"同步 {len(stock_ids)} 檔日線與籌碼 (已存在本地的只補最新幾天)..."):
+                close = load_daily_panel(list(tickers.values()), start)
+                volume = load_daily_panel(list(tickers.values()), start, field='Volume')
+                chips = load_chip_panel(stock_ids, start)
+                pending_chips = chips.attrs.get("pending", 0)
+                chips = chips.rename(columns=tickers)
+            if close.empty:
+                st.error("無法取得歷史數據。")
+                return
+
+            volume = volume.reindex_like(close)
+            score = replay_screen_scores(close, volume, chips)
+            report = score_bucket_report(score, close)
+            elapsed = time.perf_counter() - t0
+
+            st.caption(f"{close.shape[1]} 檔 × {close.shape[0]} 個交易日，共 {int(score.notna().sum().sum()):,} 個評分樣本，耗時 {elapsed:.1f} 秒")
+            if pending_chips:
+                st.warning(f"受 FinMind 請求額度限制，尚有 {pending_chips} 檔的外資買賣超還沒補齊 (這些檔的籌碼分數偏低)，稍後再執行會接著補。")
+            ret_cols = [c for c in report.columns if "報酬" in c]
+            rate_cols = [c for c in report.columns if "勝率" in c]
+            st.dataframe(report.style.format({**{c: "{:+.2%}" for c in ret_cols}, **{c: "{:.1%}" for c in rate_cols}}),
+                         use_container_width=True)
+
+with tab_ai:
+    if tab_ai.open:
+        render_ai_tab()
+
+mark_startup("全頁完成")
+st.session_state.cold_start_done = True